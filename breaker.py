@@ -0,0 +1,141 @@
+"""Circuit breaker для вызовов Telegram API.
+
+Пока цель (канал, метод) отвечает — breaker закрыт и вызовы идут как обычно.
+После failure_threshold сбоев подряд он открывается: вызовы сразу получают
+CircuitOpen и не ждут таймаута. Через паузу один пробный вызов проходит
+(half-open): удался — breaker закрыт, нет — снова открыт на вдвое большую
+паузу (с джиттером, чтобы пробы разных целей не совпадали).
+
+Сбоем считаются только ошибки сети и сервера Telegram: ответ «Bad Request»
+значит, что API работает.
+"""
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, asyncio.TimeoutError)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"circuit {name} is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        base_delay: float = 5.0,
+        max_delay: float = 300.0,
+        jitter: float = 0.2,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+        self.state = CLOSED
+        self.failures = 0          # сбоев подряд
+        self.opens = 0             # открытий подряд (для backoff)
+        self.retry_at = 0.0        # monotonic: когда пустить пробный вызов
+        self.probing = False
+        self.last_error: str | None = None
+        self.calls = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @staticmethod
+    def is_failure(error: BaseException) -> bool:
+        return isinstance(error, TRANSIENT_ERRORS)
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() >= self.retry_at:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.probing = False
+
+    def record_failure(self, error: BaseException):
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        self.probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._trip()
+
+    def _trip(self):
+        self.opens += 1
+        self.trips += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.opens - 1))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.state = OPEN
+        self.retry_at = time.monotonic() + delay
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Вызов через breaker. Если он открыт — сразу CircuitOpen."""
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        self.calls += 1
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # пробный вызов отменили — пусть следующий попробует заново
+            self.probing = False
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self.record_failure(e)
+            else:
+                # API ответил ошибкой запроса — сам сервис работает
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "retry_in": max(0.0, self.retry_at - time.monotonic()) if self.state != CLOSED else 0.0,
+            "last_error": self.last_error,
+        }
+
+
+class BreakerRegistry:
+    """Breaker на каждую цель, создаётся при первом обращении."""
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, **self.defaults)
+        return breaker
+
+    def __iter__(self):
+        return iter(self._breakers.values())
@@ -0,0 +1,311 @@
+"""Рассылка /all фоновым заданием.
+
+Получатели читаются из users пачками по id (keyset), сообщения уходят
+несколькими параллельными отправителями через общий TokenBucket. Если
+Telegram отвечает RetryAfter, пауза ставится всем отправителям, а само
+сообщение повторяется. Заблокировавших бота (users.blocked_ts) в выборке
+нет, а новые Forbidden сразу отмечаются.
+
+После каждой пачки прогресс и id последнего получателя сохраняются в
+broadcasts. После рестарта незавершённые задания продолжаются с этой
+точки. Пачка, которая отправлялась в момент падения, может дойти до
+кого-то повторно — поэтому пачки небольшие.
+
+У админа в чате живёт сообщение с прогрессом, оно обновляется по ходу
+рассылки. Паузу, продолжение и отмену делают команды /bcpause, /bcresume,
+/bccancel.
+
+Процессов на одном токене может быть несколько (webhook), но задание ведёт
+один: владелец (broadcasts.owner) берёт его условным UPDATE и продлевает
+аренду (lease_ts) на каждой контрольной точке. Задание упавшего процесса
+другой заберёт, когда аренда истечёт; при штатной остановке задания
+отпускаются сразу. Команды управления пишут статус в БД, а владелец читает
+его на каждой контрольной точке — в чужом процессе команда срабатывает
+не позже чем через пачку.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from contextlib import suppress
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from db_async import (
+    claim_broadcasts,
+    create_broadcast,
+    get_stats,
+    list_broadcast_recipients,
+    mark_blocked,
+    release_broadcasts,
+    save_broadcast_progress,
+    set_broadcast_message,
+    set_broadcast_status,
+)
+from ratelimit import TokenBucket
+
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLED = "cancelled"
+DONE = "done"
+
+STATUS_TITLES = {
+    RUNNING: "идёт",
+    PAUSED: "на паузе",
+    CANCELLED: "отменена",
+    DONE: "завершена",
+}
+
+
+class BroadcastJob:
+    def __init__(self, job_id: int, admin_chat_id: int, text: str, status: str = RUNNING,
+                 last_user_id: int = 0, total: int = 0, sent: int = 0, failed: int = 0,
+                 blocked: int = 0, progress_msg_id: int | None = None):
+        self.id = job_id
+        self.admin_chat_id = admin_chat_id
+        self.text = text
+        self.status = status
+        self.last_user_id = last_user_id
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.progress_msg_id = progress_msg_id
+        # снято — отправители ждут (пауза)
+        self.resume = asyncio.Event()
+        if status == RUNNING:
+            self.resume.set()
+        self.started = time.monotonic()
+        self.started_done = self.done
+        self.reported_at = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.started_done) / elapsed if elapsed > 0 else 0.0
+
+    def progress_text(self) -> str:
+        lines = [
+            f"📢 <b>Рассылка #{self.id}</b>: {STATUS_TITLES.get(self.status, self.status)}",
+            f"Обработано: <b>{self.done}</b> из ~{self.total}",
+            f"Доставлено: {self.sent}, заблокировали бота: {self.blocked}, ошибок: {self.failed}",
+        ]
+        if self.status == RUNNING:
+            lines.append(f"Скорость: {self.rate():.1f} сообщ./с")
+        if self.status in (RUNNING, PAUSED):
+            action = f"/bcpause {self.id}" if self.status == RUNNING else f"/bcresume {self.id}"
+            lines.append(f"{action} · /bccancel {self.id}")
+        return "\n".join(lines)
+
+
+class Broadcaster:
+    def __init__(self, bot: Bot, bucket: TokenBucket, workers: int = 8,
+                 batch_size: int = 200, progress_every: float = 5.0, max_attempts: int = 3,
+                 lease: float = 120.0):
+        self.bot = bot
+        self.bucket = bucket
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_every = progress_every
+        self.max_attempts = max_attempts
+        # аренда должна с запасом покрывать одну пачку (с паузами RetryAfter)
+        self.lease = timedelta(seconds=lease)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.jobs: dict[int, BroadcastJob] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    # ---------- запуск ----------
+
+    async def start(self, admin_chat_id: int, text: str) -> BroadcastJob:
+        total = (await get_stats())["reachable_users"]
+        job_id = await create_broadcast(admin_chat_id, text, total, self.owner, self.lease)
+        job = BroadcastJob(job_id, admin_chat_id, text, total=total)
+        msg = await self.bot.send_message(admin_chat_id, job.progress_text())
+        job.progress_msg_id = msg.message_id
+        await set_broadcast_message(job_id, msg.message_id)
+        self._spawn(job)
+        return job
+
+    async def resume_pending(self) -> int:
+        """Забирает рассылки без живого владельца (прерванные рестартом). Возвращает их число."""
+        resumed = 0
+        for (job_id, admin_chat_id, progress_msg_id, text, status, last_user_id,
+             total, sent, failed, blocked) in await claim_broadcasts(self.owner, self.lease):
+            if job_id in self.jobs:
+                continue
+            job = BroadcastJob(job_id, admin_chat_id, text, status, last_user_id,
+                               total, sent, failed, blocked, progress_msg_id)
+            logging.info(f"Рассылка #{job_id}: продолжаю после users.id {last_user_id}")
+            self._spawn(job)
+            resumed += 1
+        return resumed
+
+    async def run(self):
+        """Фоновый цикл: подхватывает задания процессов, которые упали, не отпустив их."""
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 2)
+            try:
+                await self.resume_pending()
+            except Exception as e:
+                logging.warning(f"Рассылки: не удалось проверить брошенные задания: {e}")
+
+    async def stop(self):
+        """При остановке: прерывает свои задания и отпускает их в БД."""
+        for task in list(self._tasks):
+            task.cancel()
+        for task in list(self._tasks):
+            with suppress(asyncio.CancelledError):
+                await task
+        await release_broadcasts(self.owner)
+
+    def _spawn(self, job: BroadcastJob):
+        self.jobs[job.id] = job
+        task = asyncio.create_task(self._run(job), name=f"broadcast-{job.id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ---------- управление ----------
+
+    # Статус меняется в БД, поэтому команда работает из любого процесса;
+    # если задание ведёт этот процесс, оно реагирует сразу.
+
+    async def pause(self, job_id: int) -> bool:
+        if not await set_broadcast_status(job_id, PAUSED, (RUNNING,)):
+            return False
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.status = PAUSED
+            job.resume.clear()
+            await self._report(job, force=True)
+        return True
+
+    async def unpause(self, job_id: int) -> bool:
+        if not await set_broadcast_status(job_id, RUNNING, (PAUSED,)):
+            return False
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self._apply_status(job, RUNNING)
+            await self._report(job, force=True)
+        return True
+
+    async def cancel(self, job_id: int) -> bool:
+        if not await set_broadcast_status(job_id, CANCELLED, (RUNNING, PAUSED)):
+            return False
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self._apply_status(job, CANCELLED)
+        return True
+
+    @staticmethod
+    def _apply_status(job: BroadcastJob, status: str):
+        if status == RUNNING and job.status != RUNNING:
+            job.started, job.started_done = time.monotonic(), job.done
+        job.status = status
+        if status == PAUSED:
+            job.resume.clear()
+        else:
+            # в том числе отмена: будим отправителей, чтобы они её увидели
+            job.resume.set()
+
+    # ---------- работа ----------
+
+    async def _run(self, job: BroadcastJob):
+        limit = asyncio.Semaphore(self.workers)
+        poll = min(self.progress_every, self.lease.total_seconds() / 4)
+        owned = True
+        try:
+            while True:
+                if not await self._checkpoint(job):
+                    # прогресс теперь показывает новый владелец
+                    logging.warning(f"Рассылка #{job.id}: задание забрал другой процесс")
+                    owned = False
+                    return
+                if job.status == CANCELLED:
+                    break
+                if job.status == PAUSED:
+                    # на паузе продлеваем аренду и ждём /bcresume (свой или из другого процесса)
+                    with suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(job.resume.wait(), timeout=poll)
+                    continue
+                batch = await list_broadcast_recipients(job.last_user_id, self.batch_size)
+                if not batch:
+                    if await set_broadcast_status(job.id, DONE, (RUNNING,)):
+                        job.status = DONE
+                        break
+                    continue
+                await asyncio.gather(*(self._send(job, tg_id, limit) for _, tg_id in batch))
+                if job.status == CANCELLED:
+                    break
+                job.last_user_id = batch[-1][0]
+                await self._report(job)
+            await self._checkpoint(job)
+            logging.info(
+                f"Рассылка #{job.id} {STATUS_TITLES[job.status]}: доставлено {job.sent}, "
+                f"заблокировали {job.blocked}, ошибок {job.failed}"
+            )
+        except Exception:
+            # статус в БД остался running — задание подхватит resume_pending
+            logging.exception(f"Рассылка #{job.id} упала")
+        finally:
+            self.jobs.pop(job.id, None)
+            if owned:
+                await self._report(job, force=True)
+
+    async def _send(self, job: BroadcastJob, tg_id: int, limit: asyncio.Semaphore):
+        async with limit:
+            for _ in range(self.max_attempts):
+                await job.resume.wait()
+                if job.status == CANCELLED:
+                    return
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(tg_id, job.text)
+                    job.sent += 1
+                    return
+                except TelegramRetryAfter as e:
+                    # flood wait касается всего бота — ждут все отправители
+                    self.bucket.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    # заблокировал бота — в следующие рассылки не попадёт
+                    job.blocked += 1
+                    await mark_blocked(tg_id)
+                    return
+                except Exception as e:
+                    logging.debug(f"Рассылка #{job.id}: не отправлено {tg_id}: {e}")
+                    job.failed += 1
+                    return
+            job.failed += 1
+
+    async def _checkpoint(self, job: BroadcastJob) -> bool:
+        """Сохраняет прогресс, продлевает аренду и подхватывает статус из БД.
+
+        False — задание больше не наше (аренда истекла и его забрал другой процесс).
+        """
+        status = await save_broadcast_progress(job.id, self.owner, self.lease, job.last_user_id,
+                                               job.sent, job.failed, job.blocked)
+        if status is None:
+            return False
+        if status != job.status:
+            self._apply_status(job, status)
+            await self._report(job, force=True)
+        return True
+    async def _report(self, job: BroadcastJob, force: bool = False):
+        now = time.monotonic()
+        if not force and now - job.reported_at < self.progress_every:
+            return
+        job.reported_at = now
+        if job.progress_msg_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                job.progress_text(), chat_id=job.admin_chat_id, message_id=job.progress_msg_id,
+            )
+        except Exception as e:
+            # «message is not modified» и т.п. — прогресс покажем в следующий раз
+            logging.debug(f"Рассылка #{job.id}: прогресс не обновлён: {e}")
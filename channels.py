@@ -0,0 +1,157 @@
+"""Реестр обязательных каналов.
+
+Записи REQUIRED_CHANNELS (ID -100..., ссылка или @username) разбираются один
+раз при импорте: chat_id для API, ссылка для кнопки и готовая клавиатура
+«Подписка». Состояние каналов, недоступных боту (не админ, нет доступа к
+списку участников), хранится в channel_health. Такой канал пропускается в
+проверке без запросов к API до планового повторного пробинга, и после
+рестарта админу о нём повторно не пишется.
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from db_async import load_channel_health, save_channel_health
+
+# признаки того, что бот не может смотреть участников канала
+INACCESSIBLE_MARKERS = ("forbidden", "not a member", "chat not found", "member list is inaccessible")
+
+
+def is_inaccessible_error(error: Exception | str) -> bool:
+    low = str(error).lower()
+    return any(marker in low for marker in INACCESSIBLE_MARKERS)
+
+
+def _parse_chat_id(ch: str) -> int | str | None:
+    """chat_id для get_chat_member или None, если по записи проверить нельзя."""
+    # 1) Если это ID канала вида -100...
+    if ch.startswith("-100"):
+        try:
+            return int(ch)
+        except ValueError:
+            logging.warning(f"Некорректный ID канала в REQUIRED_CHANNELS: {ch}")
+            return None
+
+    # 2) Если это ссылка https://t.me/....
+    if ch.startswith("http://") or ch.startswith("https://"):
+        last = ch.split("/")[-1]
+        if not last or last.startswith("+"):
+            logging.warning(f"Нельзя проверить подписку по инвайт-ссылке: {ch}")
+            return None
+        return "@" + last
+
+    # 3) @username
+    if ch.startswith("@"):
+        return ch
+
+    # 4) просто username
+    return "@" + ch
+
+
+def _channel_url(ch: str, private: dict[str, str]) -> str:
+    if ch in private:
+        return private[ch]
+    if ch.startswith("http://") or ch.startswith("https://"):
+        return ch
+    return f"https://t.me/{ch.lstrip('@')}"
+
+
+@dataclass
+class Channel:
+    key: str                          # запись из REQUIRED_CHANNELS
+    chat_id: int | str | None         # для API; None — проверить нельзя
+    url: str
+    # при сбоях API (открытый breaker) считать подписанным
+    fail_open: bool = True
+    # состояние (channel_health)
+    accessible: bool = True
+    failures: int = 0
+    last_error: str | None = None
+    next_probe: datetime | None = None
+    notified: bool = False
+
+    def skipped(self, now: datetime | None = None) -> bool:
+        """Недоступный канал, который до пробинга не проверяем."""
+        if self.accessible:
+            return False
+        now = now or datetime.now(timezone.utc)
+        return self.next_probe is None or now < self.next_probe
+
+
+class ChannelRegistry:
+    def __init__(
+        self,
+        required: list[str],
+        private: dict[str, str],
+        reprobe_minutes: float,
+        fail_closed: list[str] = (),
+    ):
+        self.reprobe = timedelta(minutes=reprobe_minutes)
+        fail_closed = {raw.strip() for raw in fail_closed}
+        self.channels: list[Channel] = []
+        for raw in required:
+            key = raw.strip()
+            self.channels.append(Channel(
+                key=key,
+                chat_id=_parse_chat_id(key),
+                url=_channel_url(key, private),
+                fail_open=key not in fail_closed,
+            ))
+
+        # если хоть один канал проверить нельзя — подписку не подтверждаем (как и раньше)
+        self.has_unverifiable = any(ch.chat_id is None for ch in self.channels)
+
+        buttons = [
+            [InlineKeyboardButton(text=f"📢 Канал {idx}", url=ch.url)]
+            for idx, ch in enumerate(self.channels, start=1)
+        ]
+        buttons.append([InlineKeyboardButton(text="🔄 Проверить подписку", callback_data="check_sub")])
+        self.keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    async def load_health(self) -> int:
+        """Поднимает состояние каналов из БД. Возвращает число недоступных."""
+        by_key = {ch.key: ch for ch in self.channels}
+        for key, accessible, failures, last_error, next_probe, notified in await load_channel_health():
+            ch = by_key.get(key)
+            if ch is None:
+                continue
+            ch.accessible = accessible
+            ch.failures = failures
+            ch.last_error = last_error
+            ch.next_probe = next_probe
+            ch.notified = notified
+        return sum(not ch.accessible for ch in self.channels)
+
+    async def mark_inaccessible(self, ch: Channel, error: str) -> bool:
+        """Канал недоступен до следующего пробинга. True — если об этом ещё не сообщали."""
+        first_report = not ch.notified
+        ch.accessible = False
+        ch.failures += 1
+        ch.last_error = error[:500]
+        ch.next_probe = datetime.now(timezone.utc) + self.reprobe
+        ch.notified = True
+        await self._save(ch)
+        return first_report
+
+    async def mark_accessible(self, ch: Channel):
+        if ch.accessible and not ch.notified:
+            return
+        logging.info(f"Канал {ch.chat_id} снова доступен для проверки подписки")
+        ch.accessible = True
+        ch.failures = 0
+        ch.last_error = None
+        ch.next_probe = None
+        # если канал отвалится снова — снова сообщим
+        ch.notified = False
+        await self._save(ch)
+
+    async def _save(self, ch: Channel):
+        await save_channel_health(ch.key, ch.accessible, ch.failures, ch.last_error, ch.next_probe, ch.notified)
@@ -26,6 +26,11 @@ PRIVATE_CHANNELS = {
     "-1001911861096": "https://t.me/+4qCta2uYUaQ4MjYy"
 }
 
+# Если Telegram API по каналу сбоит (сеть, 5xx), подписку на него по умолчанию
+# не проверяем — пропускаем канал, чтобы не закрыть бот всем пользователям.
+# Каналы из этого списка в такой ситуации считаются НЕ подтверждёнными.
+FAIL_CLOSED_CHANNELS = []
+
 # Сколько грн даём за одного активированного реферала
 REF_BONUS = 5.0
 
@@ -35,6 +40,10 @@ MIN_WITHDRAW = 65.0
 # Админы (сюда свой Telegram ID)
 ADMINS = [1428837532]
 
+# Скрины заданий присылать админам не по одному, а альбомами раз в минуту
+# (до 10 фото, под альбомом — кнопки по каждой заявке)
+TASK_DIGEST = False
+
 # Дата запуска бота (для статистики)
 BOT_START_DATE = "19.03.2026"
 
@@ -1,630 +1,1449 @@
+import logging
 import os
-import psycopg2
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise RuntimeError(
-        "DATABASE_URL не найден. В Railway открой worker → Variables и добавь DATABASE_URL "
-        "(или подключи Postgres к worker через Shared Variables)."
-    )
+import migrations
+from storage import PostgresBackend, SQLiteBackend, sqlite_path
 
-# Railway Postgres даёт DATABASE_URL автоматически (после подключения БД к сервису worker)
+# Railway Postgres даёт DATABASE_URL автоматически (после подключения БД к сервису worker).
+# Для маленького бота на одной машине можно вместо Postgres взять встроенный SQLite:
+# DATABASE_URL=sqlite:///bot.db
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError(
         "DATABASE_URL не найден. В Railway открой worker → Variables и добавь DATABASE_URL "
-        "(или подключи Postgres к worker через Shared Variables)."
+        "(или подключи Postgres к worker через Shared Variables). "
+        "Для локального запуска без сервера: DATABASE_URL=sqlite:///bot.db"
     )
 
+# Настройки пула соединений (можно переопределить через Variables)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))       # сколько ждать свободное соединение, сек
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))     # пересоздавать соединения старше N сек
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))   # SELECT 1, если соединение простаивало N сек
+
+# Сколько секунд get_stats() отдаёт счётчики из памяти, не ходя в БД
+STATS_TTL = float(os.getenv("STATS_TTL", "30"))
+
+
+# ---------- BACKEND ----------
+
+_backend: PostgresBackend | SQLiteBackend | None = None
+_backend_lock = threading.Lock()
+
+
+def _get_backend() -> PostgresBackend | SQLiteBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = sqlite_path(DATABASE_URL)
+                if path is not None:
+                    _backend = SQLiteBackend(path, readers=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT)
+                else:
+                    _backend = PostgresBackend(
+                        DATABASE_URL,
+                        min_size=DB_POOL_MIN,
+                        max_size=DB_POOL_MAX,
+                        timeout=DB_POOL_TIMEOUT,
+                        recycle=DB_POOL_RECYCLE,
+                        ping_idle=DB_POOL_PING_IDLE,
+                    )
+    return _backend
+
+
+def _dialect() -> str:
+    return _get_backend().dialect
+
 
-def _get_conn():
-    return psycopg2.connect(DATABASE_URL)
+@contextmanager
+def _connection(readonly: bool = False):
+    """Соединение бэкенда: commit при успехе, rollback при ошибке.
 
+    readonly=True — только чтение (в SQLite идёт в пул читателей и не ждёт писателя).
+    """
+    with _get_backend().connection(readonly=readonly) as conn:
+        yield conn
 
-def _ensure_column(cur, table: str, column_def: str):
-    """Postgres: безопасно добавляет колонку, если её нет."""
-    cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column_def}")
+
+def pool_stats() -> dict:
+    """Размер пула и время ожидания соединения (для /metrics)."""
+    return _get_backend().stats()
+
+
+def close_pool():
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
 
 
 def init_db():
-    """Создание таблиц + добавление недостающих колонок (без потери данных)."""
-    conn = _get_conn()
-    cur = conn.cursor()
+    """Доводит схему до актуальной версии (см. migrations.py).
+
+    Если база уже актуальна, это один запрос MAX(version).
+    """
+    with _connection() as conn:
+        applied = migrations.migrate(conn, _dialect())
+    if applied:
+        logging.info(f"Применены миграции БД: {applied}")
+    if 5 in applied:
+        # счётчики статистики только что созданы — заполняем их полным пересчётом
+        reconcile_stats()
+    return applied
+
+
+# ---------- SETTINGS ----------
+
+def get_setting(name: str) -> str | None:
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM app_settings WHERE name=%s", (name,))
+        row = cur.fetchone()
+    return row[0] if row else None
 
-    # Таблица пользователей
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            tg_id BIGINT UNIQUE,
-            balance DOUBLE PRECISION DEFAULT 0,
-            referrer_id BIGINT,
-            activated INTEGER DEFAULT 0,
-            phone TEXT,
-            created_at TEXT,
-            last_bonus_at TEXT,
-            banned INTEGER DEFAULT 0
-        )
-        """
-    )
 
-    # Миграции колонок (если база старая)
-    _ensure_column(cur, "users", "referrer_id BIGINT")
-    _ensure_column(cur, "users", "activated INTEGER DEFAULT 0")
-    _ensure_column(cur, "users", "phone TEXT")
-    _ensure_column(cur, "users", "created_at TEXT")
-    _ensure_column(cur, "users", "last_bonus_at TEXT")
-    _ensure_column(cur, "users", "banned INTEGER DEFAULT 0")
-    _ensure_column(cur, "users", "balance DOUBLE PRECISION DEFAULT 0")
-    _ensure_column(cur, "users", "language TEXT DEFAULT 'unset'")
-
-    # Таблица выводов
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS withdrawals (
-            id SERIAL PRIMARY KEY,
-            tg_id BIGINT,
-            method TEXT,
-            details TEXT,
-            amount DOUBLE PRECISION,
-            status TEXT,
-            created_at TEXT
+def set_setting(name: str, value: str):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO app_settings (name, value, updated_ts) VALUES (%s, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_ts = EXCLUDED.updated_ts
+            """,
+            (name, value, datetime.now(timezone.utc)),
         )
-        """
-    )
 
-    # Таблица заявок по заданиям
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS task_submissions (
-            id SERIAL PRIMARY KEY,
-            tg_id BIGINT,
-            task_id TEXT,
-            status TEXT,
-            proof_file_id TEXT,
-            proof_caption TEXT,
-            created_at TEXT
-        )
-        """
-    )
 
-    
-    # Таблица фейковых рефералов
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS fake_refs (
-            tg_id BIGINT PRIMARY KEY,
-            refs INTEGER DEFAULT 0
-        )
-        """
-    )
+# ---------- TIMESTAMPS ----------
 
-    # Таблица кастомной статистики
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS custom_stats (
-            name TEXT PRIMARY KEY,
-            value INTEGER
-        )
-        """
-    )
+# Даты переезжают из TEXT (ISO-строки) в TIMESTAMPTZ-колонки *_ts (миграция 3).
+# Пока backfill_timestamps() не прошёл по всем таблицам, пишем в обе колонки,
+# а читаем новую с откатом на старую.
+#
+# Когда проход завершён, в app_settings ставится отметка _BACKFILL_DONE, и
+# следующие старты таблицы не сканируют. Запись в TEXT при этом остаётся,
+# чтобы откат на прошлую версию бота видел новые даты. Dual-write
+# заканчивается отдельной миграцией, которая удалит TEXT-колонки (вместе с
+# записью в них и откатом чтения в _as_dt), когда отметка стоит на всех
+# базах и откат на версию без *_ts больше не нужен.
+
+_BACKFILL_DONE = "timestamps_backfilled"
 
-    conn.commit()
-    conn.close()
+_TS_COLUMNS = [
+    # (таблица, TEXT-колонка, TIMESTAMPTZ-колонка)
+    ("users", "created_at", "created_ts"),
+    ("users", "last_bonus_at", "last_bonus_ts"),
+    ("withdrawals", "created_at", "created_ts"),
+    ("task_submissions", "created_at", "created_ts"),
+]
+
+
+def _as_dt(ts, text):
+    """Dual-read: значение из TIMESTAMPTZ-колонки, иначе разбираем старую строку."""
+    if ts is not None:
+        return ts
+    if not text:
+        return None
+    try:
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def backfill_timestamps(batch_size: int = 5000) -> int:
+    """Переносит старые TEXT-даты в *_ts пачками по batch_size строк.
+
+    Каждая пачка — отдельная короткая транзакция по диапазону id, поэтому
+    таблица не блокируется надолго, а после рестарта работа просто
+    продолжается (уже заполненные строки не трогаются). Пройдя все таблицы,
+    ставит отметку _BACKFILL_DONE, и дальше функция сразу возвращает 0.
+    Возвращает число обновлённых строк.
+    """
+    if get_setting(_BACKFILL_DONE):
+        return 0
+    total = 0
+    for table, text_col, ts_col in _TS_COLUMNS:
+        last_id = 0
+        while True:
+            with _connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    f"SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s) b",
+                    (last_id, batch_size),
+                )
+                upto = cur.fetchone()[0]
+                if upto is None:
+                    break
+                # строки разбираем в Python: кривая дата (например, 2025-13-01) остаётся
+                # NULL в *_ts и попадает в лог, а не роняет всю пачку на каждом повторе
+                cur.execute(
+                    f"""
+                    SELECT id, {text_col} FROM {table}
+                    WHERE id > %s AND id <= %s AND {ts_col} IS NULL AND {text_col} IS NOT NULL
+                    """,
+                    (last_id, upto),
+                )
+                values = []
+                for row_id, text in cur.fetchall():
+                    dt = _as_dt(None, text)
+                    if dt is None:
+                        if text.strip():
+                            logging.warning(f"backfill_timestamps: {table} id={row_id}: не разобрана дата {text!r}")
+                        continue
+                    values.append((row_id, dt))
+                _update_ts(cur, table, ts_col, values)
+                total += len(values)
+            last_id = upto
+    set_setting(_BACKFILL_DONE, datetime.now(timezone.utc).isoformat())
+    if total:
+        logging.info(f"backfill_timestamps: перенесено {total} дат")
+        # почасовые счётчики строятся по created_ts — пересобираем с перенесёнными датами
+        reconcile_stats()
+    return total
+
+
+def _update_ts(cur, table: str, ts_col: str, values: list[tuple]):
+    """UPDATE пачки (id, datetime) в *_ts.
+
+    В Postgres — одним запросом через VALUES: executemany шёл бы по запросу
+    на строку и держал транзакцию пачки открытой всё это время. В SQLite
+    запросы локальные, executemany дёшев.
+    """
+    if not values:
+        return
+    if _dialect() == "postgres":
+        from psycopg2.extras import execute_values
+
+        execute_values(
+            cur,
+            f"UPDATE {table} AS t SET {ts_col} = v.ts FROM (VALUES %s) AS v(id, ts) WHERE t.id = v.id",
+            values,
+            template="(%s, %s::timestamptz)",
+            page_size=len(values),
+        )
+        return
+    cur.executemany(f"UPDATE {table} SET {ts_col}=%s WHERE id=%s", [(dt, row_id) for row_id, dt in values])
 
 
 # ---------- USERS ----------
 
 def create_user(tg_id, referrer_id=None):
     """Создаёт пользователя, если его ещё нет."""
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return None
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
+        if row:
+            return None
 
-    created_at = datetime.now(timezone.utc).isoformat()
-    cur.execute(
-        """
-        INSERT INTO users (tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (tg_id, 0.0, referrer_id, 0, None, created_at, None, 0),
-    )
-    conn.commit()
-    conn.close()
+        now = datetime.now(timezone.utc)
+        created_at = now.isoformat()
+        cur.execute(
+            """
+            INSERT INTO users (tg_id, balance, referrer_id, activated, phone, created_at, created_ts,
+                               last_bonus_at, banned)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            (tg_id, 0.0, referrer_id, 0, None, created_at, now, None, 0),
+        )
+        _bump(cur, "total_users", 1)
+        cur.execute(
+            """
+            INSERT INTO stats_new_users_hourly (hour, cnt) VALUES (%s, 1)
+            ON CONFLICT (hour) DO UPDATE SET cnt = stats_new_users_hourly.cnt + 1
+            """,
+            (_hour(now),),
+        )
     return created_at
 
 
 def get_user(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned
-        FROM users WHERE tg_id=%s
-        """,
-        (tg_id,),
+    """Вся строка пользователя одним запросом:
+    (tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned, language,
+     blocked_at).
+
+    created_at, last_bonus_at и blocked_at — datetime (или None).
+    """
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT tg_id, balance, referrer_id, activated, phone,
+                   created_ts, created_at, last_bonus_ts, last_bonus_at, banned, language,
+                   blocked_ts
+            FROM users WHERE tg_id=%s
+            """,
+            (tg_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    (tg_id, balance, referrer_id, activated, phone,
+     created_ts, created_at, bonus_ts, bonus_at, banned, language, blocked_ts) = row
+    return (
+        tg_id, balance, referrer_id, activated, phone,
+        _as_dt(created_ts, created_at), _as_dt(bonus_ts, bonus_at), banned, language or "unset",
+        blocked_ts,
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
 
 
 def activate_user(tg_id):
     """Активирует пользователя. Возвращает referrer_id или None."""
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT activated, referrer_id FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return None
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT activated, referrer_id FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        activated, referrer_id = row
+        if activated:
+            return None
+
+        cur.execute("UPDATE users SET activated=1 WHERE tg_id=%s AND activated=0", (tg_id,))
+        if cur.rowcount == 0:
+            # параллельный запрос успел активировать раньше
+            return None
+        _bump(cur, "activated_users", 1)
+    return referrer_id
 
-    activated, referrer_id = row
-    if activated:
-        conn.close()
-        return None
 
-    cur.execute("UPDATE users SET activated=1 WHERE tg_id=%s", (tg_id,))
-    conn.commit()
-    conn.close()
-    return referrer_id
+def add_balance(tg_id, amount, reason: str = "adjust", ref_id=None):
+    """Меняет баланс, пишет запись в журнал и возвращает новый баланс (None, если пользователя нет).
 
+    reason — откуда движение: 'daily_bonus', 'referral', 'task', 'admin', ...;
+    ref_id — связанный объект (id заявки, реферала и т.п.).
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        bal = _credit(cur, tg_id, amount, reason, ref_id)
+    return bal
 
-def add_balance(tg_id, amount):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET balance = balance + %s WHERE tg_id=%s", (amount, tg_id))
-    conn.commit()
-    conn.close()
+
+def _credit(cur, tg_id, amount, reason: str, ref_id=None):
+    """Начисление с записью в журнал в текущей транзакции; None, если пользователя нет."""
+    cur.execute(
+        "UPDATE users SET balance = balance + %s WHERE tg_id=%s RETURNING balance",
+        (amount, tg_id),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    _ledger(cur, tg_id, amount, row[0], reason, ref_id)
+    return float(row[0])
 
 
 def get_balance(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT balance FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT balance FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
     return float(row[0]) if row else 0.0
 
 
 # ---------- PHONE ----------
 
 def set_phone(tg_id, phone):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET phone=%s WHERE tg_id=%s", (phone, tg_id))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT phone FROM users WHERE tg_id=%s FOR UPDATE", (tg_id,))
+        row = cur.fetchone()
+        if not row:
+            return
+        cur.execute("UPDATE users SET phone=%s WHERE tg_id=%s", (phone, tg_id))
+        _bump(cur, "with_phone", int(bool(phone)) - int(bool(row[0])))
 
 
 def get_phone(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT phone FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT phone FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
     return row[0] if row else None
 
 
 def is_phone_used(phone: str, except_id: int | None = None) -> bool:
-    conn = _get_conn()
-    cur = conn.cursor()
-    if except_id is None:
-        cur.execute("SELECT id FROM users WHERE phone=%s", (phone,))
-    else:
-        cur.execute("SELECT id FROM users WHERE phone=%s AND tg_id!=%s", (phone, except_id))
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        if except_id is None:
+            cur.execute("SELECT id FROM users WHERE phone=%s", (phone,))
+        else:
+            cur.execute("SELECT id FROM users WHERE phone=%s AND tg_id!=%s", (phone, except_id))
+        row = cur.fetchone()
     return row is not None
 
 
 # ---------- BONUS ----------
 
-def get_last_bonus_at(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT last_bonus_at FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+def get_last_bonus_at(tg_id) -> datetime | None:
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT last_bonus_ts, last_bonus_at FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
+    return _as_dt(row[0], row[1]) if row else None
 
 
-def set_last_bonus_at(tg_id, value: str):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET last_bonus_at=%s WHERE tg_id=%s", (value, tg_id))
-    conn.commit()
-    conn.close()
+def set_last_bonus_at(tg_id, value: datetime):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE users SET last_bonus_ts=%s, last_bonus_at=%s WHERE tg_id=%s",
+            (value, value.isoformat(), tg_id),
+        )
+
+
+def claim_daily_bonus(tg_id, amount, now: datetime, cooldown: timedelta):
+    """Ежедневный бонус: отметка времени и начисление одной транзакцией.
+
+    Отметка ставится условным UPDATE, только если прошлый бонус старше
+    cooldown, поэтому два параллельных нажатия (или два процесса) не начислят
+    его дважды. Возвращает новый баланс или None, если бонус уже забран.
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET last_bonus_ts=%s, last_bonus_at=%s
+            WHERE tg_id=%s AND (last_bonus_ts IS NULL OR last_bonus_ts <= %s)
+            """,
+            (now, now.isoformat(), tg_id, now - cooldown),
+        )
+        if cur.rowcount != 1:
+            return None
+        bal = _credit(cur, tg_id, amount, "daily_bonus")
+    return bal
 
 
 # ---------- LANGUAGE ----------
 
 def get_language(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT language FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT language FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
     return row[0] if row and row[0] else "unset"
 
 
 def set_language(tg_id, lang: str):
     if lang not in ("ru", "ua", "unset"):
         lang = "ru"
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET language=%s WHERE tg_id=%s", (lang, tg_id))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET language=%s WHERE tg_id=%s", (lang, tg_id))
 
 
 # ---------- BAN ----------
 
 def is_banned(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT banned FROM users WHERE tg_id=%s", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT banned FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
     return bool(row[0]) if row else False
 
 
 def ban_user(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET banned=1 WHERE tg_id=%s", (tg_id,))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET banned=1 WHERE tg_id=%s AND banned=0", (tg_id,))
+        _bump(cur, "banned_users", cur.rowcount)
 
 
 def unban_user(tg_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET banned=0 WHERE tg_id=%s", (tg_id,))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET banned=0 WHERE tg_id=%s AND banned=1", (tg_id,))
+        _bump(cur, "banned_users", -cur.rowcount)
 
 
-# ---------- WITHDRAWALS ----------
+# ---------- BLOCKED ----------
 
-def create_withdrawal(tg_id, method, details, amount):
-    conn = _get_conn()
-    cur = conn.cursor()
-    created_at = datetime.now(timezone.utc).isoformat()
+# Пользователь заблокировал бота или удалил аккаунт: Telegram отвечает Forbidden.
+# Таким не шлём ни рассылки, ни уведомления, пока он снова не нажмёт /start.
+
+def mark_blocked(tg_id):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE users SET blocked_ts=%s WHERE tg_id=%s AND blocked_ts IS NULL",
+            (datetime.now(timezone.utc), tg_id),
+        )
+        _bump(cur, "blocked_users", cur.rowcount)
+
+
+def clear_blocked(tg_id):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET blocked_ts=NULL WHERE tg_id=%s AND blocked_ts IS NOT NULL", (tg_id,))
+        _bump(cur, "blocked_users", -cur.rowcount)
+
+
+def is_reachable(tg_id) -> bool:
+    """Можно ли писать пользователю. Неизвестных (нет в users) не блокируем."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT blocked_ts FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
+    return row is None or row[0] is None
+
+
+# ---------- BALANCE LEDGER ----------
+
+# Каждое изменение users.balance пишется в balance_ledger в той же транзакции.
+# Журнал только дополняется; take_balance_snapshots() периодически фиксирует
+# балансы, чтобы rebuild_balance() не суммировал всю историю.
+
+def _ledger(cur, tg_id, delta, balance_after, reason: str, ref_id=None):
     cur.execute(
         """
-        INSERT INTO withdrawals (tg_id, method, details, amount, status, created_at)
+        INSERT INTO balance_ledger (tg_id, delta, balance_after, reason, ref_id, created_ts)
         VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
         """,
-        (tg_id, method, details, amount, "new", created_at),
+        (tg_id, delta, balance_after, reason, ref_id, datetime.now(timezone.utc)),
     )
-    wid = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
+
+
+def get_ledger(tg_id, limit: int = 10):
+    """Последние движения баланса: (id, delta, balance_after, reason, ref_id, created_ts)."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, delta, balance_after, reason, ref_id, created_ts
+            FROM balance_ledger
+            WHERE tg_id=%s
+            ORDER BY id DESC
+            LIMIT %s
+            """,
+            (tg_id, limit),
+        )
+        rows = cur.fetchall()
+    return rows
+
+
+def take_balance_snapshots() -> int:
+    """Снимок баланса для всех, у кого были движения после прошлого снимка."""
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM balance_snapshots")
+        since = cur.fetchone()[0]
+        cur.execute(
+            """
+            INSERT INTO balance_snapshots (tg_id, ledger_id, balance, taken_ts)
+            SELECT l.tg_id, l.id, l.balance_after, %s
+            FROM balance_ledger l
+            JOIN (
+                SELECT tg_id, MAX(id) AS id
+                FROM balance_ledger
+                WHERE id > %s
+                GROUP BY tg_id
+            ) last ON last.id = l.id
+            ON CONFLICT DO NOTHING
+            """,
+            (datetime.now(timezone.utc), since),
+        )
+        taken = cur.rowcount
+    return taken
+
+
+def rebuild_balance(tg_id) -> float:
+    """Баланс по журналу: последний снимок + движения после него."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT ledger_id, balance FROM balance_snapshots
+            WHERE tg_id=%s
+            ORDER BY ledger_id DESC
+            LIMIT 1
+            """,
+            (tg_id,),
+        )
+        snap = cur.fetchone()
+        since, base = (snap[0], float(snap[1])) if snap else (0, 0.0)
+        cur.execute(
+            "SELECT COALESCE(SUM(delta), 0) FROM balance_ledger WHERE tg_id=%s AND id > %s",
+            (tg_id, since),
+        )
+        tail = float(cur.fetchone()[0])
+    return base + tail
+
+
+def audit_balance(tg_id):
+    """(баланс в users, баланс по журналу) — должны совпадать."""
+    return get_balance(tg_id), rebuild_balance(tg_id)
+
+
+# ---------- WITHDRAWALS ----------
+
+def request_withdrawal(tg_id, method, details, amount):
+    """Списание + заявка на вывод одной транзакцией.
+
+    Баланс уменьшается условным UPDATE, только если денег хватает, поэтому
+    параллельные запросы не уведут его в минус. Возвращает id заявки или None,
+    если средств недостаточно.
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET balance = balance - %s
+            WHERE tg_id=%s AND balance >= %s
+            RETURNING balance
+            """,
+            (amount, tg_id, amount),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        now = datetime.now(timezone.utc)
+        cur.execute(
+            """
+            INSERT INTO withdrawals (tg_id, method, details, amount, status, created_at, created_ts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (tg_id, method, details, amount, "new", now.isoformat(), now),
+        )
+        wid = cur.fetchone()[0]
+        _ledger(cur, tg_id, -amount, row[0], "withdrawal", wid)
+    return wid
+
+
+def create_withdrawal(tg_id, method, details, amount):
+    with _connection() as conn:
+        cur = conn.cursor()
+        now = datetime.now(timezone.utc)
+        cur.execute(
+            """
+            INSERT INTO withdrawals (tg_id, method, details, amount, status, created_at, created_ts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (tg_id, method, details, amount, "new", now.isoformat(), now),
+        )
+        wid = cur.fetchone()[0]
     return wid
 
 
 def get_withdraw(wd_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, tg_id, method, details, amount, status, created_at
-        FROM withdrawals
-        WHERE id=%s
-        """,
-        (wd_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, method, details, amount, status, created_at
+            FROM withdrawals
+            WHERE id=%s
+            """,
+            (wd_id,),
+        )
+        row = cur.fetchone()
     return row
 
 
 def set_withdraw_status(wd_id, status):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE withdrawals SET status=%s WHERE id=%s", (status, wd_id))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE withdrawals SET status=%s WHERE id=%s", (status, wd_id))
 
 
 def list_new_withdrawals(limit: int = 30):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, tg_id, method, details, amount, status, created_at
-        FROM withdrawals
-        WHERE status='new'
-        ORDER BY id ASC
-        LIMIT %s
-        """,
-        (limit,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, method, details, amount, status, created_at
+            FROM withdrawals
+            WHERE status='new'
+            ORDER BY id ASC
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
     return rows
 
 
+def has_approved_withdrawal(tg_id) -> bool:
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM withdrawals WHERE tg_id=%s AND status='approved' LIMIT 1",
+            (tg_id,),
+        )
+        row = cur.fetchone()
+    return row is not None
+
+
+# ---------- CHANNEL MEMBERS ----------
+
+def set_channel_member(chat_id: int, tg_id: int, is_member: bool) -> bool:
+    """Запоминает подписку пользователя на канал (из chat_member или ответа API).
+
+    Только для тех, кто есть в users: подписчики канала, которые бота не
+    запускали, индексу не нужны, а в большом канале их сотни тысяч.
+    Возвращает, записано ли.
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO channel_members (chat_id, tg_id, is_member, updated_ts)
+            SELECT %s, %s, %s, %s
+            WHERE EXISTS (SELECT 1 FROM users WHERE tg_id=%s)
+            ON CONFLICT (chat_id, tg_id) DO UPDATE
+            SET is_member = EXCLUDED.is_member, updated_ts = EXCLUDED.updated_ts
+            """,
+            (chat_id, tg_id, 1 if is_member else 0, datetime.now(timezone.utc), tg_id),
+        )
+        saved = cur.rowcount == 1
+    return saved
+
+
+def prune_channel_members() -> int:
+    """Удаляет из индекса тех, кого нет в users (записи до фильтра в set_channel_member)."""
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM channel_members WHERE tg_id NOT IN (SELECT tg_id FROM users WHERE tg_id IS NOT NULL)")
+        pruned = cur.rowcount
+    return pruned
+
+
+def load_channel_members():
+    """Весь индекс подписок: [(chat_id, tg_id, is_member)] — для зеркала в памяти."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT chat_id, tg_id, is_member FROM channel_members")
+        rows = cur.fetchall()
+    return [(chat_id, tg_id, bool(is_member)) for chat_id, tg_id, is_member in rows]
+
+
+# ---------- CHANNEL HEALTH ----------
+
+def load_channel_health():
+    """[(channel, accessible, failures, last_error, next_probe_ts, notified)]"""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT channel, accessible, failures, last_error, next_probe_ts, notified FROM channel_health"
+        )
+        rows = cur.fetchall()
+    return [
+        (channel, bool(accessible), int(failures), last_error, next_probe, bool(notified))
+        for channel, accessible, failures, last_error, next_probe, notified in rows
+    ]
+
+
+def save_channel_health(channel: str, accessible: bool, failures: int, last_error, next_probe, notified: bool):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO channel_health
+                (channel, accessible, failures, last_error, next_probe_ts, notified, updated_ts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (channel) DO UPDATE
+            SET accessible = EXCLUDED.accessible, failures = EXCLUDED.failures,
+                last_error = EXCLUDED.last_error, next_probe_ts = EXCLUDED.next_probe_ts,
+                notified = EXCLUDED.notified, updated_ts = EXCLUDED.updated_ts
+            """,
+            (channel, 1 if accessible else 0, failures, last_error, next_probe,
+             1 if notified else 0, datetime.now(timezone.utc)),
+        )
+
+
 # ---------- TASK SUBMISSIONS ----------
 
 def create_task_submission(tg_id, task_id, proof_file_id, proof_caption):
-    conn = _get_conn()
-    cur = conn.cursor()
-    created_at = datetime.now(timezone.utc).isoformat()
-    cur.execute(
-        """
-        INSERT INTO task_submissions (tg_id, task_id, status, proof_file_id, proof_caption, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
-        """,
-        (tg_id, task_id, "pending", proof_file_id, proof_caption, created_at),
-    )
-    sid = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        now = datetime.now(timezone.utc)
+        cur.execute(
+            """
+            INSERT INTO task_submissions (tg_id, task_id, status, proof_file_id, proof_caption,
+                                          created_at, created_ts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (tg_id, task_id, "pending", proof_file_id, proof_caption, now.isoformat(), now),
+        )
+        sid = cur.fetchone()[0]
     return sid
 
 
 def get_task_submission(sub_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, tg_id, task_id, status, proof_file_id, proof_caption, created_at
-        FROM task_submissions
-        WHERE id=%s
-        """,
-        (sub_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, task_id, status, proof_file_id, proof_caption, created_at
+            FROM task_submissions
+            WHERE id=%s
+            """,
+            (sub_id,),
+        )
+        row = cur.fetchone()
     return row
 
 
 def set_task_status(sub_id, status):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE task_submissions SET status=%s WHERE id=%s", (status, sub_id))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE task_submissions SET status=%s WHERE id=%s", (status, sub_id))
+
+
+def approve_task_submission(sub_id, amount):
+    """pending → approved и начисление за задание одной транзакцией.
+
+    Статус меняется условным UPDATE, поэтому заявку, которую одновременно
+    приняли два админа (или два процесса), оплачивает только первый.
+    Возвращает новый баланс или None, если заявка уже не pending.
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE task_submissions SET status='approved' WHERE id=%s AND status='pending' RETURNING tg_id",
+            (sub_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        bal = _credit(cur, row[0], amount, "task", sub_id)
+    return bal
+
+
+def reject_task_submission(sub_id) -> bool:
+    """pending → rejected; False, если заявку уже разобрали."""
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE task_submissions SET status='rejected' WHERE id=%s AND status='pending'",
+            (sub_id,),
+        )
+        changed = cur.rowcount == 1
+    return changed
+
+
+def mark_submissions_notified(sub_ids):
+    """Скрины этих заявок дошли до админов."""
+    sub_ids = list(sub_ids)
+    if not sub_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(sub_ids))
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"UPDATE task_submissions SET notified_ts=%s WHERE id IN ({placeholders}) AND notified_ts IS NULL",
+            (datetime.now(timezone.utc), *sub_ids),
+        )
+
+
+def list_unnotified_submissions(limit: int = 500):
+    """Заявки на проверке, скрин которых так и не дошёл до админов (рестарт до отправки).
+
+    [(id, tg_id, task_id, proof_file_id, proof_caption)]
+    """
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, task_id, proof_file_id, proof_caption
+            FROM task_submissions
+            WHERE status='pending' AND notified_ts IS NULL
+            ORDER BY id
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
+    return rows
 
 
 def get_last_task_submission(tg_id, task_id):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, status
-        FROM task_submissions
-        WHERE tg_id=%s AND task_id=%s
-        ORDER BY id DESC
-        LIMIT 1
-        """,
-        (tg_id, task_id),
-    )
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, status
+            FROM task_submissions
+            WHERE tg_id=%s AND task_id=%s
+            ORDER BY id DESC
+            LIMIT 1
+            """,
+            (tg_id, task_id),
+        )
+        row = cur.fetchone()
     return row
 
 
 def has_any_approved_task(tg_id) -> bool:
     """True, если у пользователя есть хотя бы 1 одобренная заявка по заданиям."""
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT 1
-        FROM task_submissions
-        WHERE tg_id=%s AND status='approved'
-        LIMIT 1
-        """,
-        (tg_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT 1
+            FROM task_submissions
+            WHERE tg_id=%s AND status='approved'
+            LIMIT 1
+            """,
+            (tg_id,),
+        )
+        row = cur.fetchone()
     return row is not None
 
 
 
 # ---------- STATS / TOP / USERS ----------
 
-def get_stats():
-    conn = _get_conn()
-    cur = conn.cursor()
+# Счётчики живут в stats_counters и меняются вместе с users (create_user,
+# activate_user, set_phone, ban_user/unban_user). Новые пользователи считаются
+# по часовым корзинам, «за 24 часа» — сумма последних 24 корзин.
 
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0]
+_STAT_COUNTERS = ("total_users", "activated_users", "with_phone", "banned_users", "blocked_users")
 
-    cur.execute("SELECT COUNT(*) FROM users WHERE activated=1")
-    activated_users = cur.fetchone()[0]
+_stats_cache: tuple[float, dict] | None = None
 
-    cur.execute("SELECT COUNT(*) FROM users WHERE phone IS NOT NULL AND phone != ''")
-    with_phone = cur.fetchone()[0]
 
-    cur.execute("SELECT COUNT(*) FROM users WHERE banned=1")
-    banned_users = cur.fetchone()[0]
+def _hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
 
-    point = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
-    cur.execute("""
-        SELECT COUNT(*) FROM users 
-        WHERE created_at::timestamp > %s
-    """, (point,))
-    new_24h = cur.fetchone()[0]
 
-    conn.close()
+def _bump(cur, name: str, delta: int):
+    """Меняет счётчик статистики в текущей транзакции."""
+    if not delta:
+        return
+    cur.execute(
+        """
+        INSERT INTO stats_counters (name, value) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value
+        """,
+        (name, delta),
+    )
+
+
+def get_stats():
+    """Статистика за один запрос; результат кешируется в памяти на STATS_TTL секунд."""
+    global _stats_cache
+    cached = _stats_cache
+    if cached and time.monotonic() - cached[0] < STATS_TTL:
+        return dict(cached[1])
+
+    now = datetime.now(timezone.utc)
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT name, value FROM stats_counters
+            UNION ALL
+            SELECT 'new_24h', COALESCE(SUM(cnt), 0) FROM stats_new_users_hourly WHERE hour > %s
+            UNION ALL
+            SELECT 'submissions_24h', COUNT(*) FROM task_submissions WHERE created_ts > %s
+            """,
+            (_hour(now) - timedelta(hours=24), now - timedelta(hours=24)),
+        )
+        rows = cur.fetchall()
+
+    stats = {name: 0 for name in _STAT_COUNTERS}
+    stats.update({name: int(value) for name, value in rows})
+    # кому реально дойдёт рассылка
+    stats["reachable_users"] = stats["total_users"] - stats["blocked_users"]
+    _stats_cache = (time.monotonic(), stats)
+    return dict(stats)
+
+
+def reconcile_stats():
+    """Полный пересчёт счётчиков по таблице users (после миграции или по /recount).
+
+    Возвращает расхождения {имя: (было, стало)}.
+    """
+    global _stats_cache
+    now = datetime.now(timezone.utc)
+    with _connection() as conn:
+        cur = conn.cursor()
+        if _dialect() == "postgres":
+            # блокируем только пишущие в счётчики транзакции, чтение users не мешает
+            # (в SQLite писатель и так один)
+            cur.execute("LOCK TABLE stats_counters IN EXCLUSIVE MODE")
+        cur.execute("SELECT name, value FROM stats_counters")
+        before = {name: int(value) for name, value in cur.fetchall()}
+
+        cur.execute(
+            """
+            SELECT COUNT(*),
+                   COUNT(*) FILTER (WHERE activated=1),
+                   COUNT(*) FILTER (WHERE phone IS NOT NULL AND phone != ''),
+                   COUNT(*) FILTER (WHERE banned=1),
+                   COUNT(*) FILTER (WHERE blocked_ts IS NOT NULL)
+            FROM users
+            """
+        )
+        after = dict(zip(_STAT_COUNTERS, (int(v) for v in cur.fetchone())))
+
+        for name, value in after.items():
+            cur.execute(
+                """
+                INSERT INTO stats_counters (name, value) VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+                """,
+                (name, value),
+            )
+
+        # часовые корзины за последние 2 суток пересобираем, старше недели — удаляем
+        since = _hour(now) - timedelta(hours=48)
+        cur.execute("DELETE FROM stats_new_users_hourly WHERE hour >= %s OR hour < %s",
+                    (since, now - timedelta(days=7)))
+        cur.execute("SELECT created_ts FROM users WHERE created_ts >= %s", (since,))
+        buckets = Counter(_hour(ts.astimezone(timezone.utc)) for (ts,) in cur.fetchall())
+        cur.executemany(
+            "INSERT INTO stats_new_users_hourly (hour, cnt) VALUES (%s, %s)",
+            sorted(buckets.items()),
+        )
+
+    _stats_cache = None
     return {
-        "total_users": total_users,
-        "activated_users": activated_users,
-        "with_phone": with_phone,
-        "banned_users": banned_users,
-        "new_24h": new_24h,
+        name: (before.get(name, 0), value)
+        for name, value in after.items()
+        if before.get(name, 0) != value
     }
 
 
 def get_top_referrers(limit: int = 10):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT referrer_id, COUNT(*) as cnt
-        FROM users
-        WHERE activated=1 AND referrer_id IS NOT NULL
-        GROUP BY referrer_id
-        ORDER BY cnt DESC
-        LIMIT %s
-        """,
-        (limit,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT referrer_id, COUNT(*) as cnt
+            FROM users
+            WHERE activated=1 AND referrer_id IS NOT NULL
+            GROUP BY referrer_id
+            ORDER BY cnt DESC
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
     return rows
 
 
 def list_users(limit: int = 200):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned
-        FROM users
-        ORDER BY created_at ASC
-        LIMIT %s
-        """,
-        (limit,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned
+            FROM users
+            ORDER BY id ASC
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
     return rows
 
 
 def list_all_users(limit: int = 200):
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT tg_id, balance, phone, activated, created_at, banned
-        FROM users
-        ORDER BY id ASC
-        LIMIT %s
-        """,
-        (limit,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT tg_id, balance, phone, activated, created_at, banned
+            FROM users
+            ORDER BY id ASC
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
     return rows
 
 # ===== USERS PAGINATION (для /users) =====
 
-def count_users():
-    """Количество всех пользователей."""
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
-    conn.close()
-    return int(total)
-
+def list_users_after(after_id: int = 0, limit: int = 50):
+    """Keyset-страница: пользователи с id > after_id.
 
-def list_users_page(offset: int = 0, limit: int = 50):
-    """Страница пользователей (для админ-команды /users)."""
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT tg_id, balance, activated, banned, created_at
-        FROM users
-        ORDER BY id ASC
-        OFFSET %s LIMIT %s
-        """,
-        (offset, limit),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    (id, tg_id, balance, activated, banned, created_at)
+    """
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, balance, activated, banned, created_at
+            FROM users
+            WHERE id > %s
+            ORDER BY id ASC
+            LIMIT %s
+            """,
+            (after_id, limit),
+        )
+        rows = cur.fetchall()
     return rows
 
 
-# ===== FAKE REFS =====
+def list_users_before(before_id: int, limit: int = 50):
+    """Keyset-страница назад: пользователи с id < before_id (по возрастанию id)."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id, balance, activated, banned, created_at
+            FROM users
+            WHERE id < %s
+            ORDER BY id DESC
+            LIMIT %s
+            """,
+            (before_id, limit),
+        )
+        rows = cur.fetchall()
+    return rows[::-1]
 
-def add_fake_refs(tg_id: int, amount: int):
-    conn = _get_conn()
-    cur = conn.cursor()
 
-    cur.execute(
-        """
-        INSERT INTO fake_refs (tg_id, refs)
-        VALUES (%s,%s)
-        ON CONFLICT (tg_id)
-        DO UPDATE SET refs = fake_refs.refs + %s
-        """
-    ,(tg_id,amount,amount))
+def find_user_pk(tg_id):
+    """users.id по Telegram ID (для перехода к пользователю в /users)."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
 
-    conn.commit()
-    conn.close()
+def first_user_pk_since(since: datetime):
+    """id первого пользователя, зарегистрированного не раньше since."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id FROM users
+            WHERE created_ts >= %s
+            ORDER BY created_ts ASC, id ASC
+            LIMIT 1
+            """,
+            (since,),
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
 
 
-def get_fake_refs():
-    conn = _get_conn()
-    cur = conn.cursor()
+# ---------- LEADERBOARD ----------
 
-    try:
+def refresh_leaderboard(limit: int = 10) -> int:
+    """Пересобирает таблицу leaderboard: реальные активированные рефералы + fake_refs.
+
+    Вся агрегация в одном INSERT ... SELECT; читатели топа видят либо старую,
+    либо новую версию целиком. Возвращает число мест.
+    """
+    with _connection() as conn:
+        cur = conn.cursor()
+        if _dialect() == "postgres":
+            # пересборки из разных процессов идут по очереди (иначе два INSERT
+            # столкнутся по rank); чтение топа блокировка не задерживает
+            cur.execute("LOCK TABLE leaderboard IN EXCLUSIVE MODE")
+        cur.execute("DELETE FROM leaderboard")
         cur.execute(
             """
-            SELECT tg_id, refs FROM fake_refs
-            ORDER BY refs DESC
+            INSERT INTO leaderboard (rank, tg_id, refs, refreshed_ts)
+            SELECT ROW_NUMBER() OVER (ORDER BY refs DESC, tg_id), tg_id, refs, %s
+            FROM (
+                SELECT tg_id, SUM(cnt) AS refs
+                FROM (
+                    SELECT referrer_id AS tg_id, COUNT(*) AS cnt
+                    FROM users
+                    WHERE activated=1 AND referrer_id IS NOT NULL
+                    GROUP BY referrer_id
+                    UNION ALL
+                    SELECT tg_id, refs FROM fake_refs
+                ) AS combined
+                GROUP BY tg_id
+                HAVING SUM(cnt) > 0
+                ORDER BY refs DESC, tg_id
+                LIMIT %s
+            ) AS top
+            """,
+            (datetime.now(timezone.utc), limit),
+        )
+        places = cur.rowcount
+    return places
+
+
+def get_leaderboard():
+    """[(rank, tg_id, refs, username)] — username None, если ещё не известен."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT l.rank, l.tg_id, l.refs, u.username
+            FROM leaderboard l
+            LEFT JOIN usernames u ON u.tg_id = l.tg_id
+            ORDER BY l.rank
             """
         )
         rows = cur.fetchall()
-    except Exception:
-        rows = []
-
-    conn.close()
     return rows
 
 
-# ===== CUSTOM STATS =====
+def stale_usernames(tg_ids, max_age: timedelta) -> list[int]:
+    """Из tg_ids — те, чей username не запрашивали дольше max_age (или никогда)."""
+    tg_ids = list(tg_ids)
+    if not tg_ids:
+        return []
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        placeholders = ", ".join(["%s"] * len(tg_ids))
+        cur.execute(
+            f"SELECT tg_id FROM usernames WHERE tg_id IN ({placeholders}) AND resolved_ts > %s",
+            (*tg_ids, datetime.now(timezone.utc) - max_age),
+        )
+        fresh = {row[0] for row in cur.fetchall()}
+    return [tg_id for tg_id in tg_ids if tg_id not in fresh]
 
-def set_custom_stat(name: str, value: int):
-    conn = _get_conn()
-    cur = conn.cursor()
 
-    cur.execute(
-        """
-        INSERT INTO custom_stats (name,value)
-        VALUES (%s,%s)
-        ON CONFLICT (name)
-        DO UPDATE SET value=%s
-        """
-    ,(name,value,value))
+def save_username(tg_id: int, username: str | None):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO usernames (tg_id, username, resolved_ts) VALUES (%s, %s, %s)
+            ON CONFLICT (tg_id) DO UPDATE
+            SET username = EXCLUDED.username, resolved_ts = EXCLUDED.resolved_ts
+            """,
+            (tg_id, username, datetime.now(timezone.utc)),
+        )
 
-    conn.commit()
-    conn.close()
 
+# ---------- FLOW STATE ----------
 
-def get_custom_stat(name: str):
-    conn = _get_conn()
-    cur = conn.cursor()
+def get_flow(tg_id: int, flow: str) -> str | None:
+    """JSON состояния диалога или None, если его нет или он истёк."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT data FROM flow_state WHERE tg_id=%s AND flow=%s AND expires_ts > %s",
+            (tg_id, flow, datetime.now(timezone.utc)),
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
 
-    try:
+
+def set_flow(tg_id: int, flow: str, data: str, ttl: timedelta):
+    with _connection() as conn:
+        cur = conn.cursor()
         cur.execute(
             """
-            SELECT value FROM custom_stats WHERE name=%s
+            INSERT INTO flow_state (tg_id, flow, data, expires_ts) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (tg_id, flow) DO UPDATE
+            SET data = EXCLUDED.data, expires_ts = EXCLUDED.expires_ts
+            """,
+            (tg_id, flow, data, datetime.now(timezone.utc) + ttl),
+        )
+
+
+def clear_flow(tg_id: int, flow: str):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM flow_state WHERE tg_id=%s AND flow=%s", (tg_id, flow))
+
+
+def purge_expired_flows() -> int:
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM flow_state WHERE expires_ts <= %s", (datetime.now(timezone.utc),))
+        purged = cur.rowcount
+    return purged
+
+
+# ---------- BROADCASTS ----------
+
+def list_broadcast_recipients(after_id: int = 0, limit: int = 500):
+    """Следующая пачка получателей рассылки: [(users.id, tg_id)] с id > after_id."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, tg_id FROM users
+            WHERE id > %s AND tg_id IS NOT NULL AND blocked_ts IS NULL
+            ORDER BY id
+            LIMIT %s
+            """,
+            (after_id, limit),
+        )
+        rows = cur.fetchall()
+    return rows
+
+
+def create_broadcast(admin_chat_id: int, text: str, total: int, owner: str, lease: timedelta) -> int:
+    now = datetime.now(timezone.utc)
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
             """
-        ,(name,))
+            INSERT INTO broadcasts (admin_chat_id, text, status, total, owner, lease_ts, created_ts, updated_ts)
+            VALUES (%s, %s, 'running', %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (admin_chat_id, text, total, owner, now + lease, now, now),
+        )
+        job_id = cur.fetchone()[0]
+    return job_id
+
+
+def set_broadcast_message(job_id: int, msg_id: int):
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE broadcasts SET progress_msg_id=%s WHERE id=%s", (msg_id, job_id))
+
 
+def save_broadcast_progress(job_id: int, owner: str, lease: timedelta, last_user_id: int,
+                            sent: int, failed: int, blocked: int) -> str | None:
+    """Контрольная точка владельца: все получатели с users.id <= last_user_id уже обработаны.
+
+    Заодно продлевает аренду и возвращает статус из БД (его меняют /bcpause,
+    /bcresume, /bccancel в любом процессе). None — задание ведёт другой процесс.
+    """
+    now = datetime.now(timezone.utc)
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE broadcasts
+            SET last_user_id=%s, sent=%s, failed=%s, blocked=%s, lease_ts=%s, updated_ts=%s
+            WHERE id=%s AND owner=%s
+            RETURNING status
+            """,
+            (last_user_id, sent, failed, blocked, now + lease, now, job_id, owner),
+        )
         row = cur.fetchone()
-        conn.close()
+    return row[0] if row else None
 
-        if row:
-            return row[0]
-    except Exception:
-        pass
 
-    conn.close()
+def set_broadcast_status(job_id: int, status: str, current: tuple[str, ...]) -> bool:
+    """Меняет статус рассылки, только если сейчас он один из current."""
+    placeholders = ", ".join(["%s"] * len(current))
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"UPDATE broadcasts SET status=%s, updated_ts=%s WHERE id=%s AND status IN ({placeholders})",
+            (status, datetime.now(timezone.utc), job_id, *current),
+        )
+        changed = cur.rowcount == 1
+    return changed
+
+
+def claim_broadcasts(owner: str, lease: timedelta):
+    """Забирает незавершённые рассылки (running/paused), у которых нет живого владельца.
+
+    Свои задания owner тоже получает — с продлённой арендой. Чужие — только
+    если аренда истекла (процесс упал или остановился, не отпустив их).
+    """
+    now = datetime.now(timezone.utc)
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE broadcasts SET owner=%s, lease_ts=%s
+            WHERE status IN ('running', 'paused')
+              AND (owner IS NULL OR owner=%s OR lease_ts IS NULL OR lease_ts < %s)
+            RETURNING id, admin_chat_id, progress_msg_id, text, status, last_user_id,
+                      total, sent, failed, blocked
+            """,
+            (owner, now + lease, owner, now),
+        )
+        rows = cur.fetchall()
+    return sorted(rows)
+
+
+def release_broadcasts(owner: str):
+    """Отпускает задания при остановке: другой процесс (или этот после рестарта) продолжит сразу."""
+    with _connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE broadcasts SET owner=NULL, lease_ts=NULL WHERE owner=%s", (owner,))
+
+
+def list_active_broadcasts() -> list[int]:
+    """id незавершённых рассылок (running/paused) во всех процессах."""
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM broadcasts WHERE status IN ('running', 'paused') ORDER BY id")
+        rows = cur.fetchall()
+    return [row[0] for row in rows]
+
+
+# ===== FAKE REFS =====
+
+def add_fake_refs(tg_id: int, amount: int):
+    with _connection() as conn:
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            INSERT INTO fake_refs (tg_id, refs)
+            VALUES (%s,%s)
+            ON CONFLICT (tg_id)
+            DO UPDATE SET refs = fake_refs.refs + %s
+            """
+        ,(tg_id,amount,amount))
+
+
+def get_fake_refs():
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT tg_id, refs FROM fake_refs
+                ORDER BY refs DESC
+                """
+            )
+            rows = cur.fetchall()
+        except Exception:
+            rows = []
+
+    return rows
+
+
+# ===== CUSTOM STATS =====
+
+def set_custom_stat(name: str, value: int):
+    with _connection() as conn:
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            INSERT INTO custom_stats (name,value)
+            VALUES (%s,%s)
+            ON CONFLICT (name)
+            DO UPDATE SET value=%s
+            """
+        ,(name,value,value))
+
+
+def get_custom_stat(name: str):
+    with _connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                SELECT value FROM custom_stats WHERE name=%s
+                """
+            ,(name,))
+
+            row = cur.fetchone()
+
+            if row:
+                return row[0]
+        except Exception:
+            pass
+
     return None
@@ -0,0 +1,186 @@
+"""Асинхронная обёртка над db.py.
+
+Те же функции с теми же именами, но корутины: запрос уходит в ограниченный
+пул потоков, а event loop aiogram в это время обрабатывает другие апдейты.
+Потоков столько же, сколько соединений в пуле БД, — лишние потоки всё равно
+стояли бы в очереди за соединением.
+
+Чтения обёрнуты в single-flight: если тот же запрос с теми же аргументами уже
+выполняется (двойное нажатие, альбом из фото), второй вызов ждёт его результат
+и в БД не идёт. Присоединиться можно только к чтению, начатому после
+последней завершённой записи этого процесса (см. _async_read), так что
+get_user сразу после add_balance видит новый баланс.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from singleflight import SingleFlight
+
+_executor = ThreadPoolExecutor(max_workers=db.DB_POOL_MAX, thread_name_prefix="db")
+
+
+async def _in_thread(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+# сколько вызовов через _async завершилось; каждый считаем записью
+_writes = 0
+
+
+def _async(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        global _writes
+        try:
+            return await _in_thread(fn, *args, **kwargs)
+        finally:
+            _writes += 1
+    return wrapper
+
+
+_reads = SingleFlight()
+
+
+def _async_read(fn):
+    """Чтение с single-flight.
+
+    В ключе — номер последней завершённой записи: чтение, начатое до неё,
+    могло не увидеть её результат, и вызывающий после записи к нему не
+    присоединится, а запустит своё. Записи других процессов так не
+    отслеживаются — как и при обычном чтении без single-flight.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())), _writes)
+        return await _reads.do(key, _in_thread, fn, *args, **kwargs)
+    return wrapper
+
+
+# ---------- SCHEMA ----------
+init_db = _async(db.init_db)
+backfill_timestamps = _async(db.backfill_timestamps)
+
+# ---------- USERS ----------
+create_user = _async(db.create_user)
+get_user = _async_read(db.get_user)
+activate_user = _async(db.activate_user)
+add_balance = _async(db.add_balance)
+get_balance = _async_read(db.get_balance)
+
+# ---------- PHONE ----------
+set_phone = _async(db.set_phone)
+get_phone = _async_read(db.get_phone)
+is_phone_used = _async_read(db.is_phone_used)
+
+# ---------- BONUS ----------
+get_last_bonus_at = _async_read(db.get_last_bonus_at)
+set_last_bonus_at = _async(db.set_last_bonus_at)
+claim_daily_bonus = _async(db.claim_daily_bonus)
+
+# ---------- LANGUAGE ----------
+get_language = _async_read(db.get_language)
+set_language = _async(db.set_language)
+
+# ---------- BAN ----------
+is_banned = _async_read(db.is_banned)
+ban_user = _async(db.ban_user)
+unban_user = _async(db.unban_user)
+
+# ---------- BLOCKED ----------
+mark_blocked = _async(db.mark_blocked)
+clear_blocked = _async(db.clear_blocked)
+is_reachable = _async_read(db.is_reachable)
+
+# ---------- BALANCE LEDGER ----------
+get_ledger = _async_read(db.get_ledger)
+take_balance_snapshots = _async(db.take_balance_snapshots)
+rebuild_balance = _async_read(db.rebuild_balance)
+audit_balance = _async_read(db.audit_balance)
+
+# ---------- WITHDRAWALS ----------
+request_withdrawal = _async(db.request_withdrawal)
+create_withdrawal = _async(db.create_withdrawal)
+get_withdraw = _async_read(db.get_withdraw)
+set_withdraw_status = _async(db.set_withdraw_status)
+list_new_withdrawals = _async_read(db.list_new_withdrawals)
+has_approved_withdrawal = _async_read(db.has_approved_withdrawal)
+
+# ---------- CHANNEL MEMBERS ----------
+set_channel_member = _async(db.set_channel_member)
+prune_channel_members = _async(db.prune_channel_members)
+load_channel_members = _async_read(db.load_channel_members)
+
+# ---------- CHANNEL HEALTH ----------
+load_channel_health = _async_read(db.load_channel_health)
+save_channel_health = _async(db.save_channel_health)
+
+# ---------- TASK SUBMISSIONS ----------
+create_task_submission = _async(db.create_task_submission)
+get_task_submission = _async_read(db.get_task_submission)
+set_task_status = _async(db.set_task_status)
+approve_task_submission = _async(db.approve_task_submission)
+reject_task_submission = _async(db.reject_task_submission)
+mark_submissions_notified = _async(db.mark_submissions_notified)
+list_unnotified_submissions = _async_read(db.list_unnotified_submissions)
+get_last_task_submission = _async_read(db.get_last_task_submission)
+has_any_approved_task = _async_read(db.has_any_approved_task)
+
+# ---------- STATS / TOP / USERS ----------
+get_stats = _async_read(db.get_stats)
+reconcile_stats = _async(db.reconcile_stats)
+get_top_referrers = _async_read(db.get_top_referrers)
+list_users = _async_read(db.list_users)
+list_all_users = _async_read(db.list_all_users)
+list_users_after = _async_read(db.list_users_after)
+list_users_before = _async_read(db.list_users_before)
+find_user_pk = _async_read(db.find_user_pk)
+first_user_pk_since = _async_read(db.first_user_pk_since)
+
+# ---------- LEADERBOARD ----------
+refresh_leaderboard = _async(db.refresh_leaderboard)
+get_leaderboard = _async_read(db.get_leaderboard)
+stale_usernames = _async_read(db.stale_usernames)
+save_username = _async(db.save_username)
+
+# ---------- FLOW STATE ----------
+# чтение сразу после set_flow увидит новое значение (см. _async_read)
+get_flow = _async_read(db.get_flow)
+set_flow = _async(db.set_flow)
+clear_flow = _async(db.clear_flow)
+purge_expired_flows = _async(db.purge_expired_flows)
+
+# ---------- BROADCASTS ----------
+list_broadcast_recipients = _async_read(db.list_broadcast_recipients)
+create_broadcast = _async(db.create_broadcast)
+set_broadcast_message = _async(db.set_broadcast_message)
+save_broadcast_progress = _async(db.save_broadcast_progress)
+set_broadcast_status = _async(db.set_broadcast_status)
+claim_broadcasts = _async(db.claim_broadcasts)
+release_broadcasts = _async(db.release_broadcasts)
+list_active_broadcasts = _async_read(db.list_active_broadcasts)
+
+# ---------- FAKE REFS / CUSTOM STATS ----------
+add_fake_refs = _async(db.add_fake_refs)
+get_fake_refs = _async_read(db.get_fake_refs)
+set_custom_stat = _async(db.set_custom_stat)
+get_custom_stat = _async_read(db.get_custom_stat)
+
+
+# ---------- POOL ----------
+
+# метрики читаются из памяти — в поток отправлять незачем
+pool_stats = db.pool_stats
+
+
+def singleflight_stats() -> dict:
+    """Сколько чтений ушло в БД и сколько присоединилось к уже идущим."""
+    return _reads.stats()
+
+
+def close_pool():
+    """Останавливает потоки БД и закрывает все соединения пула."""
+    _executor.shutdown(wait=True)
+    db.close_pool()
@@ -0,0 +1,158 @@
+"""Дайджест заявок по заданиям для админов.
+
+Вместо отдельного send_photo на каждую заявку скрины копятся и раз в
+flush_every секунд (или как только набралось max_batch) уходят каждому
+админу альбомом send_media_group, до 10 фото. Альбом не может нести
+кнопки, поэтому следом идёт одно сообщение с парой «✔️ / ❌» на каждую
+заявку. На пике это два запроса к API на десять заявок вместо десяти.
+
+Кнопки дайджеста — те же task_ok / task_no с суффиксом ":d": после
+решения обработчик меняет только строку этой заявки (mark_resolved), а не
+всё сообщение. Одиночная заявка уходит обычным фото с подписью.
+
+Буфер в памяти; при остановке бот отправляет его (flush) до того, как
+опустошит outbox. На случай падения доставка отмечается в БД
+(task_submissions.notified_ts), как только скрин дошёл хотя бы до одного
+админа; при старте бот заново отправляет заявки на проверке без отметки.
+Скрин может прийти админу дважды (дошёл, но упали до отметки), но не
+потеряется.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from html import escape
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+
+from db_async import mark_submissions_notified
+from outbox import HIGH, Outbox
+
+# суффикс callback_data кнопок дайджеста
+DIGEST_SUFFIX = ":d"
+
+
+@dataclass
+class Proof:
+    sub_id: int
+    file_id: str
+    title: str
+    tg_id: int
+    comment: str
+
+
+def _short(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def proof_caption(p: Proof) -> str:
+    """Подпись к скрину отдельной заявки."""
+    return (
+        f"📝 <b>Новая заявка по заданию</b>\n"
+        f"ID заявки: <code>{p.sub_id}</code>\n"
+        f"Задание: <b>{p.title}</b>\n"
+        f"Пользователь: <code>{p.tg_id}</code>\n\n"
+        f"Комментарий юзера:\n{escape(p.comment) or '—'}"
+    )
+
+
+def proof_keyboard(p: Proof) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✔️ Принять", callback_data=f"task_ok:{p.sub_id}"),
+        InlineKeyboardButton(text="❌ Отклонить", callback_data=f"task_no:{p.sub_id}"),
+    ]])
+
+
+def mark_resolved(markup: InlineKeyboardMarkup, sub_id: int, label: str) -> InlineKeyboardMarkup:
+    """Клавиатура дайджеста, где строка заявки заменена меткой решения."""
+    rows = []
+    for row in markup.inline_keyboard:
+        if row and row[0].callback_data == f"task_ok:{sub_id}{DIGEST_SUFFIX}":
+            # повторное нажатие ответит «Уже одобрено/отклонено»
+            row = [InlineKeyboardButton(text=f"{label} #{sub_id}", callback_data=row[0].callback_data)]
+        rows.append(row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+class ProofDigest:
+    def __init__(self, outbox: Outbox, admins: list[int], flush_every: float = 60.0, max_batch: int = 10):
+        self.outbox = outbox
+        self.admins = admins
+        self.flush_every = flush_every
+        # больше 10 фото в одном альбоме Telegram не принимает
+        self.max_batch = min(max_batch, 10)
+        self._pending: list[Proof] = []
+        self._marks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.proofs = 0
+
+    def add(self, proof: Proof):
+        self._pending.append(proof)
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+
+    def flush(self):
+        """Отправляет всё накопленное пачками по max_batch."""
+        while self._pending:
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+            self._send(batch)
+
+    def track(self, sub_ids: list[int], sent: list[asyncio.Future]):
+        """Отметит заявки доставленными, когда хоть одно из sent дойдёт."""
+        task = asyncio.create_task(self._mark_delivered(sub_ids, sent))
+        self._marks.add(task)
+        task.add_done_callback(self._marks.discard)
+
+    @staticmethod
+    async def _mark_delivered(sub_ids: list[int], sent: list[asyncio.Future]):
+        if not any(await asyncio.gather(*sent)):
+            logging.warning(f"Заявки {sub_ids} не дошли ни до одного админа, отправлю после рестарта")
+            return
+        try:
+            await mark_submissions_notified(sub_ids)
+        except Exception as e:
+            logging.warning(f"Не удалось отметить доставку заявок {sub_ids}: {e}")
+
+    def _send(self, batch: list[Proof]):
+        self.batches += 1
+        self.proofs += len(batch)
+        sent = []
+        if len(batch) == 1:
+            # альбом из одного фото не бывает — обычная заявка
+            p = batch[0]
+            for adm in self.admins:
+                sent.append(self.outbox.send_photo(adm, p.file_id, priority=HIGH,
+                                                   caption=proof_caption(p), reply_markup=proof_keyboard(p)))
+            self.track([p.sub_id], sent)
+            return
+
+        lines = [f"📝 <b>Заявки по заданиям: {len(batch)}</b>"]
+        rows = []
+        for p in batch:
+            lines.append(f"#{p.sub_id} — {p.title} — <code>{p.tg_id}</code>")
+            rows.append([
+                InlineKeyboardButton(text=f"✔️ #{p.sub_id}", callback_data=f"task_ok:{p.sub_id}{DIGEST_SUFFIX}"),
+                InlineKeyboardButton(text=f"❌ #{p.sub_id}", callback_data=f"task_no:{p.sub_id}{DIGEST_SUFFIX}"),
+            ])
+        kb = InlineKeyboardMarkup(inline_keyboard=rows)
+        for adm in self.admins:
+            media = [InputMediaPhoto(media=p.file_id, caption=self._album_caption(p)) for p in batch]
+            self.outbox.enqueue("send_media_group", adm, priority=HIGH, media=media)
+            # кнопки идут последними: дошли они — админ может разобрать заявки
+            sent.append(self.outbox.send_message(adm, "\n".join(lines), priority=HIGH, reply_markup=kb))
+        self.track([p.sub_id for p in batch], sent)
+
+    @staticmethod
+    def _album_caption(p: Proof) -> str:
+        return f"#{p.sub_id} · {p.title} · <code>{p.tg_id}</code>\n{escape(_short(p.comment, 200)) or '—'}"
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_every)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Дайджест заявок: не удалось отправить")
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "batches": self.batches, "proofs": self.proofs}
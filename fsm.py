@@ -0,0 +1,81 @@
+"""Состояние диалогов: вывод средств, отправка скрина задания.
+
+Запись — словарь по ключу (tg_id, flow), в нём шаг диалога ("state") и
+собранные данные. Каждая запись живёт ttl с последнего изменения:
+брошенный на середине вывод сам исчезает, и память не растёт.
+
+Бэкенды (FSM_STORAGE):
+
+- memory — TTLCache в процессе: ограничен max_users записями (LRU), но
+  теряется при рестарте и не виден другим процессам;
+- db — таблица flow_state в основной БД (Postgres/SQLite): переживает
+  рестарт, общий для нескольких процессов на одном токене (webhook).
+  Истёкшие записи не читаются и удаляются purge().
+"""
+import json
+import os
+from datetime import timedelta
+
+from cache import TTLCache
+from db_async import clear_flow, get_flow, purge_expired_flows, set_flow
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")                 # memory | db
+FSM_TTL_MINUTES = float(os.getenv("FSM_TTL_MINUTES", "30"))
+FSM_MAX_USERS = int(os.getenv("FSM_MAX_USERS", "100000"))         # только для memory
+
+WITHDRAW = "withdraw"
+TASK = "task"
+
+
+class MemoryFlowStore:
+    def __init__(self, ttl: timedelta, max_users: int):
+        self.ttl = ttl.total_seconds()
+        self._cache = TTLCache(max_users)
+
+    async def get(self, tg_id: int, flow: str) -> dict | None:
+        data = self._cache.get((tg_id, flow))
+        # копия: изменения вступают в силу только через set()
+        return dict(data) if data is not None else None
+
+    async def set(self, tg_id: int, flow: str, data: dict):
+        self._cache.set((tg_id, flow), dict(data), self.ttl)
+
+    async def clear(self, tg_id: int, flow: str):
+        self._cache.invalidate((tg_id, flow))
+
+    async def purge(self) -> int:
+        return self._cache.purge()
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._cache), "evictions": self._cache.evictions}
+
+
+class DbFlowStore:
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+
+    async def get(self, tg_id: int, flow: str) -> dict | None:
+        raw = await get_flow(tg_id, flow)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, tg_id: int, flow: str, data: dict):
+        await set_flow(tg_id, flow, json.dumps(data), self.ttl)
+
+    async def clear(self, tg_id: int, flow: str):
+        await clear_flow(tg_id, flow)
+
+    async def purge(self) -> int:
+        return await purge_expired_flows()
+
+    def stats(self) -> dict:
+        return {"backend": "db"}
+
+
+def create_flow_store(kind: str = FSM_STORAGE, ttl_minutes: float = FSM_TTL_MINUTES,
+                      max_users: int = FSM_MAX_USERS) -> MemoryFlowStore | DbFlowStore:
+    ttl = timedelta(minutes=ttl_minutes)
+    if kind == "memory":
+        return MemoryFlowStore(ttl, max_users)
+    if kind == "db":
+        return DbFlowStore(ttl)
+    raise ValueError(f"Неизвестный FSM_STORAGE: {kind!r} (memory или db)")
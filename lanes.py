@@ -0,0 +1,100 @@
+"""Апдейты одного пользователя — по очереди, разных — параллельно.
+
+aiogram обрабатывает каждый апдейт отдельной задачей, поэтому два быстрых
+нажатия одного пользователя шли одновременно и обходили проверки вида
+«прочитал → изменил».
+
+Полоса упорядочивает апдейты только одного from_user и только в этом
+процессе: два админа, нажавшие «Принять» по одной заявке, или несколько
+процессов webhook в разных полосах. Деньги поэтому защищены в БД условными
+UPDATE (claim_daily_bonus, approve_task_submission), а полосы убирают
+лишние гонки и порядок ответов.
+
+UserLanes — outer-middleware на апдейт: у каждого from_user своя «полоса»
+(Lock), апдейты в ней идут строго по одному в порядке прихода. Общее число
+одновременно обрабатываемых апдейтов ограничено concurrency; слот берётся
+уже после очереди в полосе, так что ждущие своей очереди его не занимают.
+
+Очередь полосы ограничена max_pending: сверх этого апдейт отбрасывается
+(человек столько не нажимает — это флуд). Пустые полосы удаляются.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class _Lane:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0          # ждут + выполняется
+
+
+class UserLanes(BaseMiddleware):
+    def __init__(self, concurrency: int = 64, max_pending: int = 10):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(concurrency)
+        self._lanes: dict[int, _Lane] = {}
+        self.running = 0
+        self.handled = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user is None:
+            async with self._slots:
+                return await handler(event, data)
+
+        lane = self._lanes.get(from_user.id)
+        if lane is None:
+            lane = self._lanes[from_user.id] = _Lane()
+        if lane.depth > self.max_pending:
+            self.dropped += 1
+            logging.debug(f"Полоса {from_user.id}: очередь полна, апдейт отброшен")
+            return None
+
+        lane.depth += 1
+        self.max_depth = max(self.max_depth, lane.depth)
+        queued = time.monotonic()
+        try:
+            async with lane.lock, self._slots:
+                waited = time.monotonic() - queued
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.running += 1
+                try:
+                    return await handler(event, data)
+                finally:
+                    self.running -= 1
+                    self.handled += 1
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0:
+                del self._lanes[from_user.id]
+
+    def stats(self) -> dict:
+        return {
+            "lanes": len(self._lanes),
+            "queued": sum(lane.depth for lane in self._lanes.values()) - self.running,
+            "running": self.running,
+            "concurrency": self.concurrency,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "max_depth": self.max_depth,
+            "wait_avg": self.wait_total / self.handled if self.handled else 0.0,
+            "wait_max": self.wait_max,
+        }
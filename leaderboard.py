@@ -0,0 +1,114 @@
+"""Топ рефералов, собранный заранее.
+
+Сумма реальных активированных рефералов и fake_refs считается в БД
+(db.refresh_leaderboard) и лежит в таблице leaderboard. Username участников
+топа подтягиваются через get_chat в фоне и хранятся в usernames с TTL, так
+что на одного пользователя приходится не больше одного запроса за TTL.
+Текст сообщения рендерится сразу на всех языках, и кнопка «Топ» просто
+отдаёт готовую строку: ни агрегации, ни запросов к API.
+
+Пересборка идёт по расписанию и по событию (mark_dirty: реферал
+засчитан, /addref). События за debounce секунд склеиваются в одну пересборку.
+Пересборки в процессе идут по одной (lock); между процессами их
+разводит блокировка таблицы в refresh_leaderboard.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Callable
+
+from aiogram import Bot
+
+from breaker import CircuitBreaker, CircuitOpen
+from db_async import get_leaderboard, refresh_leaderboard, save_username, stale_usernames
+
+
+class Leaderboard:
+    def __init__(
+        self,
+        bot: Bot,
+        breaker: CircuitBreaker,
+        render: Callable[[str, list], str],
+        langs: tuple[str, ...] = ("ru", "ua"),
+        size: int = 10,
+        refresh_minutes: float = 5,
+        username_ttl_hours: float = 24,
+        debounce: float = 10.0,
+    ):
+        self.bot = bot
+        self.breaker = breaker
+        self.render = render
+        self.langs = langs
+        self.size = size
+        self.refresh_every = refresh_minutes * 60
+        self.username_ttl = timedelta(hours=username_ttl_hours)
+        self.debounce = debounce
+        self._texts: dict[str, str] = {}
+        self._dirty = asyncio.Event()
+        # фоновая пересборка и /top сразу после старта не должны пересобирать одновременно
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+        self.resolved = 0
+
+    def text(self, lang: str) -> str | None:
+        """Готовое сообщение; None — топ ещё ни разу не собран."""
+        return self._texts.get(lang) or self._texts.get(self.langs[0])
+
+    def mark_dirty(self):
+        """Данные топа изменились — пересобрать в ближайшее время."""
+        self._dirty.set()
+
+    async def refresh(self):
+        async with self._lock:
+            await self._refresh()
+
+    async def ensure_ready(self):
+        """Собирает топ, если он ещё ни разу не собран (ждёт уже идущую пересборку)."""
+        async with self._lock:
+            if not self._texts:
+                await self._refresh()
+
+    async def _refresh(self):
+        await refresh_leaderboard(self.size)
+        rows = await get_leaderboard()
+        if await self._resolve_usernames([tg_id for _, tg_id, _, _ in rows]):
+            rows = await get_leaderboard()
+        self._texts = {lang: self.render(lang, rows) for lang in self.langs}
+        self.refreshes += 1
+
+    async def _resolve_usernames(self, tg_ids: list[int]) -> int:
+        """Запрашивает username тех, у кого он устарел. Возвращает число запросов."""
+        done = 0
+        for tg_id in await stale_usernames(tg_ids, self.username_ttl):
+            try:
+                chat = await self.breaker.call(self.bot.get_chat, tg_id)
+            except CircuitOpen:
+                # API сейчас недоступен — остальных спросим при следующей пересборке
+                break
+            except Exception as e:
+                if CircuitBreaker.is_failure(e):
+                    break
+                # чат недоступен: сохраняем пустой username, чтобы не спрашивать до TTL
+                chat = None
+            await save_username(tg_id, chat.username if chat else None)
+            done += 1
+        self.resolved += done
+        return done
+
+    async def run(self):
+        """Фоновый цикл: пересборка по расписанию или по mark_dirty."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"Не удалось обновить топ рефералов: {e}")
+            try:
+                await asyncio.wait_for(self._dirty.wait(), timeout=self.refresh_every)
+                # пачку событий подряд обрабатываем одной пересборкой
+                await asyncio.sleep(self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+
+    def stats(self) -> dict:
+        return {"refreshes": self.refreshes, "resolved": self.resolved, "ready": bool(self._texts)}
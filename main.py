@@ -1,14 +1,21 @@
 import asyncio
+import functools
 import logging
-from datetime import datetime, timezone
+import os
+from html import escape
+from datetime import datetime, timedelta, timezone
 from config import PRIVATE_CHANNELS 
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
     Message,
     CallbackQuery,
+    ChatMemberUpdated,
+    User,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardMarkup,
@@ -25,55 +32,88 @@ from config import (
     BOT_START_DATE,
     TASKS,
     PAYOUTS_CHANNEL_URL,
+    FAIL_CLOSED_CHANNELS,
+    TASK_DIGEST,
 )
-from db import (
+from breaker import BreakerRegistry, CircuitOpen
+from broadcast import Broadcaster
+from cache import TTLCache
+from channels import Channel, ChannelRegistry, is_inaccessible_error
+from digest import DIGEST_SUFFIX, Proof, ProofDigest, mark_resolved, proof_caption, proof_keyboard
+from fsm import TASK, WITHDRAW, create_flow_store
+from lanes import UserLanes
+from leaderboard import Leaderboard
+from membership import MembershipIndex, is_member_status
+from outbox import HIGH, Outbox
+from ratelimit import TokenBucket
+from singleflight import SingleFlight
+from user_context import UserContext, UserContextMiddleware, load_user_context
+from webhook import WEBHOOK_URL, run_webhook
+from db_async import (
     add_fake_refs,
-    get_fake_refs,
     set_custom_stat,
     get_custom_stat,
     init_db,
+    backfill_timestamps,
     create_user,
-    get_user,
     activate_user,
-    get_balance,
     add_balance,
-    get_last_bonus_at,
-    set_last_bonus_at,
-    is_banned,
+    get_ledger,
+    audit_balance,
+    take_balance_snapshots,
+    claim_daily_bonus,
     ban_user,
     unban_user,
-    create_withdrawal,
+    request_withdrawal,
     get_withdraw,
     set_withdraw_status,
     get_stats,
+    reconcile_stats,
     list_all_users,
-    get_top_referrers,
     create_task_submission,
     get_task_submission,
-    set_task_status,
+    approve_task_submission,
+    reject_task_submission,
     get_last_task_submission,
+    list_unnotified_submissions,
     has_any_approved_task,
     list_new_withdrawals,
-    get_language,
+    has_approved_withdrawal,
     set_language,
-    list_users,          # 🔹 ДОБАВИЛ ЭТО
-    count_users,
-    list_users_page,
+    list_users_after,
+    list_users_before,
+    find_user_pk,
+    first_user_pk_since,
+    pool_stats,
+    mark_blocked,
+    clear_blocked,
+    singleflight_stats,
+    list_active_broadcasts,
+    close_pool,
 )
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# свой сервер Bot API (telegram-bot-api) или локальная заглушка; по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-# Простые FSM-состояния (на словарях)
-user_state: dict[int, str] = {}
-pending_withdraw: dict[int, dict] = {}
+# апдейты одного пользователя — строго по очереди, разных — параллельно (см. lanes.py)
+USER_LANES_CONCURRENCY = int(os.getenv("USER_LANES_CONCURRENCY", "64"))   # апдейтов одновременно
+USER_LANE_MAX_PENDING = int(os.getenv("USER_LANE_MAX_PENDING", "10"))     # сверх — флуд, отбрасываем
+lanes = UserLanes(USER_LANES_CONCURRENCY, USER_LANE_MAX_PENDING)
+dp.update.outer_middleware(lanes)
 
-task_state: dict[int, str] = {}
-pending_task: dict[int, dict] = {}
+# строка users грузится один раз на апдейт и передаётся хендлерам как `user`
+dp.message.outer_middleware(UserContextMiddleware())
+dp.callback_query.outer_middleware(UserContextMiddleware())
+
+# шаги вывода и отправки скрина, с TTL (см. fsm.py)
+flows = create_flow_store()
 
 DAILY_BONUS = 0.3
 DAILY_HOURS = 24
@@ -120,6 +160,9 @@ TEXTS = {
         "bad_phone": "❌ Некорректный номер.\nДозволені коди: +380, +7, +375.",
         "phone_used": "❌ Этот номер уже привязан к другому аккаунту.",
         "sub_menu": "📢 Подпишись на каналы и нажми «Проверить подписку» 👇",
+        "top_title": "🏆 <b>Топ рефералов</b>",
+        "top_line": "{i}. {name} — {cnt} реф. — заработал <b>{earned}</b>",
+        "top_empty": "Пока нет активных рефералов.",
     },
     "ua": {
         "choose_lang": "🌍 Обери мову / Choose language:",
@@ -132,22 +175,15 @@ TEXTS = {
         "bad_phone": "❌ Невідповідний номер.\nДозволені коди: +380, +7, +375.",
         "phone_used": "❌ Цей номер уже привʼязаний до іншого акаунта.",
         "sub_menu": "📢 Підпишись на канали та натисни «Перевірити підписку» 👇",
+        "top_title": "🏆 <b>Топ рефералів</b>",
+        "top_line": "{i}. {name} — {cnt} реф. — заробив <b>{earned}</b>",
+        "top_empty": "Поки немає активних рефералів.",
     },
 }
 
 
-def get_lang(user_id: int) -> str:
-    lang = get_language(user_id)
-    if lang not in ("ru", "ua", "unset"):
-        return "unset"
-    return lang
-
-
-def tr(user_id: int, key: str) -> str:
-    lang = get_lang(user_id)
-    if lang == "unset":
-        lang = "ru"
-    return TEXTS.get(lang, TEXTS["ru"]).get(key, key)
+def tr(user: UserContext, key: str) -> str:
+    return TEXTS.get(user.lang, TEXTS["ru"]).get(key, key)
 
 
 def lang_keyboard() -> InlineKeyboardMarkup:
@@ -158,9 +194,88 @@ def lang_keyboard() -> InlineKeyboardMarkup:
         ]]
     )
 
-# каналы без админки: не ломаем бота, но сообщаем админу один раз
-notified_channels: set[str] = set()
+# обязательные каналы разобраны один раз; недоступные боту (нет админки) не
+# ломают бота — пропускаются до повторной проверки раз в CHANNEL_REPROBE_MINUTES,
+# админу о них сообщаем один раз (состояние хранится в channel_health)
+CHANNEL_REPROBE_MINUTES = 30
+channels = ChannelRegistry(
+    REQUIRED_CHANNELS, PRIVATE_CHANNELS, CHANNEL_REPROBE_MINUTES, FAIL_CLOSED_CHANNELS,
+)
+
+# breaker на каждую цель Telegram API (канал, get_chat): при сбоях вызовы не
+# ждут таймаутов, а сразу получают CircuitOpen (см. breaker.py)
+breakers = BreakerRegistry(failure_threshold=3, base_delay=5, max_delay=300)
+
+# сколько get_chat_member одной проверки подписки идут одновременно
+SUB_CHECK_CONCURRENCY = 6
+
+# кэш ответов get_chat_member: (user_id, chat_id) -> подписан ли.
+# «Подписан» держим дольше: отписка заметится не сразу, зато повторные
+# нажатия не ходят в API. «Не подписан» — недолго, чтобы после подписки
+# доступ открылся быстро (а кнопка «Проверить подписку» сбрасывает кэш сразу).
+SUB_CACHE_TTL_POSITIVE = 300
+SUB_CACHE_TTL_NEGATIVE = 20
+SUB_CACHE_SIZE = 50_000
+sub_cache = TTLCache(SUB_CACHE_SIZE)
+
+# массовые отправки: не больше BROADCAST_RATE сообщений в секунду на всех
+# (лимит Telegram ~30/с, остаток — на обычные ответы бота)
+BROADCAST_RATE = 25
+send_bucket = TokenBucket(BROADCAST_RATE)
+broadcaster = Broadcaster(bot, send_bucket, workers=8)
+
+# уведомления пользователям и админам — через очередь с тем же лимитом (см. outbox.py)
+outbox = Outbox(bot, send_bucket, workers=4)
+
+# при TASK_DIGEST скрины заданий уходят админам альбомами (см. digest.py)
+TASK_DIGEST_SECONDS = 60
+task_digest = ProofDigest(outbox, ADMINS, flush_every=TASK_DIGEST_SECONDS)
+
+# одновременные проверки подписки одного пользователя идут одним запросом
+sub_flights = SingleFlight()
 
+# подписки на каналы, где бот админ, — из апдейтов chat_member (см. membership.py)
+membership = MembershipIndex()
+
+
+
+# ============ ИДЕНТИЧНОСТЬ БОТА ============
+
+# username/id бота берём один раз при старте и изредка обновляем в фоне,
+# а не через get_me() на каждое нажатие «Профиль» / «Пригласить друга»
+BOT_IDENTITY_REFRESH_HOURS = 6
+bot_identity: User | None = None
+
+
+async def refresh_bot_identity() -> User:
+    global bot_identity
+    bot_identity = await bot.get_me()
+    return bot_identity
+
+
+async def get_bot_identity() -> User:
+    return bot_identity or await refresh_bot_identity()
+
+
+async def bot_identity_loop():
+    while True:
+        await asyncio.sleep(BOT_IDENTITY_REFRESH_HOURS * 3600)
+        try:
+            await refresh_bot_identity()
+        except Exception as e:
+            # остаёмся со старыми данными до следующей попытки
+            logging.warning(f"Не удалось обновить данные бота: {e}")
+
+
+@functools.lru_cache(maxsize=50_000)
+def _referral_link(bot_username: str, user_id: int) -> str:
+    return f"https://t.me/{bot_username}?start={user_id}"
+
+
+async def referral_link(user_id: int) -> str:
+    # username в ключе кэша: если бота переименуют, ссылки соберутся заново
+    me = await get_bot_identity()
+    return _referral_link(me.username, user_id)
 
 
 # ============ ХЕЛПЕРЫ ============
@@ -169,6 +284,23 @@ def fmt_money(amount: float) -> str:
     return f"{amount:.2f} грн (~{amount / USD_RATE:.2f} $)"
 
 
+# ============ ТОП РЕФЕРАЛОВ ============
+
+def render_leaderboard(lang: str, rows: list) -> str:
+    texts = TEXTS.get(lang, TEXTS["ru"])
+    if not rows:
+        return texts["top_empty"]
+    lines = [texts["top_title"]]
+    for rank, ref_id, cnt, username in rows:
+        name = f"@{username}" if username else f"<code>{ref_id}</code>"
+        lines.append(texts["top_line"].format(i=rank, name=name, cnt=cnt, earned=fmt_money(cnt * REF_BONUS)))
+    return "\n".join(lines)
+
+
+# топ собирается в БД и рендерится заранее (см. leaderboard.py)
+leaderboard = Leaderboard(bot, breakers.get("get_chat"), render_leaderboard, langs=tuple(TEXTS))
+
+
 
 
 def get_bot_days_running() -> int:
@@ -180,32 +312,6 @@ def get_bot_days_running() -> int:
         return 0
 
 
-def _channel_to_url(ch: str) -> str:
-    ch = ch.strip()
-    if ch.startswith("http://") or ch.startswith("https://"):
-        return ch
-    ch = ch.lstrip("@")
-    return f"https://t.me/{ch}"
-
-
-def _normalize_channel_id(ch: str) -> str | None:
-    ch = ch.strip()
-    if ch.startswith("http://") or ch.startswith("https://"):
-        parts = ch.split("/")
-        last = parts[-1]
-        if not last:
-            return None
-        if last.startswith("+"):
-            # через прямой приватный инвайт проверить нельзя
-            return None
-        return "@" + last
-    if ch.startswith("@"):
-        return ch
-    if ch:
-        return "@" + ch
-    return None
-
-
 def get_task_by_id(task_id: str) -> dict | None:
     for t in TASKS:
         if t.get("id") == task_id:
@@ -236,22 +342,8 @@ def main_keyboard(lang: str = 'ru') -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(resize_keyboard=True, keyboard=kb)
 
 def subscribe_keyboard() -> InlineKeyboardMarkup:
-    buttons = []
-
-    for idx, ch in enumerate(REQUIRED_CHANNELS, start=1):
-        ch = ch.strip()
-        if ch in PRIVATE_CHANNELS:
-            url = PRIVATE_CHANNELS[ch]
-        else:
-            url = _channel_to_url(ch)
-
-        buttons.append([InlineKeyboardButton(text=f"📢 Канал {idx}", url=url)])
-
-    buttons.append([InlineKeyboardButton(text="🔄 Проверить подписку", callback_data="check_sub")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-
-
+    # собрана один раз в ChannelRegistry
+    return channels.keyboard
 
 
 # ============ КАНАЛ С ВЫПЛАТАМИ ============
@@ -265,8 +357,8 @@ def payouts_inline_keyboard() -> InlineKeyboardMarkup:
 
 
 @router.message(F.text.in_([BUTTONS["ru"]["payouts"], BUTTONS["ua"]["payouts"]]))
-async def payouts_channel_button(message: Message):
-    if not await ensure_full_access(message):
+async def payouts_channel_button(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
     await message.answer(
@@ -301,64 +393,219 @@ def task_actions_keyboard(task_id: str) -> InlineKeyboardMarkup:
     )
 
 
-# ============ ПРОВЕРКИ ============
+# ============ УВЕДОМЛЕНИЯ ============
 
-async def is_subscribed(user_id: int) -> bool:
-    """Проверка подписки на все обязательные каналы (support username + ID)."""
-    for raw in REQUIRED_CHANNELS:
-        ch = raw.strip()
-
-        # 1) Если это ID канала вида -100...
-        if ch.startswith("-100"):
-            try:
-                chat_id = int(ch)
-            except ValueError:
-                logging.warning(f"Некорректный ID канала в REQUIRED_CHANNELS: {ch}")
-                return False
+def notify_user(tg_id: int, text: str, **kwargs) -> asyncio.Future:
+    """Сообщение пользователю от бота (не в ответ на его апдейт).
+
+    Сообщение встаёт в очередь outbox, обработчик не ждёт отправки.
+    Тем, кто заблокировал бота, не шлём вовсе; Forbidden от Telegram
+    запоминаем в users.blocked_ts. Future даёт True, если сообщение ушло.
+    """
+    return outbox.send_message(tg_id, text, check_reachable=True, **kwargs)
 
-        # 2) Если это ссылка https://t.me/....
-        elif ch.startswith("http://") or ch.startswith("https://"):
-            parts = ch.split("/")
-            last = parts[-1]
-            if not last or last.startswith("+"):
-                logging.warning(f"Нельзя проверить подписку по инвайт-ссылке: {ch}")
-                return False
-            chat_id = "@" + last
 
-        # 3) @username
-        elif ch.startswith("@"):
-            chat_id = ch
+def notify_admins(text: str, photo: str | None = None, **kwargs) -> list[asyncio.Future]:
+    """Сообщение (или фото с подписью) всем админам, вне очереди пользователей.
 
-        # 4) просто username
+    Возвращает future доставки каждому админу (ждать не обязательно).
+    """
+    sent = []
+    for adm in ADMINS:
+        if photo:
+            sent.append(outbox.send_photo(adm, photo, priority=HIGH, caption=text, **kwargs))
         else:
-            chat_id = "@" + ch
+            sent.append(outbox.send_message(adm, text, priority=HIGH, **kwargs))
+    return sent
+
 
+# ============ ПРОВЕРКИ ============
+
+def _notify_channel_unavailable(chat_id):
+    notify_admins(f"⚠️ Канал {chat_id} не проверяется: боту не дали доступ (нужно добавить бота админом/право видеть участников).\nПока что канал временно пропускается в проверке.")
+
+
+async def _channel_unavailable(ch: Channel, error: str):
+    if await channels.mark_inaccessible(ch, error):
+        _notify_channel_unavailable(ch.chat_id)
+
+
+async def _check_channel(ch: Channel, user_id: int, limit: asyncio.Semaphore) -> bool:
+    """Подписан ли пользователь на один канал. Недоступный боту канал пропускаем."""
+    chat_id = ch.chat_id
+    async with limit:
+        breaker = breakers.get(f"channel:{ch.key}")
         try:
-            member = await bot.get_chat_member(chat_id, user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                return False
+            member = await breaker.call(bot.get_chat_member, chat_id, user_id)
+        except CircuitOpen:
+            # API по каналу сейчас сбоит — решает политика канала (FAIL_CLOSED_CHANNELS)
+            return ch.fail_open
         except Exception as e:
             msg = str(e)
             logging.debug(f"Ошибка проверки подписки {user_id} на {chat_id}: {msg}")
 
-            low = msg.lower()
-            if ("forbidden" in low) or ("not a member" in low) or ("chat not found" in low) or ("member list is inaccessible" in low):
-                key = str(chat_id)
-                if key not in notified_channels:
-                    notified_channels.add(key)
-                    for adm in ADMINS:
-                        try:
-                            await bot.send_message(adm, f"⚠️ Канал {chat_id} не проверяется: боту не дали доступ (нужно добавить бота админом/право видеть участников).\nПока что канал временно пропускается в проверке.")
-                        except Exception:
-                            pass
-                continue
+            if is_inaccessible_error(msg):
+                # в фоне: проверку могут отменить, а состояние и уведомление должны дойти
+                spawn(_channel_unavailable(ch, msg))
+                return True
+
+            if breaker.is_failure(e):
+                # сеть/5xx — не повод закрывать доступ всем подряд
+                logging.warning(f"Сбой проверки подписки на {chat_id}: {msg}")
+                return ch.fail_open
+
+            return False
+
+    if not ch.accessible:
+        # подошёл срок перепроверки, и канал снова отвечает
+        spawn(channels.mark_accessible(ch))
+
+    subscribed = is_member_status(member)
+    if membership.is_tracked(chat_id):
+        # дальше индекс будут обновлять апдейты chat_member
+        spawn(membership.set(chat_id, user_id, subscribed))
+    else:
+        ttl = SUB_CACHE_TTL_POSITIVE if subscribed else SUB_CACHE_TTL_NEGATIVE
+        sub_cache.set((user_id, chat_id), subscribed, ttl)
+    return subscribed
+
 
+async def is_subscribed(user_id: int) -> bool:
+    """Проверка подписки на все обязательные каналы (support username + ID).
+
+    Одновременные проверки одного пользователя (двойное нажатие, альбом)
+    выполняются один раз — см. singleflight.py.
+    """
+    return await sub_flights.do(("is_subscribed", user_id), _is_subscribed, user_id)
+
+
+async def _is_subscribed(user_id: int) -> bool:
+    """Сама проверка подписки.
+
+    Каналы проверяются параллельно (не больше SUB_CHECK_CONCURRENCY запросов
+    сразу); на первом «не подписан» остальные проверки отменяются.
+    По каналам, где бот админ, отвечает индекс membership; по остальным —
+    sub_cache. В API идут только каналы, по которым ответа нет.
+    """
+    if channels.has_unverifiable:
+        return False
+
+    missing = []
+    for ch in channels:
+        if ch.skipped():
+            continue
+        chat_id = ch.chat_id
+        if membership.is_tracked(chat_id):
+            cached = membership.get(chat_id, user_id)
+        else:
+            cached = sub_cache.get((user_id, chat_id))
+        if cached is False:
             return False
+        if cached is None:
+            missing.append(ch)
+    if not missing:
+        return True
 
+    limit = asyncio.Semaphore(SUB_CHECK_CONCURRENCY)
+    checks = [asyncio.create_task(_check_channel(ch, user_id, limit)) for ch in missing]
+    try:
+        for done in asyncio.as_completed(checks):
+            if not await done:
+                return False
+    finally:
+        for task in checks:
+            task.cancel()
     return True
 
 
-async def ensure_full_access(message: Message) -> bool:
+def forget_subscription(user_id: int):
+    """Сбрасывает закэшированные ответы по пользователю (кнопка «Проверить подписку»)."""
+    for ch in channels:
+        sub_cache.invalidate((user_id, ch.chat_id))
+    membership.forget_negative(user_id)
+    # уже идущая проверка могла начаться до подписки — не присоединяемся к ней
+    sub_flights.forget(("is_subscribed", user_id))
+
+
+async def probe_channels():
+    """Проверяет права бота в обязательных каналах.
+
+    Где бот админ — канал попадает в индекс подписок (chat_member). Недоступные
+    каналы перепроверяются, только когда подошёл срок next_probe.
+    """
+    me = await get_bot_identity()
+    for ch in channels:
+        if ch.chat_id is None or ch.skipped():
+            continue
+        try:
+            chat = await bot.get_chat(ch.chat_id)
+            bot_member = await bot.get_chat_member(chat.id, me.id)
+        except Exception as e:
+            if is_inaccessible_error(e):
+                await _channel_unavailable(ch, str(e))
+            else:
+                logging.warning(f"Канал {ch.chat_id}: не удалось проверить права бота: {e}")
+            continue
+        membership.chat_ids[ch.chat_id] = chat.id
+        if bot_member.status in ("administrator", "creator"):
+            membership.tracked.add(chat.id)
+        else:
+            membership.tracked.discard(chat.id)
+        await channels.mark_accessible(ch)
+    logging.info(
+        f"Индекс подписок: отслеживается {len(membership.tracked)} из {len(channels)} каналов"
+    )
+
+
+async def channel_probe_loop():
+    while True:
+        try:
+            await probe_channels()
+        except Exception as e:
+            logging.warning(f"Не удалось проверить каналы: {e}")
+        await asyncio.sleep(CHANNEL_REPROBE_MINUTES * 60)
+
+
+@router.my_chat_member()
+async def on_bot_member_update(event: ChatMemberUpdated):
+    """Статус бота изменился.
+
+    В личке: пользователь заблокировал/разблокировал бота.
+    В обязательном канале: бота повысили/понизили — включаем/выключаем индекс по нему.
+    """
+    if event.chat.type == "private":
+        if event.new_chat_member.status == "kicked":
+            await mark_blocked(event.chat.id)
+        elif event.new_chat_member.status == "member":
+            await clear_blocked(event.chat.id)
+        return
+    if event.chat.id not in membership.chat_ids.values():
+        return
+    if event.new_chat_member.status in ("administrator", "creator"):
+        membership.tracked.add(event.chat.id)
+    else:
+        membership.tracked.discard(event.chat.id)
+
+
+@router.chat_member()
+async def on_channel_member_update(event: ChatMemberUpdated):
+    """Вступление/выход пользователя в обязательном канале."""
+    if event.chat.id not in membership.tracked:
+        return
+    tg_id = event.new_chat_member.user.id
+    was_member = is_member_status(event.old_chat_member)
+    now_member = is_member_status(event.new_chat_member)
+    membership.events += 1
+    await membership.set(event.chat.id, tg_id, now_member)
+    sub_cache.invalidate((tg_id, event.chat.id))
+
+    # по правилам отписываться после выплаты нельзя — сообщаем админам сразу
+    if was_member and not now_member and await has_approved_withdrawal(tg_id):
+        title = event.chat.title or event.chat.id
+        notify_admins(f"⚠️ Пользователь <code>{tg_id}</code> получил выплату и отписался от канала {title}.")
+
+
+async def ensure_full_access(message: Message, user: UserContext) -> bool:
     """
     Общая проверка доступа:
     - не забанен
@@ -367,17 +614,15 @@ async def ensure_full_access(message: Message) -> bool:
     Телефон здесь больше НЕ проверяем, 
     он нужен только при первом входе/активации.
     """
-    user_id = message.from_user.id
-
     # Бан
-    if is_banned(user_id):
-        await message.answer(tr(user_id, "banned"))
+    if user.banned:
+        await message.answer(tr(user, "banned"))
         return False
 
     # Подписка
-    if not await is_subscribed(user_id):
+    if not await is_subscribed(user.tg_id):
         await message.answer(
-            tr(user_id, "not_sub"),
+            tr(user, "not_sub"),
             reply_markup=subscribe_keyboard(),
         )
         return False
@@ -387,35 +632,34 @@ async def ensure_full_access(message: Message) -> bool:
 
 
 
-async def try_qualify_referral(user_id: int):
+async def try_qualify_referral(user_id: int, user: UserContext | None = None):
     """Засчитываем реферала ТОЛЬКО если он:
     1) забрал бонус (есть last_bonus_at)
     2) выполнил хотя бы 1 задание (есть approved task_submissions)
 
     Порядок не важен: функцию вызываем и после бонуса, и после approve задания.
+    Если у вызывающего уже есть свежий UserContext этого пользователя — передаём его,
+    иначе строка читается из БД.
     """
-    try:
-        u = get_user(user_id)
-    except Exception:
-        return
+    if user is None:
+        try:
+            user = await load_user_context(user_id)
+        except Exception:
+            return
 
-    if not u:
+    if not user.exists:
         return
 
-    # get_user: (tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned)
-    referrer_id = u[2]
-    activated = int(u[3] or 0)
-
     # Уже засчитан
-    if activated == 1:
+    if user.activated:
         return
 
     # Нет реферера
-    if not referrer_id:
+    if not user.referrer_id:
         return
 
     # 1) бонус должен быть забран
-    if not get_last_bonus_at(user_id):
+    if not user.last_bonus_at:
         return
 
     # 2) хотя бы 1 одобренное задание
@@ -423,7 +667,7 @@ async def try_qualify_referral(user_id: int):
     # Засчитываем реферала: отмечаем activated=1 и начисляем бонус рефереру (один раз)
     # activate_user вернет referrer_id только при первом засчёте.
     try:
-        ref = activate_user(user_id)
+        ref = await activate_user(user_id)
     except Exception:
         return
 
@@ -431,42 +675,37 @@ async def try_qualify_referral(user_id: int):
         return
 
     try:
-        add_balance(ref, REF_BONUS)
+        await add_balance(ref, REF_BONUS, reason="referral", ref_id=user_id)
     except Exception:
         return
+    leaderboard.mark_dirty()
 
     # Уведомление рефереру (не критично)
-    try:
-        await bot.send_message(
-            ref,
-            f"✅ У тебя новый активный реферал: <code>{user_id}</code>\n"
-            f"Начислено: <b>{fmt_money(REF_BONUS)}</b>."
-        )
-    except Exception:
-        pass
+    notify_user(
+        ref,
+        f"✅ У тебя новый активный реферал: <code>{user_id}</code>\n"
+        f"Начислено: <b>{fmt_money(REF_BONUS)}</b>."
+    )
 
 
 
 
-async def try_activate_and_open_menu(user_id: int, chat_id: int):
-    if is_banned(user_id):
-        await bot.send_message(chat_id, tr(user_id, "banned"))
+async def try_activate_and_open_menu(user: UserContext, chat_id: int):
+    if user.banned:
+        await bot.send_message(chat_id, tr(user, "banned"))
         return
 
-    if not await is_subscribed(user_id):
+    if not await is_subscribed(user.tg_id):
         await bot.send_message(
             chat_id,
-            tr(user_id, "not_sub"),
+            tr(user, "not_sub"),
             reply_markup=subscribe_keyboard(),
         )
         return
 
     # ⚠️ Реферал засчитывается НЕ при входе, а только после: бонус + 1 задание.
 
-    lang = get_lang(user_id)
-
-
-    if lang == "unset":
+    if user.language == "unset":
 
 
         await bot.send_message(
@@ -475,7 +714,7 @@ async def try_activate_and_open_menu(user_id: int, chat_id: int):
             chat_id,
 
 
-            tr(user_id, "choose_lang"),
+            tr(user, "choose_lang"),
 
 
             reply_markup=lang_keyboard(),
@@ -494,10 +733,10 @@ async def try_activate_and_open_menu(user_id: int, chat_id: int):
         chat_id,
 
 
-        tr(user_id, "access_open"),
+        tr(user, "access_open"),
 
 
-        reply_markup=main_keyboard(lang),
+        reply_markup=main_keyboard(user.lang),
 
 
     )
@@ -506,12 +745,16 @@ async def try_activate_and_open_menu(user_id: int, chat_id: int):
 # ============ /start, подписка, телефон ============
 
 @router.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, user: UserContext):
     user_id = message.from_user.id
     text_parts = (message.text or "").split()
 
-    if is_banned(user_id):
-        await message.answer(tr(user_id, "banned"))
+    if user.blocked_at is not None:
+        # снова нажал /start — значит, разблокировал бота
+        await clear_blocked(user_id)
+
+    if user.banned:
+        await message.answer(tr(user, "banned"))
         return
 
     ref_id = None
@@ -523,44 +766,44 @@ async def cmd_start(message: Message):
         except Exception:
             pass
 
-    create_user(user_id, ref_id)
+    await create_user(user_id, ref_id)
 
     # ВСЕГДА показываем спонсоров при входе
     await message.answer(
-        tr(user_id, "sub_menu"),
+        tr(user, "sub_menu"),
         reply_markup=subscribe_keyboard(),
     )
 
 
 
 @router.callback_query(F.data == "check_sub")
-async def check_sub_handler(call: CallbackQuery):
-    await try_activate_and_open_menu(call.from_user.id, call.message.chat.id)
+async def check_sub_handler(call: CallbackQuery, user: UserContext):
+    forget_subscription(user.tg_id)
+    await try_activate_and_open_menu(user, call.message.chat.id)
     await call.answer()
 
 # ============ ВЫБОР ЯЗЫКА ============
 
 @router.callback_query(F.data.startswith('lang:'))
-async def set_lang_handler(call: CallbackQuery):
-    user_id = call.from_user.id
+async def set_lang_handler(call: CallbackQuery, user: UserContext):
     lang = call.data.split(':', 1)[1]
     if lang not in ('ru','ua'):
         lang = 'ru'
-    set_language(user_id, lang)
-    await call.message.answer(tr(user_id, 'access_open'), reply_markup=main_keyboard(lang))
+    await set_language(user.tg_id, lang)
+    user.language = lang
+    await call.message.answer(tr(user, 'access_open'), reply_markup=main_keyboard(user.lang))
     await call.answer()
 
 # ============ ПРОФИЛЬ, РЕФЫ, БОНУС, СТАТИСТИКА, ПРАВИЛА, ТОП ============
 
 @router.message(F.text.in_([BUTTONS["ru"]["profile"], BUTTONS["ua"]["profile"]]))
-async def my_profile(message: Message):
-    if not await ensure_full_access(message):
+async def my_profile(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
     user_id = message.from_user.id
-    bal = get_balance(user_id)
-    me = await bot.get_me()
-    ref_link = f"https://t.me/{me.username}?start={user_id}"
+    bal = user.balance
+    ref_link = await referral_link(user_id)
 
     text = (
         "👤 <b>Твой профиль</b>\n\n"
@@ -573,13 +816,12 @@ async def my_profile(message: Message):
 
 
 @router.message(F.text.in_([BUTTONS["ru"]["invite"], BUTTONS["ua"]["invite"]]))
-async def invite_friend(message: Message):
-    if not await ensure_full_access(message):
+async def invite_friend(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
     user_id = message.from_user.id
-    me = await bot.get_me()
-    ref_link = f"https://t.me/{me.username}?start={user_id}"
+    ref_link = await referral_link(user_id)
 
     await message.answer(
         "Отправь эту ссылку друзьям:\n"
@@ -589,34 +831,40 @@ async def invite_friend(message: Message):
 
 
 @router.message(F.text.in_([BUTTONS["ru"]["daily"], BUTTONS["ua"]["daily"]]))
-async def daily_bonus(message: Message):
-    if not await ensure_full_access(message):
+async def daily_bonus(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
+        return
+
+    # строки users ещё нет (не было /start) — начислять некуда
+    if not user.exists:
+        await message.answer("Нажми /start, чтобы начать пользоваться ботом.")
         return
 
     user_id = message.from_user.id
     now = datetime.now(timezone.utc)
-    last = get_last_bonus_at(user_id)
+    last = user.last_bonus_at
 
     if last:
-        try:
-            last_dt = datetime.fromisoformat(last)
-            delta = now - last_dt
-            if delta.total_seconds() < DAILY_HOURS * 3600:
-                remain = DAILY_HOURS * 3600 - delta.total_seconds()
-                h = int(remain // 3600)
-                m = int((remain % 3600) // 60)
-                await message.answer(
-                    f"⏳ Бонус уже забран.\n"
-                    f"Следующий будет доступен через <b>{h} ч {m} мин</b>."
-                )
-                return
-        except Exception:
-            pass
+        delta = now - last
+        if delta.total_seconds() < DAILY_HOURS * 3600:
+            remain = DAILY_HOURS * 3600 - delta.total_seconds()
+            h = int(remain // 3600)
+            m = int((remain % 3600) // 60)
+            await message.answer(
+                f"⏳ Бонус уже забран.\n"
+                f"Следующий будет доступен через <b>{h} ч {m} мин</b>."
+            )
+            return
 
-    add_balance(user_id, DAILY_BONUS)
-    set_last_bonus_at(user_id, now.isoformat())
-    await try_qualify_referral(user_id)
-    bal = get_balance(user_id)
+    # отметка и начисление — одним условным UPDATE: повторное нажатие из другого
+    # процесса или второго окна бонус второй раз не получит
+    bal = await claim_daily_bonus(user_id, DAILY_BONUS, now, timedelta(hours=DAILY_HOURS))
+    if bal is None:
+        await message.answer("⏳ Бонус уже забран.")
+        return
+    user.balance = bal
+    user.last_bonus_at = now
+    await try_qualify_referral(user_id, user)
 
     await message.answer(
         f"🎁 Ты получил бонус <b>{fmt_money(DAILY_BONUS)}</b>!\n"
@@ -628,10 +876,10 @@ async def daily_bonus(message: Message):
 
 async def stats_public(message: Message):
 
-    s = get_stats()
+    s = await get_stats()
     days = get_bot_days_running()
 
-    custom = get_custom_stat("users")
+    custom = await get_custom_stat("users")
 
     total = s["total_users"] + (custom or 0)
 
@@ -645,8 +893,8 @@ async def stats_public(message: Message):
 
 
 @router.message(F.text.in_([BUTTONS["ru"]["rules"], BUTTONS["ua"]["rules"]]))
-async def rules(message: Message):
-    if not await ensure_full_access(message):
+async def rules(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
     text = (
@@ -664,48 +912,30 @@ async def rules(message: Message):
 
 
 @router.message(F.text.in_([BUTTONS["ru"]["top"], BUTTONS["ua"]["top"]]))
-async def top_referrals(message: Message):
-    if not await ensure_full_access(message):
+async def top_referrals(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
-    real = get_top_referrers(limit=100000)
-    fake = get_fake_refs()
-
-    top_dict = {}
-
-    for ref, cnt in real:
-        top_dict[ref] = top_dict.get(ref, 0) + cnt
-
-    for ref, cnt in fake:
-        top_dict[ref] = top_dict.get(ref, 0) + cnt
-
-    top = sorted(top_dict.items(), key=lambda x: x[1], reverse=True)[:10]
-
-    if not top:
-        await message.answer("Пока нет активных рефералов.")
-        return
-
-    lines = ["🏆 <b>Топ рефералов</b>"]
-    for i, (ref_id, cnt) in enumerate(top, start=1):
-        earned = cnt * REF_BONUS
-        name = f"<code>{ref_id}</code>"
+    text = leaderboard.text(user.lang)
+    if text is None:
+        # сразу после старта, пока топ не собран
         try:
-            chat = await bot.get_chat(ref_id)
-            if chat.username:
-                name = f"@{chat.username}"
-        except Exception:
-            pass
-        lines.append(f"{i}. {name} — {cnt} реф. — заработал <b>{fmt_money(earned)}</b>")
-
-    await message.answer("\n".join(lines))
+            await leaderboard.ensure_ready()
+        except Exception as e:
+            logging.warning(f"Не удалось собрать топ рефералов: {e}")
+        text = leaderboard.text(user.lang)
+    if text is None:
+        await message.answer("🏆 Топ ещё собирается, попробуй через минуту.")
+        return
+    await message.answer(text)
 
 
 
 # ============ ЗАДАНИЯ ============
 
 @router.message(F.text.in_([BUTTONS["ru"]["tasks"], BUTTONS["ua"]["tasks"]]))
-async def tasks_menu_handler(message: Message):
-    if not await ensure_full_access(message):
+async def tasks_menu_handler(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
     if not TASKS:
@@ -725,8 +955,8 @@ async def tasks_menu_handler(message: Message):
 
 
 @router.callback_query(F.data == "tasks_back")
-async def tasks_back(call: CallbackQuery):
-    await tasks_menu_handler(call.message)
+async def tasks_back(call: CallbackQuery, user: UserContext):
+    await tasks_menu_handler(call.message, user)
     await call.answer()
 
 
@@ -738,7 +968,7 @@ async def open_task(call: CallbackQuery):
         await call.answer("Задание не найдено", show_alert=True)
         return
 
-    last = get_last_task_submission(call.from_user.id, task_id)
+    last = await get_last_task_submission(call.from_user.id, task_id)
     if last and last[1] in ("pending", "approved"):
         await call.message.answer("❌ Ты уже выполнял это задание или оно на проверке.")
         await call.answer()
@@ -762,84 +992,89 @@ async def task_proof_start(call: CallbackQuery):
         return
 
     user_id = call.from_user.id
-    last = get_last_task_submission(user_id, task_id)
+    last = await get_last_task_submission(user_id, task_id)
     if last and last[1] in ("pending", "approved"):
         await call.message.answer("❌ Ты уже выполнял это задание или оно на проверке.")
         await call.answer()
         return
 
-    task_state[user_id] = "waiting_proof"
-    pending_task[user_id] = {"task_id": task_id}
+    await flows.set(user_id, TASK, {"state": "waiting_proof", "task_id": task_id})
 
     await call.message.answer("📸 Отправь скрин выполнения задания одним фото.")
     await call.answer()
 
 
 @router.message(F.photo)
-async def handle_task_photo(message: Message):
+async def handle_task_photo(message: Message, user: UserContext):
     user_id = message.from_user.id
-    if task_state.get(user_id) != "waiting_proof":
+    data = await flows.get(user_id, TASK)
+    if not data or data.get("state") != "waiting_proof":
         return
 
-    if not await ensure_full_access(message):
-        task_state.pop(user_id, None)
-        pending_task.pop(user_id, None)
+    if not await ensure_full_access(message, user):
+        await flows.clear(user_id, TASK)
         return
 
-    data = pending_task.get(user_id)
-    if not data or "task_id" not in data:
+    if "task_id" not in data:
         await message.answer("Ошибка состояния. Попробуй открыть задание заново.")
-        task_state.pop(user_id, None)
-        pending_task.pop(user_id, None)
+        await flows.clear(user_id, TASK)
         return
 
     task_id = data["task_id"]
     t = get_task_by_id(task_id)
     if not t:
         await message.answer("Задание не найдено. Попробуй позже.")
-        task_state.pop(user_id, None)
-        pending_task.pop(user_id, None)
+        await flows.clear(user_id, TASK)
         return
 
     file_id = message.photo[-1].file_id
     caption = message.caption or ""
 
-    sub_id = create_task_submission(user_id, task_id, file_id, caption)
+    sub_id = await create_task_submission(user_id, task_id, file_id, caption)
 
     await message.answer(
         "✅ Скрин отправлен на проверку.\n"
         "После проверки админом ты получишь уведомление."
     )
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="✔️ Принять", callback_data=f"task_ok:{sub_id}"),
-                InlineKeyboardButton(text="❌ Отклонить", callback_data=f"task_no:{sub_id}"),
-            ]
-        ]
-    )
+    send_proof(Proof(sub_id, file_id, t["title"], user_id, caption))
 
-    for adm in ADMINS:
-        try:
-            await bot.send_photo(
-                adm,
-                photo=file_id,
-                caption=(
-                    f"📝 <b>Новая заявка по заданию</b>\n"
-                    f"ID заявки: <code>{sub_id}</code>\n"
-                    f"Задание: <b>{t['title']}</b>\n"
-                    f"Пользователь: <code>{user_id}</code>\n\n"
-                    f"Комментарий юзера:\n{caption or '—'}"
-                ),
-                reply_markup=kb,
+    await flows.clear(user_id, TASK)
+
+
+def send_proof(proof: Proof):
+    """Скрин заявки админам: в дайджест или сразу; доставка отмечается в БД."""
+    if TASK_DIGEST:
+        task_digest.add(proof)
+        return
+    sent = notify_admins(proof_caption(proof), photo=proof.file_id, reply_markup=proof_keyboard(proof))
+    task_digest.track([proof.sub_id], sent)
+
+
+async def resend_unnotified_proofs() -> int:
+    """После рестарта: заявки, скрин которых не успел дойти до админов."""
+    rows = await list_unnotified_submissions()
+    for sub_id, tg_id, task_id, file_id, caption in rows:
+        t = get_task_by_id(task_id)
+        send_proof(Proof(sub_id, file_id, t["title"] if t else str(task_id), tg_id, caption or ""))
+    return len(rows)
+
+
+async def _mark_task_message(call: CallbackQuery, sub_id: int, mark: str, label: str):
+    """Отмечает решение в сообщении админа: в дайджесте — только строку заявки."""
+    try:
+        if call.data.endswith(DIGEST_SUFFIX):
+            await call.message.edit_reply_markup(
+                reply_markup=mark_resolved(call.message.reply_markup, sub_id, label)
             )
+            return
+        await call.message.edit_caption((call.message.caption or "") + f"\n\n{mark}")
+    except Exception:
+        try:
+            await call.message.edit_text((call.message.text or "") + f"\n\n{mark}")
         except Exception:
             pass
 
-    task_state.pop(user_id, None)
-    pending_task.pop(user_id, None)
-
 
 @router.callback_query(F.data.startswith("task_ok:"))
 async def task_ok(call: CallbackQuery):
@@ -847,8 +1082,8 @@ async def task_ok(call: CallbackQuery):
         await call.answer("Не админ", show_alert=True)
         return
 
-    sub_id = int(call.data.split(":", 1)[1])
-    sub = get_task_submission(sub_id)
+    sub_id = int(call.data.split(":")[1])
+    sub = await get_task_submission(sub_id)
     if not sub:
         await call.answer("Заявка не найдена", show_alert=True)
         return
@@ -869,34 +1104,23 @@ async def task_ok(call: CallbackQuery):
         await call.answer("Задание не найдено", show_alert=True)
         return
 
-    set_task_status(sub_id, "approved")
-    add_balance(tg_id, t["price"])
+    # статус меняется только из pending: второй админ (или процесс) сюда не пройдёт
+    if await approve_task_submission(sub_id, t["price"]) is None:
+        await call.answer("Заявка уже обработана", show_alert=True)
+        return
 
     # Проверяем, не стал ли реферал "активным" (бонус + 1 задание)
     await try_qualify_referral(tg_id)
 
-    try:
-        await call.message.edit_caption(
-            (call.message.caption or "") + "\n\n✔️ <b>Одобрено админом</b>"
-        )
-    except Exception:
-        try:
-            await call.message.edit_text(
-                (call.message.text or "") + "\n\n✔️ <b>Одобрено админом</b>"
-            )
-        except Exception:
-            pass
+    await _mark_task_message(call, sub_id, "✔️ <b>Одобрено админом</b>", "✔️")
 
     await call.answer("Принято")
 
-    try:
-        await bot.send_message(
-            tg_id,
-            f"🎉 Задание <b>{t['title']}</b> одобрено!\n"
-            f"Тебе начислено: <b>{fmt_money(t['price'])}</b>."
-        )
-    except Exception:
-        pass
+    notify_user(
+        tg_id,
+        f"🎉 Задание <b>{t['title']}</b> одобрено!\n"
+        f"Тебе начислено: <b>{fmt_money(t['price'])}</b>."
+    )
 
 
 @router.callback_query(F.data.startswith("task_no:"))
@@ -905,8 +1129,8 @@ async def task_no(call: CallbackQuery):
         await call.answer("Не админ", show_alert=True)
         return
 
-    sub_id = int(call.data.split(":", 1)[1])
-    sub = get_task_submission(sub_id)
+    sub_id = int(call.data.split(":")[1])
+    sub = await get_task_submission(sub_id)
     if not sub:
         await call.answer("Заявка не найдена", show_alert=True)
         return
@@ -921,40 +1145,25 @@ async def task_no(call: CallbackQuery):
         await call.answer("Уже отклонено", show_alert=True)
         return
 
-    set_task_status(sub_id, "rejected")
+    if not await reject_task_submission(sub_id):
+        await call.answer("Заявка уже обработана", show_alert=True)
+        return
 
-    try:
-        await call.message.edit_caption(
-            (call.message.caption or "") + "\n\n❌ <b>Отклонено админом</b>"
-        )
-    except Exception:
-        try:
-            await call.message.edit_text(
-                (call.message.text or "") + "\n\n❌ <b>Отклонено админом</b>"
-            )
-        except Exception:
-            pass
+    await _mark_task_message(call, sub_id, "❌ <b>Отклонено админом</b>", "❌")
 
     await call.answer("Отклонено")
 
-    try:
-        await bot.send_message(
-            tg_id,
-            "❌ Твоя заявка по заданию была отклонена админом."
-        )
-    except Exception:
-        pass
+    notify_user(tg_id, "❌ Твоя заявка по заданию была отклонена админом.")
 
 
 # ============ ВЫВОД СРЕДСТВ ============
 
 @router.message(F.text.in_([BUTTONS["ru"]["withdraw"], BUTTONS["ua"]["withdraw"]]))
-async def start_withdraw(message: Message):
-    if not await ensure_full_access(message):
+async def start_withdraw(message: Message, user: UserContext):
+    if not await ensure_full_access(message, user):
         return
 
-    user_id = message.from_user.id
-    bal = get_balance(user_id)
+    bal = user.balance
 
     if bal < MIN_WITHDRAW:
         await message.answer(
@@ -971,10 +1180,10 @@ async def start_withdraw(message: Message):
 
 
 @router.callback_query(F.data.startswith("wd_method:"))
-async def choose_withdraw_method(call: CallbackQuery):
+async def choose_withdraw_method(call: CallbackQuery, user: UserContext):
     user_id = call.from_user.id
 
-    if is_banned(user_id):
+    if user.banned:
         await call.message.answer("🚫 Ты заблокирован в боте.")
         await call.answer()
         return
@@ -988,7 +1197,7 @@ async def choose_withdraw_method(call: CallbackQuery):
         return
 
     method = call.data.split(":", 1)[1]
-    bal = get_balance(user_id)
+    bal = user.balance
 
     if bal < MIN_WITHDRAW:
         await call.message.answer(
@@ -998,8 +1207,7 @@ async def choose_withdraw_method(call: CallbackQuery):
         await call.answer()
         return
 
-    pending_withdraw[user_id] = {"method": method}
-    user_state[user_id] = "waiting_amount"
+    await flows.set(user_id, WITHDRAW, {"state": "waiting_amount", "method": method})
 
     await call.message.answer(
         f"Баланс: <b>{fmt_money(bal)}</b>\n"
@@ -1008,15 +1216,20 @@ async def choose_withdraw_method(call: CallbackQuery):
     await call.answer()
 
 
-@router.message(lambda m: user_state.get(m.from_user.id) is not None)
-async def withdraw_states(message: Message):
+async def in_withdraw_flow(message: Message) -> dict | bool:
+    """Фильтр: пользователь на шаге вывода; состояние уходит в хендлер как `flow`."""
+    flow = await flows.get(message.from_user.id, WITHDRAW)
+    return {"flow": flow} if flow else False
+
+
+# регистрируется в конце, после команд (см. ниже)
+async def withdraw_states(message: Message, user: UserContext, flow: dict):
     user_id = message.from_user.id
-    state = user_state.get(user_id)
+    state = flow.get("state")
     text = (message.text or "").strip()
 
-    if not await ensure_full_access(message):
-        user_state.pop(user_id, None)
-        pending_withdraw.pop(user_id, None)
+    if not await ensure_full_access(message, user):
+        await flows.clear(user_id, WITHDRAW)
         return
 
     if state == "waiting_amount":
@@ -1026,7 +1239,7 @@ async def withdraw_states(message: Message):
             await message.answer("❌ Введи сумму числом, например 50 или 75.5")
             return
 
-        bal = get_balance(user_id)
+        bal = user.balance
         if amount < MIN_WITHDRAW:
             await message.answer(
                 f"Минимальная сумма для вывода — <b>{fmt_money(MIN_WITHDRAW)}</b>."
@@ -1038,20 +1251,20 @@ async def withdraw_states(message: Message):
             )
             return
 
-        pending_withdraw.setdefault(user_id, {})
-        pending_withdraw[user_id]["amount"] = amount
+        flow["amount"] = amount
 
-        method = pending_withdraw[user_id].get("method")
+        method = flow.get("method")
         if method == "card":
-            user_state[user_id] = "waiting_card"
+            flow["state"] = "waiting_card"
+            await flows.set(user_id, WITHDRAW, flow)
             await message.answer("Введи номер карты (16 цифр, можно с пробелами):")
         elif method == "crypto":
-            user_state[user_id] = "waiting_crypto"
+            flow["state"] = "waiting_crypto"
+            await flows.set(user_id, WITHDRAW, flow)
             await message.answer("Введи данные для вывода на криптобот:")
         else:
             await message.answer("Ошибка состояния. Попробуй начать вывод заново.")
-            user_state.pop(user_id, None)
-            pending_withdraw.pop(user_id, None)
+            await flows.clear(user_id, WITHDRAW)
 
         return
 
@@ -1061,17 +1274,19 @@ async def withdraw_states(message: Message):
             await message.answer("❌ Номер карты должен содержать 16 цифр.")
             return
 
-        data = pending_withdraw.get(user_id)
-        if not data or "amount" not in data:
+        if "amount" not in flow:
             await message.answer("Ошибка состояния. Попробуй снова начать вывод.")
-            user_state.pop(user_id, None)
-            pending_withdraw.pop(user_id, None)
+            await flows.clear(user_id, WITHDRAW)
             return
 
-        amount = data["amount"]
-        add_balance(user_id, -amount)
-
-        wd_id = create_withdrawal(user_id, "card", card_raw, amount)
+        amount = flow["amount"]
+        # списание + заявка одной транзакцией: если баланс уже потрачен, заявки не будет
+        wd_id = await request_withdrawal(user_id, "card", card_raw, amount)
+        if wd_id is None:
+            await message.answer("❌ Недостаточно средств для вывода.")
+            await flows.clear(user_id, WITHDRAW)
+            return
+        user.balance -= amount
 
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -1087,23 +1302,17 @@ async def withdraw_states(message: Message):
             f"ID: <code>{wd_id}</code>"
         )
 
-        for adm in ADMINS:
-            try:
-                await bot.send_message(
-                    adm,
-                    f"💸 <b>Новая заявка на вывод</b>\n"
-                    f"ID: {wd_id}\n"
-                    f"Пользователь: <code>{user_id}</code>\n"
-                    f"Метод: карта\n"
-                    f"Карта: <code>{card_raw}</code>\n"
-                    f"Сумма: <b>{fmt_money(amount)}</b>",
-                    reply_markup=kb,
-                )
-            except Exception:
-                pass
-
-        user_state.pop(user_id, None)
-        pending_withdraw.pop(user_id, None)
+        notify_admins(
+            f"💸 <b>Новая заявка на вывод</b>\n"
+            f"ID: {wd_id}\n"
+            f"Пользователь: <code>{user_id}</code>\n"
+            f"Метод: карта\n"
+            f"Карта: <code>{card_raw}</code>\n"
+            f"Сумма: <b>{fmt_money(amount)}</b>",
+            reply_markup=kb,
+        )
+
+        await flows.clear(user_id, WITHDRAW)
         return
 
     if state == "waiting_crypto":
@@ -1112,17 +1321,19 @@ async def withdraw_states(message: Message):
             await message.answer("❌ Введи корректные данные для криптобота.")
             return
 
-        data = pending_withdraw.get(user_id)
-        if not data or "amount" not in data:
+        if "amount" not in flow:
             await message.answer("Ошибка состояния. Попробуй снова начать вывод.")
-            user_state.pop(user_id, None)
-            pending_withdraw.pop(user_id, None)
+            await flows.clear(user_id, WITHDRAW)
             return
 
-        amount = data["amount"]
-        add_balance(user_id, -amount)
-
-        wd_id = create_withdrawal(user_id, "crypto", details, amount)
+        amount = flow["amount"]
+        # списание + заявка одной транзакцией: если баланс уже потрачен, заявки не будет
+        wd_id = await request_withdrawal(user_id, "crypto", details, amount)
+        if wd_id is None:
+            await message.answer("❌ Недостаточно средств для вывода.")
+            await flows.clear(user_id, WITHDRAW)
+            return
+        user.balance -= amount
 
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -1138,23 +1349,17 @@ async def withdraw_states(message: Message):
             f"ID: <code>{wd_id}</code>"
         )
 
-        for adm in ADMINS:
-            try:
-                await bot.send_message(
-                    adm,
-                    f"💸 <b>Новая заявка на вывод</b>\n"
-                    f"ID: {wd_id}\n"
-                    f"Пользователь: <code>{user_id}</code>\n"
-                    f"Метод: криптобот\n"
-                    f"Реквизиты: <code>{details}</code>\n"
-                    f"Сумма: <b>{fmt_money(amount)}</b>",
-                    reply_markup=kb,
-                )
-            except Exception:
-                pass
+        notify_admins(
+            f"💸 <b>Новая заявка на вывод</b>\n"
+            f"ID: {wd_id}\n"
+            f"Пользователь: <code>{user_id}</code>\n"
+            f"Метод: криптобот\n"
+            f"Реквизиты: <code>{details}</code>\n"
+            f"Сумма: <b>{fmt_money(amount)}</b>",
+            reply_markup=kb,
+        )
 
-        user_state.pop(user_id, None)
-        pending_withdraw.pop(user_id, None)
+        await flows.clear(user_id, WITHDRAW)
         return
 
 
@@ -1165,12 +1370,12 @@ async def wd_ok(call: CallbackQuery):
         return
 
     wd_id = int(call.data.split(":", 1)[1])
-    wd = get_withdraw(wd_id)
+    wd = await get_withdraw(wd_id)
     if not wd:
         await call.answer("❌ Заявка не найдена", show_alert=True)
         return
 
-    set_withdraw_status(wd_id, "approved")
+    await set_withdraw_status(wd_id, "approved")
 
     tg_id = wd[1]
     amount = wd[4]
@@ -1181,13 +1386,10 @@ async def wd_ok(call: CallbackQuery):
     except Exception:
         pass
 
-    try:
-        await bot.send_message(
-            tg_id,
-            f"🎉 Твоя выплата <b>{fmt_money(amount)}</b> одобрена и скоро будет отправлена!"
-        )
-    except Exception:
-        pass
+    notify_user(
+        tg_id,
+        f"🎉 Твоя выплата <b>{fmt_money(amount)}</b> одобрена и скоро будет отправлена!"
+    )
 
 
 @router.callback_query(F.data.startswith("wd_no:"))
@@ -1197,7 +1399,7 @@ async def wd_no(call: CallbackQuery):
         return
 
     wd_id = int(call.data.split(":", 1)[1])
-    wd = get_withdraw(wd_id)
+    wd = await get_withdraw(wd_id)
     if not wd:
         await call.answer("❌ Заявка не найдена", show_alert=True)
         return
@@ -1205,7 +1407,7 @@ async def wd_no(call: CallbackQuery):
     tg_id = wd[1]
     amount = wd[4]
 
-    set_withdraw_status(wd_id, "rejected")
+    await set_withdraw_status(wd_id, "rejected")
 
     await call.answer("❌ Выплата отклонена")
     try:
@@ -1213,14 +1415,11 @@ async def wd_no(call: CallbackQuery):
     except Exception:
         pass
 
-    try:
-        await bot.send_message(
-            tg_id,
-            "❌ Твоя заявка на вывод была отклонена администрацией.\n"
-            "<i>Средства не возвращаются.</i>"
-        )
-    except Exception:
-        pass
+    notify_user(
+        tg_id,
+        "❌ Твоя заявка на вывод была отклонена администрацией.\n"
+        "<i>Средства не возвращаются.</i>"
+    )
 
 
 # ============ АДМИН-КОМАНДЫ ============
@@ -1231,7 +1430,7 @@ async def admin_panel(message: Message):
     if not user_is_admin(message.from_user.id):
         return
 
-    s = get_stats()
+    s = await get_stats()
     days = (datetime.now(timezone.utc).date() - datetime.strptime(BOT_START_DATE, "%d.%m.%Y").date()).days
 
     text = (
@@ -1240,67 +1439,133 @@ async def admin_panel(message: Message):
         f"✅ Активировано: <b>{s['activated_users']}</b>\n"
         f"📱 С привязанным телефоном: <b>{s['with_phone']}</b>\n"
         f"⛔ Забанено: <b>{s['banned_users']}</b>\n"
+        f"📭 Заблокировали бота: <b>{s['blocked_users']}</b> (доступно для рассылки: <b>{s['reachable_users']}</b>)\n"
         f"🆕 Новых за 24 часа: <b>{s['new_24h']}</b>\n"
+        f"📝 Заявок по заданиям за 24 часа: <b>{s['submissions_24h']}</b>\n"
         f"📅 Бот работает: <b>{days} дн.</b> (с {BOT_START_DATE})\n\n"
         "Команды:\n"
-        "/users — список пользователей\n"
+        "/users — список пользователей (/users id …, /users date …)\n"
         "/ban id — бан\n"
         "/unban id — разбан\n"
         "/addbal id сумма — добавить баланс\n"
         "/subbal id сумма — снять баланс\n"
         "/msg id текст — написать пользователю\n"
-        "/all текст — рассылка всем\n"
+        "/all текст — рассылка всем (в фоне)\n"
+        "/bcpause id, /bcresume id, /bccancel id — управление рассылкой\n"
         "/pending — новые заявки на вывод\n"
+        "/metrics — метрики (пул БД, кэш подписок)\n"
+        "/recount — пересчитать статистику\n"
+        "/audit id — сверить баланс с журналом\n"
     )
     await message.answer(text)
 
 
 @router.message(Command("users"))
 async def admin_users(message: Message):
-    """Постраничный список пользователей (по 50)"""
+    """
+    Список пользователей по 50:
+    /users — с начала
+    /users id 123456789 — с указанного пользователя
+    /users date 19.03.2026 — с зарегистрированных в эту дату
+    """
     if not user_is_admin(message.from_user.id):
         return
 
-    page = 0
-    text, kb = _format_users_page(page)
+    parts = (message.text or "").split()
+    after_id = 0
+
+    if len(parts) >= 3 and parts[1] == "id":
+        try:
+            tg_id = int(parts[2])
+        except ValueError:
+            await message.answer("ID должен быть числом.")
+            return
+        pk = await find_user_pk(tg_id)
+        if pk is None:
+            await message.answer(f"Пользователь <code>{tg_id}</code> не найден.")
+            return
+        after_id = pk - 1
+
+    elif len(parts) >= 3 and parts[1] == "date":
+        since = _parse_date(parts[2])
+        if since is None:
+            await message.answer("Дата в формате <code>19.03.2026</code> или <code>2026-03-19</code>.")
+            return
+        pk = await first_user_pk_since(since)
+        if pk is None:
+            await message.answer("После этой даты пользователей нет.")
+            return
+        after_id = pk - 1
+
+    elif len(parts) > 1:
+        await message.answer(
+            "Использование:\n"
+            "<code>/users</code>\n"
+            "<code>/users id 123456789</code>\n"
+            "<code>/users date 19.03.2026</code>"
+        )
+        return
+
+    text, kb = await _format_users_page("next", after_id)
     await message.answer(text, reply_markup=kb)
 
 
 USERS_PER_PAGE = 50
 
 
-def _users_keyboard(page: int, total: int) -> InlineKeyboardMarkup:
-    max_page = max(0, (total - 1) // USERS_PER_PAGE)
+def _parse_date(value: str) -> datetime | None:
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
 
+
+def _users_keyboard(first_id: int | None, last_id: int | None,
+                    has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
     row = []
-    if page > 0:
-        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"users_page:{page-1}"))
-    row.append(InlineKeyboardButton(text=f"{page+1}/{max_page+1}", callback_data="users_page:noop"))
-    if page < max_page:
-        row.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"users_page:{page+1}"))
+    if has_prev and first_id is not None:
+        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"users_page:prev:{first_id}"))
+    row.append(InlineKeyboardButton(text="⏮ В начало", callback_data="users_page:next:0"))
+    if has_next and last_id is not None:
+        row.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"users_page:next:{last_id}"))
 
     return InlineKeyboardMarkup(inline_keyboard=[row])
 
 
-def _format_users_page(page: int):
-    total = count_users()
-    max_page = max(0, (total - 1) // USERS_PER_PAGE)
-    page = max(0, min(page, max_page))
+async def _format_users_page(direction: str, cursor: int):
+    """Страница по курсору id: next — после cursor, prev — перед cursor.
 
-    offset = page * USERS_PER_PAGE
-    rows = list_users_page(offset=offset, limit=USERS_PER_PAGE)
+    Любая страница — это WHERE id > / < cursor ... LIMIT, поэтому далёкие
+    страницы стоят столько же, сколько первая. Общее число берём из счётчиков
+    статистики, а не из COUNT(*).
+    """
+    if direction == "prev":
+        rows = await list_users_before(cursor, limit=USERS_PER_PAGE + 1)
+        has_prev = len(rows) > USERS_PER_PAGE
+        rows = rows[-USERS_PER_PAGE:]
+        has_next = True
+    else:
+        rows = await list_users_after(cursor, limit=USERS_PER_PAGE + 1)
+        has_next = len(rows) > USERS_PER_PAGE
+        rows = rows[:USERS_PER_PAGE]
+        has_prev = cursor > 0
+
+    total = (await get_stats())["total_users"]
 
-    text = f"👥 <b>Пользователи:</b> {total}\n📄 <b>Страница:</b> {page+1}/{max_page+1}\n\n"
     if not rows:
-        text += "Пользователей пока нет."
-        return text, _users_keyboard(page, total)
+        text = f"👥 <b>Пользователи:</b> ~{total}\n\nПользователей пока нет."
+        return text, _users_keyboard(None, None, False, False)
 
-    for tg_id, balance, activated, banned, created_at in rows:
+    first_id, last_id = rows[0][0], rows[-1][0]
+    text = f"👥 <b>Пользователи:</b> ~{total}\n📄 <b>Записи:</b> #{first_id}–#{last_id}\n\n"
+    for _, tg_id, balance, activated, banned, created_at in rows:
         a = "✅" if int(activated) == 1 else "❌"
         b = "🚫" if int(banned) == 1 else "—"
         text += f"ID: <code>{tg_id}</code> | 💰 {float(balance):.2f} | A:{a} | Ban:{b}\n"
 
-    return text, _users_keyboard(page, total)
+    return text, _users_keyboard(first_id, last_id, has_prev, has_next)
 
 
 @router.callback_query(F.data.startswith("users_page:"))
@@ -1309,18 +1574,18 @@ async def cb_users_page(call: CallbackQuery):
         await call.answer("Нет доступа", show_alert=True)
         return
 
-    _, value = call.data.split(":", 1)
-    if value == "noop":
+    parts = call.data.split(":")
+    if len(parts) != 3 or parts[1] not in ("next", "prev"):
         await call.answer()
         return
 
     try:
-        page = int(value)
+        cursor = int(parts[2])
     except ValueError:
         await call.answer()
         return
 
-    text, kb = _format_users_page(page)
+    text, kb = await _format_users_page(parts[1], cursor)
     try:
         await call.message.edit_text(text, reply_markup=kb)
     except Exception:
@@ -1347,7 +1612,7 @@ async def admin_ban(message: Message):
         await message.answer("ID должен быть числом.")
         return
 
-    ban_user(tg_id)
+    await ban_user(tg_id)
     await message.answer(f"🚫 Пользователь <code>{tg_id}</code> забанен.")
 
 
@@ -1368,7 +1633,7 @@ async def admin_unban(message: Message):
         await message.answer("ID должен быть числом.")
         return
 
-    unban_user(tg_id)
+    await unban_user(tg_id)
     await message.answer(f"✅ Пользователь <code>{tg_id}</code> разбанен.")
 
 
@@ -1393,17 +1658,11 @@ async def admin_addbal(message: Message):
         await message.answer("ID и сумма должны быть числами.")
         return
 
-    add_balance(tg_id, amount)
+    await add_balance(tg_id, amount, reason="admin", ref_id=message.from_user.id)
     await message.answer(
         f"✅ Баланс пользователя <code>{tg_id}</code> увеличен на <b>{amount:.2f} грн</b>."
     )
-    try:
-        await bot.send_message(
-            tg_id,
-            f"💰 Тебе начислено администратором: <b>{amount:.2f} грн</b>."
-        )
-    except Exception:
-        pass
+    notify_user(tg_id, f"💰 Тебе начислено администратором: <b>{amount:.2f} грн</b>.")
 
 
 @router.message(Command("subbal"))
@@ -1427,17 +1686,11 @@ async def admin_subbal(message: Message):
         await message.answer("ID и сумма должны быть числами.")
         return
 
-    add_balance(tg_id, -amount)
+    await add_balance(tg_id, -amount, reason="admin", ref_id=message.from_user.id)
     await message.answer(
         f"✅ С баланса пользователя <code>{tg_id}</code> снято <b>{amount:.2f} грн</b>."
     )
-    try:
-        await bot.send_message(
-            tg_id,
-            f"💸 С твоего баланса администратором снято: <b>{amount:.2f} грн</b>."
-        )
-    except Exception:
-        pass
+    notify_user(tg_id, f"💸 С твоего баланса администратором снято: <b>{amount:.2f} грн</b>.")
 
 
 @router.message(Command("msg"))
@@ -1461,10 +1714,9 @@ async def admin_msg(message: Message):
 
     text_to_send = parts[2]
 
-    try:
-        await bot.send_message(tg_id, text_to_send)
+    if await notify_user(tg_id, text_to_send):
         await message.answer("✅ Сообщение отправлено.")
-    except Exception:
+    else:
         await message.answer("❌ Не удалось отправить сообщение этому пользователю.")
 
 
@@ -1481,19 +1733,39 @@ async def admin_all(message: Message):
         await message.answer("Использование: <code>/all Текст рассылки</code>")
         return
 
-    text_to_send = parts[1]
-    users = list_users(limit=1000000)
+    # идёт в фоне, прогресс — в отдельном сообщении (см. broadcast.py)
+    await broadcaster.start(message.chat.id, parts[1])
 
-    sent = 0
-    for u in users:
-        tg_id = u[0]
-        try:
-            await bot.send_message(tg_id, text_to_send)
-            sent += 1
-        except Exception:
-            pass
 
-    await message.answer(f"📢 Рассылка отправлена <b>{sent}</b> пользователям.")
+async def _broadcast_command(message: Message, action) -> None:
+    if not user_is_admin(message.from_user.id):
+        return
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        # задания могут идти и в других процессах — список из БД
+        active = ", ".join(f"#{job_id}" for job_id in await list_active_broadcasts()) or "нет"
+        await message.answer(f"Укажи номер рассылки. Активные: {active}")
+        return
+    if not await action(int(parts[1])):
+        await message.answer("Такой активной рассылки нет (или она уже в этом состоянии).")
+
+
+@router.message(Command("bcpause"))
+async def admin_broadcast_pause(message: Message):
+    """/bcpause id — приостановить рассылку"""
+    await _broadcast_command(message, broadcaster.pause)
+
+
+@router.message(Command("bcresume"))
+async def admin_broadcast_resume(message: Message):
+    """/bcresume id — продолжить рассылку"""
+    await _broadcast_command(message, broadcaster.unpause)
+
+
+@router.message(Command("bccancel"))
+async def admin_broadcast_cancel(message: Message):
+    """/bccancel id — отменить рассылку"""
+    await _broadcast_command(message, broadcaster.cancel)
 
 
 @router.message(Command("pending"))
@@ -1504,7 +1776,7 @@ async def admin_pending(message: Message):
     if not user_is_admin(message.from_user.id):
         return
 
-    wds = list_new_withdrawals(limit=30)
+    wds = await list_new_withdrawals(limit=30)
     if not wds:
         await message.answer("🧾 Новых заявок на вывод нет.")
         return
@@ -1526,6 +1798,172 @@ async def admin_pending(message: Message):
 
 
 
+@router.message(Command("audit"))
+async def admin_audit(message: Message):
+    """
+    /audit <tg_id> — баланс пользователя против журнала + последние движения
+    """
+    if not user_is_admin(message.from_user.id):
+        return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Использование: <code>/audit 123456789</code>")
+        return
+
+    try:
+        tg_id = int(parts[1])
+    except ValueError:
+        await message.answer("ID должен быть числом.")
+        return
+
+    stored, rebuilt = await audit_balance(tg_id)
+    ok = abs(stored - rebuilt) < 0.005
+    lines = [
+        f"🧾 <b>Баланс</b> <code>{tg_id}</code>",
+        f"В профиле: <b>{stored:.2f} грн</b>",
+        f"По журналу: <b>{rebuilt:.2f} грн</b> {'✅' if ok else '⚠️ расхождение'}",
+        "",
+        "Последние движения:",
+    ]
+    for _, delta, after, reason, ref_id, created_ts in await get_ledger(tg_id, limit=10):
+        ref = f" #{ref_id}" if ref_id else ""
+        lines.append(f"{created_ts:%d.%m %H:%M} {delta:+.2f} → {after:.2f} ({reason}{ref})")
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("recount"))
+async def admin_recount(message: Message):
+    """
+    /recount — сверить счётчики статистики с полным пересчётом по users
+    """
+    if not user_is_admin(message.from_user.id):
+        return
+
+    diff = await reconcile_stats()
+    if not diff:
+        await message.answer("✅ Счётчики статистики совпадают с пересчётом.")
+        return
+
+    lines = ["🔁 <b>Счётчики исправлены:</b>"]
+    for name, (old, new) in diff.items():
+        lines.append(f"{name}: {old} → {new}")
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("metrics"))
+async def admin_metrics(message: Message):
+    """
+    /metrics — пул соединений с БД и кэш подписок
+    """
+    if not user_is_admin(message.from_user.id):
+        return
+
+    p = pool_stats()
+    lines = [
+        "📈 <b>Метрики</b>",
+        "",
+        f"🗄 <b>Пул БД</b> ({p['backend']})",
+        f"Соединений: <b>{p['size']}</b> (занято {p['in_use']}, свободно {p['idle']}; "
+        f"лимит {p['min_size']}–{p['max_size']})",
+        f"Выдано: {p['acquired']}, ждали: {p['waits']}, таймаутов: {p['timeouts']}",
+        f"Ожидание: ср. {p['wait_avg_ms']:.1f} мс, макс. {p['wait_max_ms']:.1f} мс",
+        f"Пересоздано: {p['recycled']}",
+    ]
+    if "writer_acquired" in p:
+        lines.append(
+            f"Запись (SQLite): {p['writer_acquired']}, ожидание ср. "
+            f"{p['writer_wait_avg_ms']:.1f} мс, макс. {p['writer_wait_max_ms']:.1f} мс"
+        )
+
+    c = sub_cache.stats()
+    lines += [
+        "",
+        "📢 <b>Кэш подписок</b>",
+        f"Записей: {c['size']} из {c['max_size']}, вытеснено: {c['evictions']}",
+        f"Попаданий: {c['hits']}, промахов: {c['misses']} ({c['hit_rate']:.0%})",
+    ]
+
+    m = membership.stats()
+    lines += [
+        "",
+        "👥 <b>Индекс подписок</b>",
+        f"Каналов с chat_member: {m['tracked']} из {m['channels']}, записей: {m['size']}",
+        f"Ответов из индекса: {m['hits']}, промахов: {m['misses']}, событий: {m['events']}",
+    ]
+    down = [ch for ch in channels if not ch.accessible]
+    if down:
+        lines.append(f"Недоступны боту: {', '.join(str(ch.chat_id) for ch in down)}")
+
+    r = send_bucket.stats()
+    lines += [
+        "",
+        "📢 <b>Рассылки</b>",
+        f"Активных: {len(broadcaster.jobs)}, лимит {r['rate']:.0f} сообщ./с, "
+        f"отправлено через лимитер: {r['acquired']}, flood wait: {r['pauses']}",
+    ]
+
+    o = outbox.stats()
+    lines += [
+        "",
+        "📬 <b>Очередь уведомлений</b>",
+        f"В очереди: {o['pending']}, отправлено: {o['sent']}, не доставлено: {o['failed']} "
+        f"(заблокировали бота: {o['blocked']})",
+        f"Повторов: {o['retried']}, отложено по лимиту чата: {o['deferred']}, "
+        f"макс. ожидание: {o['max_wait']:.1f} с",
+    ]
+    if TASK_DIGEST:
+        d = task_digest.stats()
+        lines.append(f"Дайджест заданий: ждут {d['pending']}, альбомов {d['batches']}, заявок {d['proofs']}")
+
+    db_sf, sub_sf = singleflight_stats(), sub_flights.stats()
+    lines += [
+        "",
+        "🔀 <b>Single-flight</b>",
+        f"Чтения БД: запущено {db_sf['started']}, присоединились {db_sf['shared']}",
+        f"Проверки подписки: запущено {sub_sf['started']}, присоединились {sub_sf['shared']}",
+    ]
+
+    ln = lanes.stats()
+    lines += [
+        "",
+        "🚦 <b>Обработка апдейтов</b>",
+        f"Выполняется: {ln['running']} из {ln['concurrency']}, ждут в очереди: {ln['queued']}, "
+        f"пользователей: {ln['lanes']}",
+        f"Обработано: {ln['handled']}, отброшено: {ln['dropped']}, макс. очередь: {ln['max_depth']}",
+        f"Ожидание: среднее {ln['wait_avg'] * 1000:.0f} мс, макс. {ln['wait_max'] * 1000:.0f} мс",
+    ]
+
+    fs = flows.stats()
+    flows_line = f"Диалоги (вывод, задания): хранилище {fs['backend']}"
+    if fs["backend"] == "memory":
+        flows_line += f", записей {fs['size']}, вытеснено {fs['evictions']}"
+    lines.append(flows_line)
+
+    lb = leaderboard.stats()
+    lines += [
+        "",
+        "🏆 <b>Топ рефералов</b>",
+        f"Пересборок: {lb['refreshes']}, запрошено username: {lb['resolved']}",
+    ]
+
+    lines += ["", "🔌 <b>Breakers Telegram API</b>"]
+    if not any(True for _ in breakers):
+        lines.append("Вызовов ещё не было")
+    states = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    for b in sorted((b.stats() for b in breakers), key=lambda b: b["name"]):
+        line = (
+            f"{states[b['state']]} {b['name']}: вызовов {b['calls']}, "
+            f"отказано {b['rejected']}, срабатываний {b['trips']}"
+        )
+        if b["state"] != "closed":
+            line += f", проба через {b['retry_in']:.0f} с"
+        if b["last_error"] and b["state"] != "closed":
+            line += f"\n   {escape(b['last_error'])}"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+
 # ============ СТАРТ БОТА ============
 
 # ===== ADMIN FAKE REFS =====
@@ -1545,7 +1983,8 @@ async def admin_addref(message: Message):
     tg_id = int(parts[1])
     amount = int(parts[2])
 
-    add_fake_refs(tg_id, amount)
+    await add_fake_refs(tg_id, amount)
+    leaderboard.mark_dirty()
 
     await message.answer(f"Добавлено {amount} рефералов пользователю {tg_id}")
 
@@ -1564,15 +2003,112 @@ async def admin_setusers(message: Message):
 
     value = int(parts[1])
 
-    set_custom_stat("users", value)
+    await set_custom_stat("users", value)
 
     await message.answer(f"Статистика пользователей установлена: {value}")
 
 
-async def main():
-    init_db()
+# шаги вывода — последним хендлером сообщений: фильтр читает состояние из flows
+# (при FSM_STORAGE=db — запрос в БД), и команды с кнопками до него не доходят
+router.message.register(withdraw_states, in_withdraw_flow)
+
+
+# фоновые задачи держим в множестве, чтобы их не собрал GC
+background_tasks: set[asyncio.Task] = set()
+
+
+def _background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"Фоновая задача {task.get_name()} упала", exc_info=task.exception())
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+BALANCE_SNAPSHOT_HOURS = 6
+
+
+async def balance_snapshot_loop():
+    """Периодически фиксирует балансы, чтобы сверка не суммировала всю историю."""
+    while True:
+        await asyncio.sleep(BALANCE_SNAPSHOT_HOURS * 3600)
+        try:
+            taken = await take_balance_snapshots()
+            logging.info(f"Снимки балансов: {taken}")
+        except Exception as e:
+            logging.warning(f"Не удалось снять балансы: {e}")
+
+
+FLOW_PURGE_MINUTES = 10
+
+
+async def flow_purge_loop():
+    """Удаляет брошенные на середине диалоги (истёк FSM TTL)."""
+    while True:
+        await asyncio.sleep(FLOW_PURGE_MINUTES * 60)
+        try:
+            purged = await flows.purge()
+            if purged:
+                logging.info(f"Удалено брошенных диалогов: {purged}")
+        except Exception as e:
+            logging.warning(f"Не удалось почистить состояние диалогов: {e}")
+
+
+# сколько ждать отправки очереди уведомлений при остановке
+OUTBOX_DRAIN_SECONDS = 10
+
+
+async def on_startup():
+    await init_db()
+    await refresh_bot_identity()
+    spawn(bot_identity_loop())
+    # старые TEXT-даты → TIMESTAMPTZ, не задерживая старт
+    spawn(backfill_timestamps())
+    spawn(balance_snapshot_loop())
+    spawn(flow_purge_loop())
+    logging.info(f"Индекс подписок: {await membership.load()} записей")
+    logging.info(f"Недоступных каналов: {await channels.load_health()}")
+    spawn(channel_probe_loop())
+    spawn(leaderboard.run())
+    outbox.start()
+    if TASK_DIGEST:
+        spawn(task_digest.run())
+    resent = await resend_unnotified_proofs()
+    if resent:
+        logging.info(f"Заново отправлено админам заявок: {resent}")
+    resumed = await broadcaster.resume_pending()
+    if resumed:
+        logging.info(f"Продолжаю рассылок: {resumed}")
+    spawn(broadcaster.run())
     print("BOT STARTED")
-    await dp.start_polling(bot)
+
+
+async def on_shutdown():
+    # отпускаем свои рассылки, чтобы их сразу продолжил другой процесс или этот после рестарта
+    await broadcaster.stop()
+    task_digest.flush()
+    await outbox.drain(OUTBOX_DRAIN_SECONDS)
+    close_pool()
+
+
+# одни и те же хуки для polling и webhook
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+async def main():
+    if WEBHOOK_URL:
+        await run_webhook(dp, bot)
+        return
+    # при установленном webhook getUpdates не работает
+    await bot.delete_webhook()
+    # chat_member Telegram присылает, только если попросить явно
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+"""Индекс подписок на обязательные каналы.
+
+Где бот админ, Telegram сам присылает апдейты chat_member о вступлении и
+выходе. По ним ведётся индекс: таблица channel_members и зеркало в памяти.
+is_subscribed отвечает из индекса и ходит в get_chat_member только в двух
+случаях: пользователя в индексе ещё нет (подписался до запуска индекса) или
+канал не отслеживается (бот там не админ).
+
+В индекс попадают только пользователи бота (есть в users): остальные
+подписчики канала ему не нужны, а иначе таблица и зеркало росли бы вместе
+с каналом. Записи, сделанные до этого правила, удаляются при load().
+"""
+from aiogram.types import ChatMember
+
+from db_async import load_channel_members, prune_channel_members, set_channel_member
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def is_member_status(member: ChatMember) -> bool:
+    # restricted — участник с ограничениями: в канале он, только если is_member
+    if member.status == "restricted":
+        return bool(getattr(member, "is_member", False))
+    return member.status in MEMBER_STATUSES
+
+
+class MembershipIndex:
+    def __init__(self):
+        # числовые id обязательных каналов; ключ — запись из REQUIRED_CHANNELS
+        self.chat_ids: dict[int | str, int] = {}
+        # каналы, где бот админ и получает chat_member
+        self.tracked: set[int] = set()
+        # chat_id -> {tg_id: подписан ли}
+        self._members: dict[int, dict[int, bool]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.events = 0
+
+    async def load(self) -> int:
+        """Поднимает зеркало из channel_members. Возвращает число записей."""
+        await prune_channel_members()
+        rows = await load_channel_members()
+        for chat_id, tg_id, is_member in rows:
+            self._members.setdefault(chat_id, {})[tg_id] = is_member
+        return len(rows)
+
+    def resolve(self, chat_id: int | str) -> int | None:
+        """Числовой id канала (для @username — после resolve при старте)."""
+        if isinstance(chat_id, int):
+            return chat_id
+        return self.chat_ids.get(chat_id)
+
+    def is_tracked(self, chat_id: int | str) -> bool:
+        return self.resolve(chat_id) in self.tracked
+
+    def get(self, chat_id: int | str, tg_id: int) -> bool | None:
+        """Ответ индекса или None, если канал не отслеживается или пользователя нет."""
+        numeric = self.resolve(chat_id)
+        if numeric not in self.tracked:
+            return None
+        value = self._members.get(numeric, {}).get(tg_id)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, chat_id: int | str, tg_id: int, is_member: bool):
+        numeric = self.resolve(chat_id)
+        if numeric is None:
+            return
+        members = self._members.get(numeric, {})
+        if members.get(tg_id) is is_member:
+            return
+        # в память — только то, что записано в БД (пользователь бота)
+        if await set_channel_member(numeric, tg_id, is_member):
+            self._members.setdefault(numeric, {})[tg_id] = is_member
+
+    def forget_negative(self, tg_id: int):
+        """Сбрасывает «не подписан» в памяти, чтобы следующая проверка спросила API."""
+        for members in self._members.values():
+            if members.get(tg_id) is False:
+                del members[tg_id]
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.tracked),
+            "channels": len(self.chat_ids),
+            "size": sum(len(m) for m in self._members.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "events": self.events,
+        }
@@ -0,0 +1,311 @@
+"""Перенос старого SQLite bot.db в Postgres.
+
+    DATABASE_URL=postgres://... python migrate_legacy.py bot.db [--chunk 20000]
+
+users, withdrawals и task_submissions читаются из bot.db пачками по id.
+Каждая пачка уходит в Postgres одним COPY во временную таблицу, а оттуда одним
+INSERT ... SELECT в схему init_db(). Пользователь, чей tg_id уже есть в
+Postgres, пропускается. Пачка и контрольная точка в legacy_import
+коммитятся в одной транзакции, поэтому после обрыва повторный запуск
+продолжает с того же места и ничего не задваивает.
+"""
+import argparse
+import io
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+import db
+
+# (колонка bot.db, тип во временной таблице, приведение значения из SQLite)
+_USERS = [
+    ("tg_id", "BIGINT", int),
+    ("balance", "DOUBLE PRECISION", float),
+    ("referrer_id", "BIGINT", int),
+    ("activated", "INTEGER", int),
+    ("phone", "TEXT", str),
+    ("created_at", "TEXT", str),
+    ("last_bonus_at", "TEXT", str),
+    ("banned", "INTEGER", int),
+    ("language", "TEXT", str),
+]
+_WITHDRAWALS = [
+    ("tg_id", "BIGINT", int),
+    ("method", "TEXT", str),
+    ("details", "TEXT", str),
+    ("amount", "DOUBLE PRECISION", float),
+    ("status", "TEXT", str),
+    ("created_at", "TEXT", str),
+]
+_TASK_SUBMISSIONS = [
+    ("tg_id", "BIGINT", int),
+    ("task_id", "TEXT", str),
+    ("status", "TEXT", str),
+    ("proof_file_id", "TEXT", str),
+    ("proof_caption", "TEXT", str),
+    ("created_at", "TEXT", str),
+]
+
+
+# TEXT-даты bot.db разбираются в Python (db._as_dt) и едут в COPY отдельной
+# TIMESTAMPTZ-колонкой: кривая строка даёт NULL, а не ошибку на всю пачку
+_TS_OF = {"created_at": "created_ts", "last_bonus_at": "last_bonus_ts"}
+
+
+# Пользователи: дубли tg_id внутри пачки схлопываем (берём первую строку),
+# уже существующих в Postgres не трогаем. Ненулевой баланс записываем в журнал.
+_INSERT_USERS = """
+    WITH ins AS (
+        INSERT INTO users (tg_id, balance, referrer_id, activated, phone, created_at,
+                           last_bonus_at, banned, language, created_ts, last_bonus_ts)
+        SELECT DISTINCT ON (s.tg_id)
+               s.tg_id, COALESCE(s.balance, 0), s.referrer_id, COALESCE(s.activated, 0),
+               s.phone, s.created_at, s.last_bonus_at, COALESCE(s.banned, 0),
+               COALESCE(s.language, 'unset'), s.created_ts, s.last_bonus_ts
+        FROM legacy_chunk s
+        WHERE s.tg_id IS NOT NULL
+        ORDER BY s.tg_id, s.legacy_id
+        ON CONFLICT (tg_id) DO NOTHING
+        RETURNING tg_id, balance
+    ), led AS (
+        INSERT INTO balance_ledger (tg_id, delta, balance_after, reason, created_ts)
+        SELECT tg_id, balance, balance, 'import', %s FROM ins WHERE balance <> 0
+    )
+    SELECT COUNT(*) FROM ins
+"""
+
+_INSERT_WITHDRAWALS = """
+    INSERT INTO withdrawals (tg_id, method, details, amount, status, created_at, created_ts)
+    SELECT s.tg_id, s.method, s.details, s.amount, s.status, s.created_at, s.created_ts
+    FROM legacy_chunk s
+    ORDER BY s.legacy_id
+"""
+
+_INSERT_TASK_SUBMISSIONS = """
+    INSERT INTO task_submissions (tg_id, task_id, status, proof_file_id, proof_caption,
+                                  created_at, created_ts)
+    SELECT s.tg_id, s.task_id, s.status, s.proof_file_id, s.proof_caption,
+           s.created_at, s.created_ts
+    FROM legacy_chunk s
+    ORDER BY s.legacy_id
+"""
+
+# порядок важен: пользователи раньше их заявок
+_TABLES = [
+    ("users", _USERS, _INSERT_USERS),
+    ("withdrawals", _WITHDRAWALS, _INSERT_WITHDRAWALS),
+    ("task_submissions", _TASK_SUBMISSIONS, _INSERT_TASK_SUBMISSIONS),
+]
+
+
+# ---------- SOURCE (bot.db) ----------
+
+def _source_columns(src: sqlite3.Connection, table: str) -> set[str] | None:
+    """Колонки таблицы в bot.db или None, если таблицы нет."""
+    rows = src.execute(f"PRAGMA table_info({table})").fetchall()
+    return {row[1] for row in rows} or None
+
+
+def _read_chunk(src, table: str, columns, present: set[str], after_id: int, limit: int):
+    # в старых файлах части колонок нет (language, banned...) — отдаём NULL
+    select = ", ".join(col if col in present else f"NULL AS {col}" for col, _, _ in columns)
+    return src.execute(
+        f"SELECT id, {select} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, limit),
+    ).fetchall()
+
+
+def _coerce(value, cast):
+    # SQLite хранит что угодно в любой колонке: '' и мусор в числовых — это NULL
+    if value is None:
+        return None
+    if cast is str:
+        return str(value)
+    try:
+        return cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _copy_field(value) -> str:
+    """Значение в текстовом формате COPY."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _chunk_columns(columns) -> list[tuple[str, str]]:
+    """(колонка, тип) временной таблицы: колонки bot.db и разобранные даты."""
+    return [(col, pgtype) for col, pgtype, _ in columns] + [
+        (_TS_OF[col], "TIMESTAMPTZ") for col, _, _ in columns if col in _TS_OF
+    ]
+
+
+def _copy_buffer(rows, columns, table: str = "") -> io.StringIO:
+    casts = [cast for _, _, cast in columns]
+    ts_idx = [i for i, (col, _, _) in enumerate(columns) if col in _TS_OF]
+    buf = io.StringIO()
+    for legacy_id, *values in rows:
+        values = [_coerce(v, c) for v, c in zip(values, casts)]
+        for i in ts_idx:
+            text = values[i]
+            dt = db._as_dt(None, text)
+            if dt is None and text:
+                col = columns[i][0]
+                logging.warning(f"{table} id={legacy_id}: не разобрана дата {col}={text!r}, {_TS_OF[col]} = NULL")
+            values.append(dt.isoformat() if dt else None)
+        fields = [str(legacy_id)] + [_copy_field(v) for v in values]
+        buf.write("\t".join(fields))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+# ---------- CHECKPOINTS ----------
+
+def _checkpoint(source: str, table: str) -> tuple[int, int, int]:
+    """(last_id, copied, skipped) для таблицы или нули, если импорт не начинался."""
+    with db._connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT last_id, copied, skipped FROM legacy_import WHERE source=%s AND tbl=%s",
+            (source, table),
+        )
+        row = cur.fetchone()
+    return tuple(int(v) for v in row) if row else (0, 0, 0)
+
+
+def _save_checkpoint(cur, source: str, table: str, last_id: int, copied: int, skipped: int):
+    cur.execute(
+        """
+        INSERT INTO legacy_import (source, tbl, last_id, copied, skipped, updated_ts)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (source, tbl) DO UPDATE
+        SET last_id = EXCLUDED.last_id, copied = EXCLUDED.copied,
+            skipped = EXCLUDED.skipped, updated_ts = EXCLUDED.updated_ts
+        """,
+        (source, table, last_id, copied, skipped, datetime.now(timezone.utc)),
+    )
+
+
+# ---------- IMPORT ----------
+
+def import_table(src, source: str, table: str, columns, insert_sql: str, chunk: int) -> tuple[int, int]:
+    """Переносит одну таблицу пачками, продолжая с контрольной точки.
+
+    Возвращает (вставлено, пропущено) за этот запуск.
+    """
+    present = _source_columns(src, table)
+    if present is None:
+        logging.info(f"{table}: в исходном файле нет такой таблицы — пропускаю")
+        return 0, 0
+
+    last_id, copied, skipped = _checkpoint(source, table)
+    (remaining,) = src.execute(f"SELECT COUNT(*) FROM {table} WHERE id > ?", (last_id,)).fetchone()
+    if not remaining:
+        logging.info(f"{table}: уже перенесено ({copied} строк)")
+        return 0, 0
+    if last_id:
+        logging.info(f"{table}: продолжаю после id {last_id}, осталось {remaining} строк")
+
+    chunk_columns = _chunk_columns(columns)
+    ddl = ", ".join(f"{col} {pgtype}" for col, pgtype in chunk_columns)
+    names = ", ".join(col for col, _ in chunk_columns)
+    run_copied = run_skipped = done = 0
+    started = time.monotonic()
+
+    while True:
+        rows = _read_chunk(src, table, columns, present, last_id, chunk)
+        if not rows:
+            break
+
+        with db._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"CREATE TEMP TABLE legacy_chunk (legacy_id BIGINT, {ddl}) ON COMMIT DROP")
+            cur.copy_expert(
+                f"COPY legacy_chunk (legacy_id, {names}) FROM STDIN",
+                _copy_buffer(rows, columns, table),
+            )
+            if table == "users":
+                cur.execute(insert_sql, (datetime.now(timezone.utc),))
+                inserted = int(cur.fetchone()[0])
+            else:
+                cur.execute(insert_sql)
+                inserted = cur.rowcount
+
+            last_id = rows[-1][0]
+            run_copied += inserted
+            run_skipped += len(rows) - inserted
+            _save_checkpoint(cur, source, table, last_id, copied + run_copied, skipped + run_skipped)
+
+        done += len(rows)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logging.info(f"{table}: {done}/{remaining} строк, {done / elapsed:.0f} стр/с")
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logging.info(
+        f"{table}: готово за {elapsed:.1f} с ({done / elapsed:.0f} стр/с), "
+        f"вставлено {run_copied}, пропущено дублей {run_skipped}"
+    )
+    return run_copied, run_skipped
+
+
+def migrate_legacy(path: str, source: str | None = None, chunk: int = 20000) -> dict:
+    """Переносит bot.db в базу из DATABASE_URL. Возвращает {таблица: (вставлено, пропущено)}."""
+    if db._dialect() != "postgres":
+        raise RuntimeError("migrate_legacy.py заливает данные через COPY — нужен Postgres в DATABASE_URL")
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    db.init_db()
+    source = source or os.path.abspath(path)
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    result = {}
+    try:
+        for table, columns, insert_sql in _TABLES:
+            result[table] = import_table(src, source, table, columns, insert_sql, chunk)
+    finally:
+        src.close()
+
+    if result.get("users", (0, 0))[0]:
+        # пользователей вставляли мимо create_user — счётчики пересчитываем целиком
+        db.reconcile_stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос старого bot.db в Postgres")
+    parser.add_argument("path", help="путь к bot.db")
+    parser.add_argument("--chunk", type=int, default=20000, help="строк в одной пачке")
+    parser.add_argument(
+        "--source",
+        help="имя источника для контрольных точек (по умолчанию — полный путь к файлу)",
+    )
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    try:
+        result = migrate_legacy(args.path, source=args.source, chunk=args.chunk)
+    except KeyboardInterrupt:
+        logging.warning("Прервано. Повторный запуск продолжит с последней контрольной точки.")
+        sys.exit(130)
+    finally:
+        db.close_pool()
+
+    total = sum(copied + skipped for copied, skipped in result.values())
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logging.info(f"Импорт завершён: {total} строк за {elapsed:.1f} с ({total / elapsed:.0f} стр/с)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,529 @@
+"""Версионированные миграции схемы БД.
+
+Номер применённой версии хранится в таблице schema_version. При старте
+достаточно одного запроса MAX(version): если база актуальна — ничего не делаем,
+иначе под advisory-lock по очереди применяем только недостающие шаги.
+
+Lock берётся pg_try_advisory_lock в цикле с паузой, а не блокирующим
+pg_advisory_lock: ждущий процесс висел бы в запросе с открытым снимком, а
+CREATE INDEX CONCURRENTLY у владельца lock ждёт завершения всех старых
+снимков — две реплики при одновременном старте зависали бы друг на друге.
+
+Шаг миграции — функция apply(cur, dialect), dialect — "postgres" или "sqlite"
+(см. storage.py). Обычные шаги выполняются в транзакции вместе с записью в
+schema_version. Шаги с transactional=False (например, CREATE INDEX
+CONCURRENTLY) выполняются в autocommit и должны быть идемпотентны: если процесс
+упал посередине, шаг просто повторится при следующем старте.
+"""
+import logging
+import time
+from datetime import datetime, timezone
+
+# произвольный ключ, чтобы два процесса не мигрировали одновременно
+_LOCK_KEY = 724031
+# как часто проверять, освободил ли lock другой процесс, сек
+_LOCK_POLL = 0.5
+
+
+def _serial(dialect: str, big: bool = False) -> str:
+    """Автоинкрементный первичный ключ."""
+    if dialect == "sqlite":
+        return "INTEGER PRIMARY KEY AUTOINCREMENT"
+    return "BIGSERIAL PRIMARY KEY" if big else "SERIAL PRIMARY KEY"
+
+
+def _ensure_column(cur, dialect: str, table: str, column_def: str):
+    """Безопасно добавляет колонку, если её нет."""
+    if dialect == "sqlite":
+        # в SQLite нет ADD COLUMN IF NOT EXISTS
+        cur.execute(f"PRAGMA table_info({table})")
+        if column_def.split()[0] in {row[1] for row in cur.fetchall()}:
+            return
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+        return
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column_def}")
+
+
+def _create_index(cur, dialect: str, name: str, definition: str):
+    """Postgres: CREATE INDEX CONCURRENTLY без блокировки записи; SQLite: обычный индекс.
+
+    Если прошлая попытка в Postgres оборвалась, от неё остаётся INVALID-индекс,
+    который IF NOT EXISTS молча пропустит, — такой индекс удаляем и строим заново.
+    """
+    if dialect == "sqlite":
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+        return
+    cur.execute(
+        """
+        SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s AND NOT i.indisvalid
+        """,
+        (name,),
+    )
+    if cur.fetchone():
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+# ---------- ШАГИ ----------
+
+def _m001_baseline(cur, dialect):
+    """Таблицы и колонки, которые раньше создавал init_db() на каждом старте."""
+    # Таблица пользователей
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS users (
+            id {_serial(dialect)},
+            tg_id BIGINT UNIQUE,
+            balance DOUBLE PRECISION DEFAULT 0,
+            referrer_id BIGINT,
+            activated INTEGER DEFAULT 0,
+            phone TEXT,
+            created_at TEXT,
+            last_bonus_at TEXT,
+            banned INTEGER DEFAULT 0
+        )
+        """
+    )
+
+    # Колонки, которых нет в старых базах
+    _ensure_column(cur, dialect, "users", "referrer_id BIGINT")
+    _ensure_column(cur, dialect, "users", "activated INTEGER DEFAULT 0")
+    _ensure_column(cur, dialect, "users", "phone TEXT")
+    _ensure_column(cur, dialect, "users", "created_at TEXT")
+    _ensure_column(cur, dialect, "users", "last_bonus_at TEXT")
+    _ensure_column(cur, dialect, "users", "banned INTEGER DEFAULT 0")
+    _ensure_column(cur, dialect, "users", "balance DOUBLE PRECISION DEFAULT 0")
+    _ensure_column(cur, dialect, "users", "language TEXT DEFAULT 'unset'")
+
+    # Таблица выводов
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id {_serial(dialect)},
+            tg_id BIGINT,
+            method TEXT,
+            details TEXT,
+            amount DOUBLE PRECISION,
+            status TEXT,
+            created_at TEXT
+        )
+        """
+    )
+
+    # Таблица заявок по заданиям
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS task_submissions (
+            id {_serial(dialect)},
+            tg_id BIGINT,
+            task_id TEXT,
+            status TEXT,
+            proof_file_id TEXT,
+            proof_caption TEXT,
+            created_at TEXT
+        )
+        """
+    )
+
+    # Таблица фейковых рефералов
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fake_refs (
+            tg_id BIGINT PRIMARY KEY,
+            refs INTEGER DEFAULT 0
+        )
+        """
+    )
+
+    # Таблица кастомной статистики
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS custom_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+        """
+    )
+
+
+def _m002_hot_indexes(cur, dialect):
+    """Индексы под горячие запросы db.py."""
+    # get_last_task_submission: WHERE tg_id AND task_id ORDER BY id DESC LIMIT 1
+    _create_index(
+        cur, dialect, "ix_task_submissions_user_task",
+        "task_submissions (tg_id, task_id, id DESC)",
+    )
+    # has_any_approved_task: WHERE tg_id AND status='approved'
+    _create_index(
+        cur, dialect, "ix_task_submissions_user_approved",
+        "task_submissions (tg_id) WHERE status = 'approved'",
+    )
+    # list_new_withdrawals: WHERE status='new' ORDER BY id
+    _create_index(
+        cur, dialect, "ix_withdrawals_new",
+        "withdrawals (id) WHERE status = 'new'",
+    )
+    # is_phone_used: WHERE phone=...
+    _create_index(
+        cur, dialect, "ix_users_phone",
+        "users (phone) WHERE phone IS NOT NULL",
+    )
+    # get_top_referrers: WHERE activated=1 AND referrer_id IS NOT NULL GROUP BY referrer_id
+    _create_index(
+        cur, dialect, "ix_users_referrer_activated",
+        "users (referrer_id) WHERE activated = 1 AND referrer_id IS NOT NULL",
+    )
+
+
+def _m003_timestamptz_columns(cur, dialect):
+    """Теневые TIMESTAMPTZ-колонки рядом со старыми TEXT-датами.
+
+    ADD COLUMN без DEFAULT в Postgres меняет только каталог, таблицу не
+    переписывает. Заполняет их db.backfill_timestamps() пачками в фоне,
+    а пока он идёт, db.py пишет в обе колонки и читает новую с откатом на старую.
+    """
+    _ensure_column(cur, dialect, "users", "created_ts TIMESTAMPTZ")
+    _ensure_column(cur, dialect, "users", "last_bonus_ts TIMESTAMPTZ")
+    _ensure_column(cur, dialect, "withdrawals", "created_ts TIMESTAMPTZ")
+    _ensure_column(cur, dialect, "task_submissions", "created_ts TIMESTAMPTZ")
+
+
+def _m004_timestamptz_indexes(cur, dialect):
+    """Индексы под выборки по времени (новые за 24 ч, бонусы, заявки за день)."""
+    _create_index(cur, dialect, "ix_users_created_ts", "users (created_ts)")
+    _create_index(cur, dialect, "ix_users_last_bonus_ts", "users (last_bonus_ts)")
+    _create_index(cur, dialect, "ix_withdrawals_created_ts", "withdrawals (created_ts)")
+    _create_index(cur, dialect, "ix_task_submissions_created_ts", "task_submissions (created_ts)")
+
+
+def _m005_stats_counters(cur, dialect):
+    """Счётчики для /admin и «📊 Статистика» вместо COUNT(*) по users.
+
+    Их обновляют пишущие функции db.py в той же транзакции, что и саму запись.
+    Начальные значения проставляет db.reconcile_stats() сразу после миграции.
+    """
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_new_users_hourly (
+            hour TIMESTAMPTZ PRIMARY KEY,
+            cnt INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+
+def _m006_balance_ledger(cur, dialect):
+    """Журнал движений баланса (только INSERT) и периодические снимки.
+
+    Текущий баланс по-прежнему лежит в users.balance, журнал нужен для аудита:
+    баланс = последний снимок + сумма delta после него. Для уже существующих
+    балансов пишем стартовые записи 'opening'.
+    """
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id {_serial(dialect, big=True)},
+            tg_id BIGINT NOT NULL,
+            delta DOUBLE PRECISION NOT NULL,
+            balance_after DOUBLE PRECISION NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id BIGINT,
+            created_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_balance_ledger_user ON balance_ledger (tg_id, id)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            tg_id BIGINT NOT NULL,
+            ledger_id BIGINT NOT NULL,
+            balance DOUBLE PRECISION NOT NULL,
+            taken_ts TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (tg_id, ledger_id)
+        )
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO balance_ledger (tg_id, delta, balance_after, reason, created_ts)
+        SELECT tg_id, balance, balance, 'opening', %s
+        FROM users
+        WHERE tg_id IS NOT NULL AND balance IS NOT NULL AND balance <> 0
+        ORDER BY id
+        """,
+        (datetime.now(timezone.utc),),
+    )
+
+
+def _m007_legacy_import(cur, dialect):
+    """Контрольные точки migrate_legacy.py: до какого id исходного bot.db дошли."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS legacy_import (
+            source TEXT NOT NULL,
+            tbl TEXT NOT NULL,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            copied BIGINT NOT NULL DEFAULT 0,
+            skipped BIGINT NOT NULL DEFAULT 0,
+            updated_ts TIMESTAMPTZ,
+            PRIMARY KEY (source, tbl)
+        )
+        """
+    )
+
+
+def _m008_channel_members(cur, dialect):
+    """Индекс подписок на обязательные каналы, который ведут апдейты chat_member."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channel_members (
+            chat_id BIGINT NOT NULL,
+            tg_id BIGINT NOT NULL,
+            is_member INTEGER NOT NULL,
+            updated_ts TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (chat_id, tg_id)
+        )
+        """
+    )
+
+
+def _m009_channel_health(cur, dialect):
+    """Состояние обязательных каналов: недоступен ли боту и когда перепроверить."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channel_health (
+            channel TEXT PRIMARY KEY,
+            accessible INTEGER NOT NULL DEFAULT 1,
+            failures INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_probe_ts TIMESTAMPTZ,
+            notified INTEGER NOT NULL DEFAULT 0,
+            updated_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+
+def _m010_broadcasts(cur, dialect):
+    """Задания рассылки /all с контрольной точкой: до какого users.id дошли."""
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id {_serial(dialect)},
+            admin_chat_id BIGINT NOT NULL,
+            progress_msg_id BIGINT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_ts TIMESTAMPTZ NOT NULL,
+            updated_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+
+def _m011_users_blocked(cur, dialect):
+    """Когда пользователь заблокировал бота (Forbidden при отправке); NULL — доступен."""
+    _ensure_column(cur, dialect, "users", "blocked_ts TIMESTAMPTZ")
+
+
+def _m012_leaderboard(cur, dialect):
+    """Готовый топ рефералов (реальные + фейковые) и кэш username с TTL."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            rank INTEGER PRIMARY KEY,
+            tg_id BIGINT NOT NULL,
+            refs INTEGER NOT NULL,
+            refreshed_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS usernames (
+            tg_id BIGINT PRIMARY KEY,
+            username TEXT,
+            resolved_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+
+def _m013_flow_state(cur, dialect):
+    """Состояние диалогов (вывод, скрин задания) для FSM_STORAGE=db.
+
+    Вне транзакции из-за CREATE INDEX CONCURRENTLY; CREATE TABLE IF NOT EXISTS
+    повторяется безопасно.
+    """
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS flow_state (
+            tg_id BIGINT NOT NULL,
+            flow TEXT NOT NULL,
+            data TEXT NOT NULL,
+            expires_ts TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (tg_id, flow)
+        )
+        """
+    )
+    _create_index(cur, dialect, "ix_flow_state_expires", "flow_state (expires_ts)")
+
+
+def _m014_broadcast_owner(cur, dialect):
+    """Какой процесс ведёт рассылку и до какого момента (аренда продлевается на ходу)."""
+    _ensure_column(cur, dialect, "broadcasts", "owner TEXT")
+    _ensure_column(cur, dialect, "broadcasts", "lease_ts TIMESTAMPTZ")
+
+
+def _m015_app_settings(cur, dialect):
+    """Служебные отметки бота (например, что backfill дат завершён)."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_ts TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+
+def _m016_submissions_notified(cur, dialect):
+    """Когда скрин заявки дошёл до админов; NULL — ещё не дошёл (пересылается при старте).
+
+    Уже существующие заявки считаем отправленными: их разослала прошлая версия.
+    """
+    _ensure_column(cur, dialect, "task_submissions", "notified_ts TIMESTAMPTZ")
+    cur.execute(
+        "UPDATE task_submissions SET notified_ts=%s WHERE notified_ts IS NULL",
+        (datetime.now(timezone.utc),),
+    )
+
+
+# (версия, описание, функция, в транзакции ли)
+MIGRATIONS = [
+    (1, "базовая схема", _m001_baseline, True),
+    (2, "индексы для горячих запросов", _m002_hot_indexes, False),
+    (3, "колонки TIMESTAMPTZ", _m003_timestamptz_columns, True),
+    (4, "индексы по TIMESTAMPTZ", _m004_timestamptz_indexes, False),
+    (5, "счётчики статистики", _m005_stats_counters, True),
+    (6, "журнал баланса", _m006_balance_ledger, True),
+    (7, "контрольные точки импорта bot.db", _m007_legacy_import, True),
+    (8, "индекс подписок на каналы", _m008_channel_members, True),
+    (9, "состояние обязательных каналов", _m009_channel_health, True),
+    (10, "задания рассылки", _m010_broadcasts, True),
+    (11, "пользователи, заблокировавшие бота", _m011_users_blocked, True),
+    (12, "топ рефералов и кэш username", _m012_leaderboard, True),
+    (13, "состояние диалогов", _m013_flow_state, False),
+    (14, "владелец рассылки", _m014_broadcast_owner, True),
+    (15, "служебные отметки", _m015_app_settings, True),
+    (16, "доставка заявок админам", _m016_submissions_notified, True),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ---------- RUNNER ----------
+
+def current_version(conn) -> int:
+    """Версия схемы или 0, если миграций ещё не было."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        row = cur.fetchone()
+    except Exception:
+        # таблицы schema_version ещё нет
+        conn.rollback()
+        return 0
+    conn.rollback()
+    return int(row[0] or 0)
+
+
+def migrate(conn, dialect: str = "postgres") -> list[int]:
+    """Применяет недостающие миграции. Возвращает список применённых версий."""
+    if current_version(conn) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        # в SQLite писатель один, а в Postgres могут стартовать сразу несколько процессов
+        if dialect == "postgres":
+            _advisory_lock(cur)
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMPTZ
+                )
+                """
+            )
+            # пока ждали lock, другой процесс мог всё применить
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            done = cur.fetchone()[0]
+
+            for version, description, apply, transactional in MIGRATIONS:
+                if version <= done:
+                    continue
+
+                logging.info(f"Миграция БД {version}: {description}")
+                if transactional:
+                    conn.autocommit = False
+                    try:
+                        apply(cur, dialect)
+                        _record(cur, version, description)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.autocommit = True
+                else:
+                    apply(cur, dialect)
+                    _record(cur, version, description)
+                applied.append(version)
+        finally:
+            if dialect == "postgres":
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_LOCK_KEY,))
+    finally:
+        conn.autocommit = False
+
+    return applied
+
+
+def _advisory_lock(cur):
+    """Ждёт advisory-lock миграций, не держа открытого запроса между попытками."""
+    waiting = False
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (_LOCK_KEY,))
+        if cur.fetchone()[0]:
+            return
+        if not waiting:
+            logging.info("Миграции БД применяет другой процесс, ждём")
+            waiting = True
+        time.sleep(_LOCK_POLL)
+
+
+def _record(cur, version: int, description: str):
+    cur.execute(
+        "INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s)",
+        (version, description, datetime.now(timezone.utc)),
+    )
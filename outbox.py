@@ -0,0 +1,212 @@
+"""Очередь исходящих сообщений, которые бот шлёт сам (не ответ на апдейт).
+
+Обработчики кладут сообщение в очередь и сразу возвращаются, отправляют
+несколько воркеров. Лимиты Telegram соблюдаются в двух местах:
+
+- глобальный — общий с рассылками TokenBucket (~30 сообщений/с на бота);
+- на чат — не чаще одного сообщения в per_chat_interval секунд. У каждого
+  чата своя очередь, в общую попадает только её первое сообщение, и не
+  раньше слота чата — воркеры не простаивают на «занятых» чатах.
+
+Сообщения одного чата уходят в порядке постановки. Из первых сообщений
+разных чатов раньше уходит то, у которого меньше priority (админам —
+HIGH), при равном — то, что поставлено раньше.
+
+RetryAfter ставит на паузу весь bucket, а сообщение возвращается в очередь
+через retry_after секунд. Ошибки сети повторяются с нарастающей паузой,
+остальные ошибки считаются окончательными. Forbidden отмечается в
+users.blocked_ts.
+
+Очередь в памяти: при остановке бот ждёт её опустошения не дольше
+drain(timeout), остальное теряется.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from breaker import TRANSIENT_ERRORS
+from db_async import is_reachable, mark_blocked
+from ratelimit import TokenBucket
+
+HIGH = 0      # админам: заявки, тревоги
+NORMAL = 1    # уведомления пользователям
+LOW = 2
+
+
+@dataclass
+class Outgoing:
+    method: str                   # метод Bot: send_message, send_photo, ...
+    chat_id: int
+    kwargs: dict
+    priority: int = NORMAL
+    # не слать тем, кто заблокировал бота (для пользователей, не для админов)
+    check_reachable: bool = False
+    attempts: int = 0
+    seq: int = 0
+    enqueued: float = field(default_factory=time.monotonic)
+    # True — доставлено, False — нет; можно дождаться, можно игнорировать
+    result: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class Outbox:
+    def __init__(self, bot: Bot, bucket: TokenBucket, workers: int = 4,
+                 per_chat_interval: float = 1.0, max_attempts: int = 3, retry_delay: float = 2.0):
+        self.bot = bot
+        self.bucket = bucket
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        # monotonic: когда чату можно отправить следующее сообщение
+        self._chat_next: dict[int, float] = {}
+        # очередь сообщений каждого чата; первое — в общей очереди или отправляется
+        self._chats: dict[int, deque[Outgoing]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.pending = 0          # в очереди, отложено или отправляется
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self.deferred = 0
+        self.max_wait = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            task = asyncio.create_task(self._worker(), name=f"outbox-{i}")
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    # ---------- постановка ----------
+
+    def enqueue(self, method: str, chat_id: int, priority: int = NORMAL,
+                check_reachable: bool = False, **kwargs: Any) -> asyncio.Future:
+        item = Outgoing(method, chat_id, kwargs, priority, check_reachable, seq=next(self._seq))
+        self.pending += 1
+        lane = self._chats.get(chat_id)
+        if lane:
+            # дождётся, пока уйдут предыдущие сообщения этого чата
+            lane.append(item)
+        else:
+            self._chats[chat_id] = deque([item])
+            self._schedule(item)
+        return item.result
+
+    def send_message(self, chat_id: int, text: str, priority: int = NORMAL, **kwargs) -> asyncio.Future:
+        return self.enqueue("send_message", chat_id, priority, text=text, **kwargs)
+
+    def send_photo(self, chat_id: int, photo: str, priority: int = NORMAL, **kwargs) -> asyncio.Future:
+        return self.enqueue("send_photo", chat_id, priority, photo=photo, **kwargs)
+
+    def _put(self, item: Outgoing):
+        self._queue.put_nowait((item.priority, item.seq, item))
+
+    def _put_later(self, item: Outgoing, delay: float):
+        asyncio.get_running_loop().call_later(delay, self._put, item)
+
+    def _schedule(self, item: Outgoing):
+        """В общую очередь — сразу или к слоту чата."""
+        delay = self._chat_next.get(item.chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            self.deferred += 1
+            self._put_later(item, delay)
+        else:
+            self._put(item)
+
+    # ---------- отправка ----------
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self._queue.get()
+            try:
+                await self._process(item)
+            except Exception:
+                logging.exception(f"Outbox: сбой при отправке в {item.chat_id}")
+                self._finish(item, False)
+
+    async def _process(self, item: Outgoing):
+        if item.check_reachable and item.attempts == 0 and not await is_reachable(item.chat_id):
+            self._finish(item, False)
+            return
+
+        await self.bucket.acquire()
+        # интервал чата считаем от фактической отправки, а не от постановки
+        self._chat_next[item.chat_id] = time.monotonic() + self.per_chat_interval
+        item.attempts += 1
+        try:
+            await getattr(self.bot, item.method)(item.chat_id, **item.kwargs)
+        except TelegramRetryAfter as e:
+            # flood wait: ждут все, и этот чат — не раньше, чем разрешат
+            self.bucket.pause(e.retry_after)
+            self._chat_next[item.chat_id] = time.monotonic() + e.retry_after
+            self._retry(item, e.retry_after, e)
+        except TelegramForbiddenError:
+            self.blocked += 1
+            await mark_blocked(item.chat_id)
+            self._finish(item, False)
+        except TRANSIENT_ERRORS as e:
+            self._retry(item, self.retry_delay * 2 ** (item.attempts - 1), e)
+        except Exception as e:
+            logging.debug(f"Outbox: не отправлено {item.method} в {item.chat_id}: {e}")
+            self._finish(item, False)
+        else:
+            self.sent += 1
+            self._finish(item, True)
+
+    def _retry(self, item: Outgoing, delay: float, error: Exception):
+        if item.attempts >= self.max_attempts:
+            logging.warning(f"Outbox: {item.method} в {item.chat_id} не ушло за {item.attempts} попыток: {error}")
+            self._finish(item, False)
+            return
+        self.retried += 1
+        self._put_later(item, delay)
+
+    def _finish(self, item: Outgoing, delivered: bool):
+        self.pending -= 1
+        if not delivered:
+            self.failed += 1
+        self.max_wait = max(self.max_wait, time.monotonic() - item.enqueued)
+        if not item.result.done():
+            item.result.set_result(delivered)
+        lane = self._chats[item.chat_id]
+        lane.popleft()
+        if lane:
+            self._schedule(lane[0])
+        else:
+            del self._chats[item.chat_id]
+        # слоты давно молчащих чатов не нужны
+        if len(self._chat_next) > 10_000:
+            now = time.monotonic()
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+
+    # ---------- остановка ----------
+
+    async def drain(self, timeout: float):
+        """Ждёт, пока очередь опустеет (но не дольше timeout), и останавливает воркеров."""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logging.warning(f"Outbox: при остановке не отправлено сообщений: {self.pending}")
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retried": self.retried,
+            "deferred": self.deferred,
+            "chats": len(self._chats),
+            "max_wait": self.max_wait,
+        }
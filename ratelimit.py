@@ -0,0 +1,53 @@
+"""Token bucket для исходящих сообщений.
+
+Telegram пропускает около 30 сообщений в секунду на бота; сверх этого
+отвечает RetryAfter (flood wait). Все массовые отправители берут токен
+перед каждым сообщением, а RetryAfter от Telegram ставит на паузу всех
+сразу — иначе соседние отправители продолжали бы упираться в тот же лимит.
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate                      # токенов в секунду
+        self.capacity = capacity or rate      # сколько можно отправить залпом
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # очередь ожидающих — по порядку, без обгонов
+        self._lock = asyncio.Lock()
+        self.acquired = 0
+        self.pauses = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Flood wait: никто не получает токен следующие seconds секунд."""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+        self.pauses += 1
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "acquired": self.acquired,
+            "pauses": self.pauses,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+        }
@@ -0,0 +1,43 @@
+"""Single-flight: одинаковые одновременные запросы выполняются один раз.
+
+Если по ключу уже идёт вызов, новый вызывающий не запускает свой, а ждёт
+тот же результат (или ту же ошибку). Как только вызов завершился, ключ
+освобождается — это не кэш, повторный запрос после завершения пойдёт заново.
+
+Результат общий для всех дождавшихся, поэтому изменять его нельзя.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # отмена одного ожидающего не должна отменять вызов для остальных
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # если все ожидающие отменились, ошибку никто не заберёт — забираем сами
+            task.exception()
+
+    def forget(self, key: Hashable):
+        """Следующий вызов по ключу начнёт новый запрос, даже если старый ещё идёт."""
+        self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"started": self.started, "shared": self.shared, "inflight": len(self._inflight)}
@@ -0,0 +1,455 @@
+"""Бэкенды хранения для db.py.
+
+db.py пишет SQL в стиле Postgres (%s-плейсхолдеры) и берёт соединения через
+backend.connection(readonly=...). Бэкенд выбирается по DATABASE_URL:
+
+- postgres://... — Postgres через пул psycopg2-соединений;
+- sqlite:///path/to/bot.db — встроенный SQLite в режиме WAL: одно пишущее
+  соединение (запись в SQLite всё равно последовательная) и пул читающих,
+  которые работают параллельно с записью.
+
+Соединение SQLite обёрнуто так, чтобы вести себя как psycopg2: %s → ?,
+транзакция открывается на первом запросе и закрывается commit()/rollback().
+Даты TIMESTAMPTZ хранятся ISO-строками в UTC и читаются обратно как datetime.
+"""
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class PoolTimeout(RuntimeError):
+    """Не дождались свободного соединения из пула."""
+
+
+# ---------- CONNECTION POOL ----------
+
+class _ConnectionPool:
+    """Простой потокобезопасный пул соединений.
+
+    - держит от min_size до max_size соединений;
+    - если все заняты — ждёт до timeout секунд;
+    - перед выдачей проверяет (ping) соединение, которое долго простаивало;
+    - битые и слишком старые соединения закрывает и пересоздаёт.
+
+    connect() создаёт соединение, ping(conn) проверяет его, reset(conn)
+    откатывает незакрытую транзакцию перед возвратом в пул.
+    """
+
+    def __init__(self, connect, min_size: int, max_size: int, timeout: float,
+                 recycle: float, ping_idle: float, ping=None, reset=None):
+        self._connect_fn = connect
+        self._ping = ping
+        self._reset = reset
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_idle = ping_idle
+
+        self._cond = threading.Condition()
+        self._idle: list[tuple] = []          # (conn, created_at, last_used)
+        self._born: dict[int, float] = {}     # id(conn) -> created_at
+        self._size = 0
+
+        # метрики
+        self.acquired = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.recycled = 0
+
+        for _ in range(self.min_size):
+            conn = self._connect()
+            self._idle.append((conn, self._born[id(conn)], time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = self._connect_fn()
+        self._born[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, created_at: float, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if self.recycle and now - created_at > self.recycle:
+            return False
+        if self._ping and self.ping_idle and now - last_used > self.ping_idle:
+            try:
+                self._ping(conn)
+            except Exception:
+                return False
+        return True
+
+    def getconn(self):
+        started = time.monotonic()
+        waited = False
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = self.timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            f"Нет свободного соединения с БД за {self.timeout:.1f} c "
+                            f"(занято {self._size}/{self.max_size})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    fresh = False
+                else:
+                    # резервируем место под новое соединение
+                    self._size += 1
+                    conn = None
+                    fresh = True
+
+            if fresh:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, created_at, last_used):
+                self._discard(conn)
+                with self._cond:
+                    self._size -= 1
+                    self.recycled += 1
+                    self._cond.notify()
+                continue
+
+            spent = time.monotonic() - started
+            with self._cond:
+                self.acquired += 1
+                if waited:
+                    self.waits += 1
+                self.wait_total += spent
+                self.wait_max = max(self.wait_max, spent)
+            return conn
+
+    def putconn(self, conn, broken: bool = False):
+        created_at = self._born.get(id(conn), 0.0)
+        bad = broken or conn.closed
+        if not bad and self._reset:
+            try:
+                self._reset(conn)
+            except Exception:
+                bad = True
+        if not bad and self.recycle and time.monotonic() - created_at > self.recycle:
+            bad = True
+
+        with self._cond:
+            if bad:
+                self._size -= 1
+                self.recycled += 1
+            else:
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+        if bad:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                "size": self._size,
+                "idle": idle,
+                "in_use": self._size - idle,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_avg_ms": (self.wait_total / self.acquired * 1000) if self.acquired else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "timeouts": self.timeouts,
+                "recycled": self.recycled,
+            }
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+# ---------- POSTGRES ----------
+
+class PostgresBackend:
+    dialect = "postgres"
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, timeout: float,
+                 recycle: float, ping_idle: float):
+        import psycopg2
+        import psycopg2.extensions
+
+        self._psycopg2 = psycopg2
+        self.dsn = dsn
+
+        def ping(conn):
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+
+        def reset(conn):
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+        self.pool = _ConnectionPool(
+            lambda: psycopg2.connect(dsn),
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            recycle=recycle,
+            ping_idle=ping_idle,
+            ping=ping,
+            reset=reset,
+        )
+
+    @contextmanager
+    def connection(self, readonly: bool = False):
+        """Берёт соединение из пула: commit при успехе, rollback при ошибке, потом возвращает в пул."""
+        psycopg2 = self._psycopg2
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # соединение, скорее всего, порвалось — в пул его не возвращаем
+            broken = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.pool.putconn(conn, broken)
+
+    def stats(self) -> dict:
+        return {"backend": self.dialect, **self.pool.stats()}
+
+    def close(self):
+        self.pool.closeall()
+
+
+# ---------- SQLITE ----------
+
+def _adapt_datetime(value: datetime) -> str:
+    # одинаковый формат для всех дат, чтобы их можно было сравнивать как строки
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _convert_timestamptz(value: bytes) -> datetime | str:
+    text = value.decode()
+    try:
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        return text
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMPTZ", _convert_timestamptz)
+
+_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE\b", re.IGNORECASE)
+
+
+def _sqlite_sql(sql: str) -> str:
+    """Postgres-SQL из db.py → SQLite: плейсхолдеры и FOR UPDATE.
+
+    FOR UPDATE можно просто убрать: пишущее соединение одно и держится
+    под замком всю транзакцию (BEGIN IMMEDIATE).
+    """
+    return _FOR_UPDATE.sub("", sql).replace("%s", "?")
+
+
+class _SQLiteCursor:
+    def __init__(self, owner: "_SQLiteConnection"):
+        self._owner = owner
+        self._cur = owner.raw.cursor()
+
+    def execute(self, sql: str, params=()):
+        self._owner._begin()
+        self._cur.execute(_sqlite_sql(sql), params)
+        return self
+
+    def executemany(self, sql: str, seq):
+        self._owner._begin()
+        self._cur.executemany(_sqlite_sql(sql), seq)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size: int):
+        return self._cur.fetchmany(size)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    @property
+    def rowcount(self) -> int:
+        return self._cur.rowcount
+
+    def close(self):
+        self._cur.close()
+
+
+class _SQLiteConnection:
+    """sqlite3-соединение с транзакциями как в psycopg2."""
+
+    def __init__(self, raw: sqlite3.Connection, writer: bool):
+        self.raw = raw
+        self.writer = writer
+        self.autocommit = False
+        self.closed = False
+
+    def _begin(self):
+        if not self.autocommit and not self.raw.in_transaction:
+            # писатель сразу берёт RESERVED-lock, чтобы не ловить SQLITE_BUSY посреди транзакции
+            self.raw.execute("BEGIN IMMEDIATE" if self.writer else "BEGIN")
+
+    def cursor(self):
+        return _SQLiteCursor(self)
+
+    def commit(self):
+        if self.raw.in_transaction:
+            self.raw.execute("COMMIT")
+
+    def rollback(self):
+        if self.raw.in_transaction:
+            self.raw.execute("ROLLBACK")
+
+    def close(self):
+        self.closed = True
+        self.raw.close()
+
+
+class SQLiteBackend:
+    dialect = "sqlite"
+
+    def __init__(self, path: str, readers: int, timeout: float):
+        self.path = path
+        self.timeout = timeout
+
+        self._writer = self._connect(writer=True)
+        self._write_lock = threading.Lock()
+        self.write_acquired = 0
+        self.write_wait_total = 0.0
+        self.write_wait_max = 0.0
+
+        def ping(conn):
+            conn.raw.execute("SELECT 1").fetchone()
+
+        self.readers = _ConnectionPool(
+            lambda: self._connect(writer=False),
+            min_size=0,
+            max_size=readers,
+            timeout=timeout,
+            recycle=0,
+            ping_idle=0,
+            ping=ping,
+            reset=lambda conn: conn.rollback(),
+        )
+
+    def _connect(self, writer: bool) -> _SQLiteConnection:
+        raw = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,          # транзакциями управляет _SQLiteConnection
+            check_same_thread=False,       # соединения ходят между потоками db_async
+            detect_types=sqlite3.PARSE_DECLTYPES,
+        )
+        raw.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        if writer:
+            raw.execute("PRAGMA journal_mode=WAL")
+            raw.execute("PRAGMA synchronous=NORMAL")
+        else:
+            raw.execute("PRAGMA query_only=ON")
+        return _SQLiteConnection(raw, writer=writer)
+
+    @contextmanager
+    def connection(self, readonly: bool = False):
+        if readonly:
+            conn = self.readers.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.readers.putconn(conn)
+            return
+
+        started = time.monotonic()
+        if not self._write_lock.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"SQLite: пишущее соединение занято дольше {self.timeout:.1f} c")
+        spent = time.monotonic() - started
+        self.write_acquired += 1
+        self.write_wait_total += spent
+        self.write_wait_max = max(self.write_wait_max, spent)
+        try:
+            yield self._writer
+            self._writer.commit()
+        except Exception:
+            self._writer.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+
+    def stats(self) -> dict:
+        s = self.readers.stats()
+        # писатель считаем как ещё одно постоянное соединение пула
+        s["size"] += 1
+        s["min_size"] += 1
+        s["max_size"] += 1
+        s["in_use"] += int(self._write_lock.locked())
+        return {
+            "backend": self.dialect,
+            **s,
+            "writer_acquired": self.write_acquired,
+            "writer_wait_avg_ms": (self.write_wait_total / self.write_acquired * 1000)
+            if self.write_acquired else 0.0,
+            "writer_wait_max_ms": self.write_wait_max * 1000,
+        }
+
+    def close(self):
+        self.readers.closeall()
+        with self._write_lock:
+            self._writer.close()
+
+
+def sqlite_path(url: str) -> str | None:
+    """sqlite:///bot.db → bot.db, sqlite:////abs/bot.db → /abs/bot.db; иначе None."""
+    if url.startswith("sqlite:///"):
+        return url[len("sqlite:///"):]
+    if url.startswith("sqlite://"):
+        return url[len("sqlite://"):]
+    return None
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db.py требует DATABASE_URL при импорте; каждый тест получает свою базу (фикстура db)
+os.environ.setdefault("DATABASE_URL", "sqlite:///unused.db")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая SQLite-база со всеми миграциями."""
+    import db as db_module
+
+    db_module.close_pool()
+    monkeypatch.setattr(db_module, "DATABASE_URL", f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setattr(db_module, "_stats_cache", None)
+    db_module.init_db()
+    yield db_module
+    db_module.close_pool()
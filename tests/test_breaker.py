@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError
+from aiogram.methods import GetChat
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+METHOD = GetChat(chat_id=1)
+
+
+async def _fail():
+    raise TelegramNetworkError(METHOD, "timeout")
+
+
+async def _bad_request():
+    raise TelegramBadRequest(METHOD, "chat not found")
+
+
+async def _ok():
+    return "ok"
+
+
+def test_opens_after_threshold_and_recovers():
+    async def run():
+        b = CircuitBreaker("t", failure_threshold=2, base_delay=0.05, jitter=0)
+        for _ in range(2):
+            with pytest.raises(TelegramNetworkError):
+                await b.call(_fail)
+        assert b.state == OPEN
+        with pytest.raises(CircuitOpen):
+            await b.call(_ok)
+
+        await asyncio.sleep(0.06)
+        # пробный вызов (half-open) удался — breaker закрыт
+        assert await b.call(_ok) == "ok"
+        assert (b.state, b.trips, b.rejected) == (CLOSED, 1, 1)
+
+    asyncio.run(run())
+
+
+def test_failed_probe_doubles_delay():
+    async def run():
+        b = CircuitBreaker("t", failure_threshold=1, base_delay=0.05, jitter=0)
+        with pytest.raises(TelegramNetworkError):
+            await b.call(_fail)
+        await asyncio.sleep(0.06)
+        assert b.allow() and b.state == HALF_OPEN
+        # пока идёт проба, остальные получают отказ
+        assert not b.allow()
+        b.record_failure(RuntimeError("still down"))
+        assert b.state == OPEN
+        assert b.stats()["retry_in"] > 0.06
+
+    asyncio.run(run())
+
+
+def test_bad_request_is_not_a_failure():
+    async def run():
+        b = CircuitBreaker("t", failure_threshold=1)
+        with pytest.raises(TelegramBadRequest):
+            await b.call(_bad_request)
+        assert (b.state, b.failures) == (CLOSED, 0)
+
+    asyncio.run(run())
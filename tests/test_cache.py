@@ -0,0 +1,38 @@
+import cache
+from cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_ttl_per_entry(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, "time", clock)
+    c = TTLCache(10)
+    c.set("yes", True, ttl=60)
+    c.set("no", False, ttl=5)
+
+    clock.now += 10
+    assert c.get("no", "missing") == "missing"
+    assert c.get("yes") is True
+    clock.now += 60
+    assert c.purge() == 1
+    assert len(c) == 0
+    assert (c.hits, c.misses) == (1, 1)
+
+
+def test_lru_eviction():
+    c = TTLCache(2)
+    c.set("a", 1, ttl=60)
+    c.set("b", 2, ttl=60)
+    # "a" использован последним — вытесняется "b"
+    assert c.get("a") == 1
+    c.set("c", 3, ttl=60)
+    assert c.get("b") is None
+    assert (c.get("a"), c.get("c")) == (1, 3)
+    assert c.evictions == 1
@@ -0,0 +1,117 @@
+"""db.py на SQLite-бэкенде: без сервера, каждый тест на своей базе."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import migrations
+
+
+def _exec(db, sql, params=()):
+    with db._connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+
+
+def test_init_db_applies_all_migrations_once(db):
+    with db._connection(readonly=True) as conn:
+        assert migrations.current_version(conn) == migrations.LATEST_VERSION
+    # повторный старт — один запрос MAX(version), ничего не применяется
+    assert db.init_db() == []
+
+
+def test_backfill_timestamps_moves_text_dates(db, caplog):
+    for tg_id in range(1, 6):
+        db.create_user(tg_id)
+    _exec(db, "UPDATE users SET created_ts=NULL, created_at='2024-01-02T03:04:05' WHERE tg_id <= 3")
+    _exec(db, "UPDATE users SET created_at='2025-13-01' WHERE tg_id = 1")
+
+    assert db.backfill_timestamps(batch_size=2) == 2
+    assert db.get_user(2)[5] == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    # кривая дата не роняет пачку: остаётся NULL и попадает в лог
+    assert db.get_user(1)[5] is None
+    assert "2025-13-01" in caplog.text
+    # проход завершён — следующие старты таблицы не сканируют
+    _exec(db, "UPDATE users SET created_ts=NULL WHERE tg_id = 4")
+    assert db.backfill_timestamps() == 0
+
+
+def test_backfill_rebuilds_hourly_stats(db):
+    db.create_user(1)
+    _exec(db, "UPDATE users SET created_ts=NULL, created_at=%s", (datetime.now(timezone.utc).isoformat(),))
+    _exec(db, "DELETE FROM stats_new_users_hourly")
+    db._stats_cache = None
+    assert db.get_stats()["new_24h"] == 0
+
+    db.backfill_timestamps()
+    assert db.get_stats()["new_24h"] == 1
+
+
+def test_request_withdrawal_reserves_balance(db):
+    db.create_user(1)
+    db.add_balance(1, 10.0, reason="admin")
+
+    wid = db.request_withdrawal(1, "card", "1234", 7.0)
+    assert wid is not None
+    assert db.get_balance(1) == 3.0
+    assert db.get_withdraw(wid)[5] == "new"
+    # не хватает — ни списания, ни заявки
+    assert db.request_withdrawal(1, "card", "1234", 7.0) is None
+    assert db.get_balance(1) == 3.0
+    assert len(db.list_new_withdrawals()) == 1
+
+
+def test_ledger_and_rebuild_balance(db):
+    db.create_user(1)
+    db.add_balance(1, 5.0, reason="admin")
+    db.add_balance(1, 2.5, reason="referral", ref_id=2)
+    assert db.take_balance_snapshots() == 1
+    db.add_balance(1, -1.0, reason="admin")
+    db.request_withdrawal(1, "card", "1234", 4.0)
+
+    reasons = [row[3] for row in db.get_ledger(1)]
+    assert reasons == ["withdrawal", "admin", "referral", "admin"]
+    assert db.rebuild_balance(1) == 2.5
+    assert db.audit_balance(1) == (2.5, 2.5)
+
+
+def test_task_approval_and_daily_bonus_pay_once(db):
+    db.create_user(1)
+    sub_id = db.create_task_submission(1, "1", "file", "")
+    assert db.approve_task_submission(sub_id, 2.0) == 2.0
+    assert db.approve_task_submission(sub_id, 2.0) is None
+    assert db.reject_task_submission(sub_id) is False
+
+    now = datetime.now(timezone.utc)
+    day = timedelta(hours=24)
+    assert db.claim_daily_bonus(1, 0.3, now, day) == 2.3
+    assert db.claim_daily_bonus(1, 0.3, now, day) is None
+    assert db.claim_daily_bonus(1, 0.3, now + day, day) == pytest.approx(2.6)
+    balance, rebuilt = db.audit_balance(1)
+    assert balance == pytest.approx(rebuilt)
+
+
+def test_reconcile_stats_fixes_drifted_counters(db):
+    for tg_id in range(1, 4):
+        db.create_user(tg_id)
+    db.activate_user(1)
+    db.ban_user(2)
+    _exec(db, "UPDATE stats_counters SET value=100 WHERE name='total_users'")
+
+    assert db.reconcile_stats() == {"total_users": (100, 3)}
+    stats = db.get_stats()
+    assert (stats["total_users"], stats["activated_users"], stats["banned_users"]) == (3, 1, 1)
+    assert stats["new_24h"] == 3
+
+
+def test_keyset_pages(db):
+    for tg_id in range(101, 108):
+        db.create_user(tg_id)
+
+    first = db.list_users_after(0, 3)
+    assert [row[1] for row in first] == [101, 102, 103]
+    second = db.list_users_after(first[-1][0], 3)
+    assert [row[1] for row in second] == [104, 105, 106]
+    assert [row[1] for row in db.list_users_after(second[-1][0], 3)] == [107]
+    # назад — тоже по возрастанию id
+    assert db.list_users_before(second[0][0], 3) == first
+    assert db.find_user_pk(105) == second[1][0]
@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+
+def test_read_after_write_does_not_join_older_read(db):
+    import db_async
+
+    def slow_get_user(tg_id):
+        row = db.get_user(tg_id)
+        time.sleep(0.1)
+        return row
+
+    read = db_async._async_read(slow_get_user)
+    db.create_user(1)
+
+    async def run():
+        old = asyncio.ensure_future(read(1))
+        await asyncio.sleep(0.02)
+        await db_async.add_balance(1, 5.0)
+        # чтение, начатое до записи, тому, кто записал, не отдаётся
+        fresh = await read(1)
+        return (await old)[1], fresh[1]
+
+    assert asyncio.run(run()) == (0.0, 5.0)
+
+
+def test_concurrent_reads_are_shared(db):
+    import db_async
+
+    db.create_user(1)
+
+    async def run():
+        before = db_async.singleflight_stats()["shared"]
+        rows = await asyncio.gather(*(db_async.get_user(1) for _ in range(3)))
+        return rows, db_async.singleflight_stats()["shared"] - before
+
+    rows, shared = asyncio.run(run())
+    assert rows[0] == rows[1] == rows[2]
+    assert shared == 2
@@ -0,0 +1,50 @@
+"""Хранилища состояния диалогов: запись живёт ttl с последнего изменения."""
+import asyncio
+
+import cache
+from fsm import WITHDRAW, create_flow_store
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_memory_store_expires(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, "time", clock)
+    flows = create_flow_store("memory", ttl_minutes=1, max_users=10)
+
+    async def run():
+        await flows.set(1, WITHDRAW, {"state": "amount"})
+        data = await flows.get(1, WITHDRAW)
+        # копия: правка без set() в хранилище не попадает
+        data["state"] = "changed"
+        assert await flows.get(1, WITHDRAW) == {"state": "amount"}
+
+        clock.now += 61
+        assert await flows.get(1, WITHDRAW) is None
+        await flows.set(2, WITHDRAW, {})
+        clock.now += 61
+        assert await flows.purge() == 1
+
+    asyncio.run(run())
+
+
+def test_db_store_expires_and_purges(db):
+    live = create_flow_store("db", ttl_minutes=30)
+    expired = create_flow_store("db", ttl_minutes=-1)
+
+    async def run():
+        await live.set(1, WITHDRAW, {"state": "details", "amount": 5})
+        await expired.set(2, WITHDRAW, {"state": "amount"})
+        assert await live.get(1, WITHDRAW) == {"state": "details", "amount": 5}
+        assert await live.get(2, WITHDRAW) is None
+        assert await live.purge() == 1
+        await live.clear(1, WITHDRAW)
+        assert await live.get(1, WITHDRAW) is None
+
+    asyncio.run(run())
@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+from lanes import UserLanes
+
+
+def _data(user_id):
+    return {"event_from_user": SimpleNamespace(id=user_id)}
+
+
+def test_one_user_in_order_different_users_in_parallel():
+    log = []
+
+    def handler(name, delay):
+        async def handle(event, data):
+            log.append(("start", name))
+            await asyncio.sleep(delay)
+            log.append(("end", name))
+        return handle
+
+    async def run():
+        lanes = UserLanes(concurrency=4)
+        await asyncio.gather(
+            lanes(handler("a1", 0.03), None, _data(1)),
+            lanes(handler("a2", 0.0), None, _data(1)),
+            lanes(handler("b1", 0.0), None, _data(2)),
+        )
+        return lanes
+
+    lanes = asyncio.run(run())
+    # второй апдейт пользователя 1 ждёт первый, пользователь 2 не ждёт никого
+    assert log.index(("start", "a2")) > log.index(("end", "a1"))
+    assert log.index(("end", "b1")) < log.index(("end", "a1"))
+    stats = lanes.stats()
+    assert (stats["handled"], stats["lanes"], stats["max_depth"]) == (3, 0, 2)
+
+
+def test_concurrency_limit():
+    running = peak = 0
+
+    async def handle(event, data):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        lanes = UserLanes(concurrency=2)
+        await asyncio.gather(*(lanes(handle, None, _data(uid)) for uid in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_flood_is_dropped():
+    async def handle(event, data):
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def run():
+        lanes = UserLanes(max_pending=2)
+        results = await asyncio.gather(*(lanes(handle, None, _data(1)) for _ in range(5)))
+        return lanes, results
+
+    lanes, results = asyncio.run(run())
+    assert results.count("ok") == 3
+    assert lanes.dropped == 2
@@ -0,0 +1,94 @@
+import asyncio
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from outbox import HIGH, LOW, Outbox
+from ratelimit import TokenBucket
+
+METHOD = SendMessage(chat_id=1, text="x")
+
+
+class FakeBot:
+    def __init__(self, errors=None):
+        # chat_id -> ошибки, которые вернут первые попытки
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+def _outbox(bot, **kwargs):
+    kwargs = {"workers": 1, "per_chat_interval": 0, "retry_delay": 0.01, **kwargs}
+    return Outbox(bot, TokenBucket(1000), **kwargs)
+
+
+def test_transient_errors_are_retried():
+    bot = FakeBot({1: [TelegramNetworkError(METHOD, "timeout"), TelegramRetryAfter(METHOD, "flood", 0)]})
+
+    async def run():
+        outbox = _outbox(bot)
+        outbox.start()
+        delivered = await outbox.send_message(1, "hi")
+        await outbox.drain(1)
+        return outbox, delivered
+
+    outbox, delivered = asyncio.run(run())
+    assert delivered is True
+    assert bot.sent == [(1, "hi")]
+    assert (outbox.retried, outbox.failed, outbox.pending) == (2, 0, 0)
+
+
+def test_gives_up_after_max_attempts():
+    bot = FakeBot({1: [TelegramNetworkError(METHOD, "timeout") for _ in range(3)]})
+
+    async def run():
+        outbox = _outbox(bot, max_attempts=3)
+        outbox.start()
+        delivered = await outbox.send_message(1, "hi")
+        await outbox.drain(1)
+        return outbox, delivered
+
+    outbox, delivered = asyncio.run(run())
+    assert delivered is False
+    assert (outbox.retried, outbox.failed) == (2, 1)
+
+
+def test_forbidden_marks_user_blocked(db):
+    db.create_user(7)
+    bot = FakeBot({7: [TelegramForbiddenError(METHOD, "bot was blocked by the user")]})
+
+    async def run():
+        outbox = _outbox(bot)
+        outbox.start()
+        first = await outbox.send_message(7, "hi")
+        # следующее уведомление заблокировавшему не отправляется вовсе
+        second = await outbox.enqueue("send_message", 7, check_reachable=True, text="again")
+        await outbox.drain(1)
+        return outbox, first, second
+
+    outbox, first, second = asyncio.run(run())
+    assert (first, second) == (False, False)
+    assert bot.sent == []
+    assert outbox.blocked == 1
+    assert db.is_reachable(7) is False
+
+
+def test_chat_order_and_priority():
+    bot = FakeBot()
+
+    async def run():
+        outbox = _outbox(bot)
+        for text in ("1", "2", "3"):
+            outbox.send_message(10, text, priority=LOW)
+        outbox.send_message(20, "admin", priority=HIGH)
+        outbox.start()
+        await outbox.drain(1)
+
+    asyncio.run(run())
+    # админу — раньше, сообщения одного чата — в порядке постановки
+    assert bot.sent == [(20, "admin"), (10, "1"), (10, "2"), (10, "3")]
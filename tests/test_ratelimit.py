@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from ratelimit import TokenBucket
+
+
+def test_burst_then_rate():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=5)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(5):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(run())
+    assert burst < 0.05
+    # ещё 5 токенов по 50/с — не меньше ~0.1 с
+    assert total >= 0.09
+
+
+def test_pause_blocks_everyone():
+    async def run():
+        bucket = TokenBucket(rate=1000)
+        bucket.pause(0.2)
+        started = time.monotonic()
+        await asyncio.gather(bucket.acquire(), bucket.acquire())
+        return time.monotonic() - started, bucket.stats()
+
+    waited, stats = asyncio.run(run())
+    assert waited >= 0.19
+    assert (stats["acquired"], stats["pauses"]) == (2, 1)
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_flight():
+    calls = []
+
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return {"key": key}
+
+    async def run():
+        sf = SingleFlight()
+        results = await asyncio.gather(*(sf.do("k", load, "k") for _ in range(5)))
+        # после завершения ключ свободен — это не кэш
+        again = await sf.do("k", load, "k")
+        return sf, results, again
+
+    sf, results, again = asyncio.run(run())
+    assert calls == ["k", "k"]
+    assert all(r is results[0] for r in results)
+    assert again is not results[0]
+    assert sf.stats() == {"started": 2, "shared": 4, "inflight": 0}
+
+
+def test_error_reaches_every_waiter_and_cancel_is_isolated():
+    async def boom():
+        await asyncio.sleep(0.01)
+        raise ValueError("db down")
+
+    async def run():
+        sf = SingleFlight()
+        first = asyncio.ensure_future(sf.do("k", boom))
+        second = asyncio.ensure_future(sf.do("k", boom))
+        await asyncio.sleep(0)
+        # отмена одного ожидающего не отменяет вызов для второго
+        first.cancel()
+        with pytest.raises(ValueError):
+            await second
+
+    asyncio.run(run())
+
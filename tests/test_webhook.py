@@ -0,0 +1,96 @@
+"""webhook.build_app на локальном aiohttp-сервере, без Telegram."""
+import asyncio
+import re
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+
+from webhook import build_app, webhook_secret
+
+TOKEN = "42:TEST"
+SECRET = "s3cret"
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 7, "type": "private"},
+        "from": {"id": 7, "is_bot": False, "first_name": "T"},
+        "text": "hello",
+    },
+}
+
+
+def _dispatcher(seen: list) -> Dispatcher:
+    dp = Dispatcher()
+    router = Router()
+
+    @router.message()
+    async def echo(message: Message):
+        seen.append(message.text)
+
+    dp.include_router(router)
+    dp.startup.register(lambda: seen.append("startup"))
+    dp.shutdown.register(lambda: seen.append("shutdown"))
+    return dp
+
+
+async def _post(secret: str | None, seen: list) -> int:
+    bot = Bot(TOKEN)
+    app = build_app(_dispatcher(seen), bot, "/hook", SECRET)
+    async with TestClient(TestServer(app)) as client:
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+        resp = await client.post("/hook", json=UPDATE, headers=headers)
+        # апдейт обрабатывается в фоне после ответа
+        for _ in range(50 if resp.status == 200 else 0):
+            if "hello" in seen:
+                break
+            await asyncio.sleep(0.01)
+    await bot.session.close()
+    return resp.status
+
+
+def test_update_with_secret_is_handled():
+    seen = []
+    assert asyncio.run(_post(SECRET, seen)) == 200
+    assert seen == ["startup", "hello", "shutdown"]
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    for secret in ("wrong", None):
+        seen = []
+        assert asyncio.run(_post(secret, seen)) == 401
+        assert "hello" not in seen
+
+
+def test_default_secret_is_stable_and_allowed_by_telegram():
+    secret = webhook_secret(TOKEN)
+    assert secret == webhook_secret(TOKEN)
+    assert re.fullmatch(r"[A-Za-z0-9_-]{1,256}", secret)
+
+
+def test_bot_api_stand_in():
+    """Бот ходит в свой Bot API (как с TELEGRAM_API_URL) — здесь это заглушка."""
+
+    async def get_me(request: web.Request) -> web.Response:
+        assert request.match_info["token"] == TOKEN
+        return web.json_response({"ok": True, "result": {"id": 42, "is_bot": True, "first_name": "Stub"}})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/bot{token}/getMe", get_me)
+        async with TestServer(app) as server:
+            session = AiohttpSession(api=TelegramAPIServer.from_base(str(server.make_url(""))))
+            bot = Bot(TOKEN, session=session)
+            try:
+                return await bot.get_me()
+            finally:
+                await bot.session.close()
+
+    me = asyncio.run(run())
+    assert (me.id, me.first_name) == (42, "Stub")
@@ -0,0 +1,77 @@
+"""Строка пользователя, загруженная один раз на апдейт.
+
+UserContextMiddleware перед хендлером одним запросом читает users и кладёт
+UserContext в data["user"]; хендлеры получают его аргументом `user` и дальше
+смотрят бан, язык, баланс и бонус в нём, а не отдельными запросами.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from db_async import get_user
+
+
+@dataclass
+class UserContext:
+    tg_id: int
+    exists: bool = False
+    balance: float = 0.0
+    referrer_id: int | None = None
+    activated: bool = False
+    phone: str | None = None
+    created_at: datetime | None = None
+    last_bonus_at: datetime | None = None
+    banned: bool = False
+    language: str = "unset"
+    blocked_at: datetime | None = None
+
+    @property
+    def lang(self) -> str:
+        """Язык для текстов: пока пользователь не выбрал — русский."""
+        return self.language if self.language in ("ru", "ua") else "ru"
+
+    @classmethod
+    def from_row(cls, tg_id: int, row) -> "UserContext":
+        if not row:
+            return cls(tg_id=tg_id)
+        # get_user: (tg_id, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned, language,
+        #            blocked_at)
+        (_, balance, referrer_id, activated, phone, created_at, last_bonus_at, banned, language,
+         blocked_at) = row
+        if language not in ("ru", "ua", "unset"):
+            language = "unset"
+        return cls(
+            tg_id=tg_id,
+            exists=True,
+            balance=float(balance or 0),
+            referrer_id=referrer_id,
+            activated=bool(activated),
+            phone=phone,
+            created_at=created_at,
+            last_bonus_at=last_bonus_at,
+            banned=bool(banned),
+            language=language,
+            blocked_at=blocked_at,
+        )
+
+
+async def load_user_context(tg_id: int) -> UserContext:
+    return UserContext.from_row(tg_id, await get_user(tg_id))
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Outer-middleware: загружает UserContext для отправителя апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user is not None:
+            data["user"] = await load_user_context(from_user.id)
+        return await handler(event, data)
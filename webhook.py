@@ -0,0 +1,76 @@
+"""Режим webhook вместо long polling.
+
+Если задан WEBHOOK_URL, бот поднимает aiohttp-сервер и принимает апдейты на
+WEBHOOK_PATH, а Telegram получает адрес через set_webhook. Запрос без
+верного заголовка X-Telegram-Bot-Api-Secret-Token отклоняется (это делает
+SimpleRequestHandler). Апдейт обрабатывается в фоне, Telegram сразу
+получает 200.
+
+Роутер и middleware те же, что при polling. Хуки dp.startup / dp.shutdown
+вызываются при старте и остановке сервера. set_webhook выполняется,
+когда сервер уже слушает порт. Процессов на одном токене может быть
+несколько: каждый ставит webhook с одинаковыми параметрами. Рассылку при
+этом ведёт один процесс (см. broadcast.py).
+
+Секрет по умолчанию выводится из токена, чтобы у всех процессов он
+совпадал без отдельной настройки.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import signal
+from contextlib import suppress
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                       # https://host, пусто — long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # 1..100, параллельных запросов от Telegram
+
+
+def webhook_secret(token: str) -> str:
+    # допустимы только A-Z, a-z, 0-9, _ и -; hex подходит
+    return WEBHOOK_SECRET or hashlib.sha256(token.encode()).hexdigest()
+
+
+def build_app(dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str | None = None) -> web.Application:
+    """aiohttp-приложение с обработчиком апдейтов и хуками диспетчера."""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Работает до SIGINT/SIGTERM, затем останавливает сервер (и dp.shutdown)."""
+    secret = webhook_secret(bot.token)
+    runner = web.AppRunner(build_app(dp, bot, WEBHOOK_PATH, secret))
+    # startup-хуки выполняются здесь
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Webhook: {WEBHOOK_URL}{WEBHOOK_PATH}, слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        with suppress(NotImplementedError):
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        logging.info("Webhook: остановка")
+    finally:
+        # webhook не снимаем: апдейты подождут у Telegram до следующего запуска
+        await runner.cleanup()
+        await bot.session.close()